@@ -0,0 +1,310 @@
+"""Benchmarks for goob: generates a synthetic repo, times goob's commands against
+it and writes the results as JSON, so runs can be compared to catch regressions.
+
+    python bench_goob.py --files 10000 --depth 4 --output new.json
+    python bench_goob.py --files 10000 --depth 4 --compare old.json
+
+Each benchmark runs in its own (forked) process, so the peak memory reported is
+that benchmark's own and every run starts with goob's caches empty. Benchmarks
+that change the repo run on a fresh copy of it."""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import resource
+import tempfile
+import argparse
+import platform
+from collections import OrderedDict
+from multiprocessing import Process, Queue
+
+import goob
+
+DEFAULTS = OrderedDict([
+    ("files", 1000),    # files in the repo
+    ("depth", 3),       # deepest directory nesting
+    ("fanout", 4),      # subdirectories per directory
+    ("file_size", 1024),
+    ("commits", 10),    # length of the history
+    ("changes", 10),    # files modified per commit (and by the "changed" benchmarks)
+    ("seed", 0),
+])
+
+# REPO GENERATOR
+def make_repo(path, files=1000, depth=3, fanout=4, file_size=1024, commits=10,
+    changes=10, seed=0):
+    """Makes a goob repo at 'path' with 'files' files of about 'file_size' bytes,
+        spread over directories up to 'depth' deep, and a history of 'commits'
+        commits, each modifying 'changes' files. Returns the paths of the files."""
+    rand = random.Random(seed)
+    dirs = [""]
+    level = [""]
+    for _ in xrange(depth):
+        level = [os.path.join(parent, "d%d" % i) for parent in level for i in xrange(fanout)]
+        dirs.extend(level)
+
+    filenames = sorted(os.path.join(rand.choice(dirs), "f%d.txt" % i) for i in xrange(files))
+    os.makedirs(path)
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        goob.init()
+        for filename in filenames:
+            _write_file(filename, rand, file_size)
+        _backdate(filenames)
+        goob.add_all()
+        goob.commit("initial commit")
+        for i in xrange(1, commits):
+            modified = rand.sample(filenames, min(changes, len(filenames)))
+            for filename in modified:
+                _write_file(filename, rand, file_size)
+            _backdate(modified)
+            goob.add(*modified)
+            goob.commit("commit %d" % i)
+    finally:
+        os.chdir(cwd)
+    return filenames
+
+def _write_file(filename, rand, size):
+    dir = os.path.dirname(filename)
+    if dir and not os.path.exists(dir):
+        os.makedirs(dir)
+    # lines of text, so diffs and deltas have something to work with
+    lines = []
+    while sum(len(line) for line in lines) < size:
+        lines.append("%08x %s\n" % (rand.getrandbits(32), "x" * rand.randrange(10, 70)))
+    with open(filename, 'w') as f:
+        f.write("".join(lines)[:size])
+
+def _backdate(filenames):
+    # goob doesn't trust stat data for files modified in the current second (see
+    # write_index), which would make every benchmark rehash the latest edits
+    then = time.time() - 60
+    for filename in filenames:
+        os.utime(filename, (then, then))
+
+def _modify(filenames, count, seed):
+    rand = random.Random(seed)
+    modified = rand.sample(filenames, min(count, len(filenames)))
+    for filename in modified:
+        with open(filename, 'a') as f:
+            f.write("changed\n")
+    return modified
+
+# BENCHMARKS
+# each is (setup, run, whether it changes the repo). setup(ctx) is untimed; run(ctx) is
+# timed. ctx has the repo's files, the params and whatever setup left in it.
+BENCHMARKS = OrderedDict()
+
+def benchmark(name, mutates=False):
+    def register(func):
+        def setup(ctx):
+            return ctx
+        BENCHMARKS[name] = (getattr(func, "setup", setup), func, mutates)
+        return func
+    return register
+
+def with_setup(setup):
+    def attach(func):
+        func.setup = setup
+        return func
+    return attach
+
+def _setup_changed(ctx):
+    ctx["modified"] = _modify(ctx["filenames"], ctx["params"]["changes"], 1)
+    return ctx
+
+def _setup_staged(ctx):
+    _setup_changed(ctx)
+    goob.add(*ctx["modified"])
+    return ctx
+
+def _setup_lookups(ctx):
+    rand = random.Random(2)
+    ctx["tree_hash"] = goob.read_hash(goob.get_cur_head()).tree_hash
+    ctx["lookups"] = [rand.choice(ctx["filenames"]) for _ in xrange(100)]
+    return ctx
+
+def _setup_first_commit(ctx):
+    ctx["first"] = [entry.hash for entry in goob.log()][-1]
+    return ctx
+
+@benchmark("add (changed files)", mutates=True)
+@with_setup(_setup_changed)
+def bench_add(ctx):
+    goob.add(*ctx["modified"])
+
+@benchmark("add_all (changed files)", mutates=True)
+@with_setup(_setup_changed)
+def bench_add_all(ctx):
+    goob.add_all()
+
+@benchmark("commit", mutates=True)
+@with_setup(_setup_staged)
+def bench_commit(ctx):
+    goob.commit("benchmark")
+
+@benchmark("status (clean)")
+def bench_status_clean(ctx):
+    goob.status()
+
+@benchmark("status (changed files)", mutates=True)
+@with_setup(_setup_changed)
+def bench_status_changed(ctx):
+    goob.status()
+
+@benchmark("walk_tree")
+@with_setup(_setup_lookups)
+def bench_walk_tree(ctx):
+    goob.walk_tree(ctx["tree_hash"])
+
+@benchmark("lookup_in_tree (x100)")
+@with_setup(_setup_lookups)
+def bench_lookup_in_tree(ctx):
+    for filename in ctx["lookups"]:
+        goob.lookup_in_tree(filename, ctx["tree_hash"])
+
+@benchmark("log")
+def bench_log(ctx):
+    goob.log()
+
+@benchmark("checkout (first commit)", mutates=True)
+@with_setup(_setup_first_commit)
+def bench_checkout(ctx):
+    goob.checkout(ctx["first"])
+
+# RUNNING
+def run_benchmarks(repo_path, filenames, params, names=None, repeat=3):
+    """Runs the named benchmarks (default: all) 'repeat' times each against the repo
+        at 'repo_path'. Returns an OrderedDict of name -> results."""
+    results = OrderedDict()
+    for name in names or BENCHMARKS:
+        runs = [_run_in_child(name, repo_path, filenames, params) for _ in xrange(repeat)]
+        seconds = sorted(run["seconds"] for run in runs)
+        results[name] = OrderedDict([
+            ("best", seconds[0]),
+            ("median", seconds[len(seconds) // 2]),
+            ("seconds", [run["seconds"] for run in runs]),
+            ("peak_rss_kb", max(run["peak_rss_kb"] for run in runs)),
+        ])
+    return results
+
+def _run_in_child(name, repo_path, filenames, params):
+    queue = Queue()
+    child = Process(target=_child, args=(queue, name, repo_path, filenames, params))
+    child.start()
+    result = queue.get()
+    child.join()
+    if "error" in result:
+        raise RuntimeError("%s failed: %s" % (name, result["error"]))
+    return result
+
+def _child(queue, name, repo_path, filenames, params):
+    try:
+        queue.put(_run_one(name, repo_path, filenames, params))
+    except Exception as e:
+        queue.put({"error": "%s: %s" % (type(e).__name__, e)})
+
+def _run_one(name, repo_path, filenames, params):
+    setup, run, mutates = BENCHMARKS[name]
+    temp_dir = None
+    if mutates:
+        temp_dir = tempfile.mkdtemp(prefix="goob-bench-")
+        work_path = os.path.join(temp_dir, "repo")
+        shutil.copytree(repo_path, work_path, symlinks=True)
+    else:
+        work_path = repo_path
+    os.chdir(work_path)
+    # commands print their results; that's not what's being measured
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        if mutates:
+            goob.status() # copying changed every ctime, so refresh the stat cache
+        ctx = setup({"filenames": filenames, "params": params})
+        goob.object_cache.clear()
+        goob.delta_base_cache.clear()
+        goob.forget_packs()
+        start = time.time()
+        run(ctx)
+        seconds = time.time() - start
+    finally:
+        sys.stdout = sys.__stdout__
+        if temp_dir:
+            shutil.rmtree(temp_dir)
+    return {"seconds": seconds,
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+def compare_results(old, new, threshold=1.25):
+    """Compares two result dicts (as written by main). Returns a list of (name, old
+        best, new best, ratio, whether that's a regression) for the benchmarks in
+        both; a regression is 'threshold' times slower or worse."""
+    rows = []
+    for name, result in new["results"].iteritems():
+        if name not in old["results"]:
+            continue
+        old_best = old["results"][name]["best"]
+        ratio = result["best"] / old_best if old_best else float("inf")
+        rows.append((name, old_best, result["best"], ratio, ratio >= threshold))
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark goob's commands.")
+    for param, default in DEFAULTS.iteritems():
+        parser.add_argument("--" + param.replace("_", "-"), type=int, default=default)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", action="append", metavar="BENCHMARK",
+        help="run just this benchmark (may be given more than once)")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare against results in this JSON file")
+    parser.add_argument("--threshold", type=float, default=1.25,
+        help="slowdown ratio that counts as a regression")
+    parser.add_argument("--keep", action="store_true", help="don't delete the generated repo")
+    args = parser.parse_args(argv)
+
+    params = OrderedDict((param, getattr(args, param)) for param in DEFAULTS)
+    for name in args.only or []:
+        if name not in BENCHMARKS:
+            parser.error("no benchmark called %r (have: %s)" % (name, ", ".join(BENCHMARKS)))
+
+    temp_dir = tempfile.mkdtemp(prefix="goob-bench-")
+    repo_path = os.path.join(temp_dir, "repo")
+    try:
+        start = time.time()
+        filenames = make_repo(repo_path, **params)
+        print "Generated repo in %.2fs (%s)" % (time.time() - start,
+            ", ".join("%s=%s" % item for item in params.iteritems()))
+        results = run_benchmarks(repo_path, filenames, params, args.only, args.repeat)
+    finally:
+        if args.keep:
+            print "Repo kept at %s" % repo_path
+        else:
+            shutil.rmtree(temp_dir)
+
+    output = OrderedDict([("params", params), ("python", platform.python_version()),
+        ("platform", platform.platform()), ("time", time.time()), ("results", results)])
+    for name, result in results.iteritems():
+        print "%-28s best %8.4fs  median %8.4fs  peak %7d KB" % (name, result["best"],
+            result["median"], result["peak_rss_kb"])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        if old["params"] != params:
+            print "Warning: comparing runs with different params."
+        regressed = False
+        for name, old_best, new_best, ratio, regression in compare_results(old, output,
+                args.threshold):
+            print "%-28s %8.4fs -> %8.4fs  x%.2f%s" % (name, old_best, new_best, ratio,
+                "  REGRESSION" if regression else "")
+            regressed = regressed or regression
+        return 1 if regressed else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,9 +2,28 @@ import os
 import inspect
 import cPickle
 from hashlib import sha1
-from collections import defaultdict, namedtuple
+from collections import defaultdict, namedtuple, OrderedDict
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
 import re
 import time
+import zlib
+import mmap
+import struct
+import binascii
+import tempfile
+import sys
+import threading
+import heapq
+import bisect
+import json
+from functools import wraps
+import select
+import errno
+import ctypes
+import ctypes.util
+from io import BytesIO
+from contextlib import contextmanager
 from color import colors
 
 # GLOBAL PATH NAMES
@@ -13,11 +32,93 @@ OBJECTS_PATH = os.path.join(REPO_PATH, "objects")
 REFS_PATH = os.path.join(REPO_PATH, "refs")
 INDEX_PATH = os.path.join(REPO_PATH, "index")
 POINTER_PATH = os.path.join(REPO_PATH, "pointer")
+COMMIT_GRAPH_PATH = os.path.join(REPO_PATH, "commit-graph")
+PATH_FILTERS_PATH = os.path.join(REPO_PATH, "path-filters")
+BITMAPS_PATH = os.path.join(REPO_PATH, "bitmaps")
+FSMONITOR_PATH = os.path.join(REPO_PATH, "fsmonitor")
+FSMONITOR_WATCHER_PATH = os.path.join(FSMONITOR_PATH, "watcher")
+FSMONITOR_JOURNAL_PATH = os.path.join(FSMONITOR_PATH, "journal")
+FSMONITOR_STATE_PATH = os.path.join(FSMONITOR_PATH, "state")
+IGNORE_FILENAME = ".goobignore"
 BLOB_PATH = os.path.join(OBJECTS_PATH, "bl")
 TREE_PATH = os.path.join(OBJECTS_PATH, "tr")
 COMMIT_PATH = os.path.join(OBJECTS_PATH, "co")
+PACK_PATH = os.path.join(OBJECTS_PATH, "pack")
 PATHS = [REPO_PATH, OBJECTS_PATH, REFS_PATH, INDEX_PATH,
-    POINTER_PATH, BLOB_PATH, TREE_PATH, COMMIT_PATH]
+    POINTER_PATH, BLOB_PATH, TREE_PATH, COMMIT_PATH, PACK_PATH]
+LOOSE_PATHS = [BLOB_PATH, TREE_PATH, COMMIT_PATH]
+
+# OBJECT STORAGE
+# every object is stored as a short header line saying what it is, then its data.
+# Blobs are the raw (or zlib-compressed) file contents, so they can be written
+# and read back a chunk at a time. Trees and commits have a canonical binary
+# encoding (see encode_tree/encode_commit), and are named for the hash of it.
+# (Objects from before this were pickled; pickles never start with a NUL byte.)
+BLOB_RAW_MAGIC = "\x00goob-blob\n"
+BLOB_ZLIB_MAGIC = "\x00goob-zblob\n"
+BLOB_CHUNKED_MAGIC = "\x00goob-cblob\n" # then a CHUNK_ENTRY per chunk, in order
+TREE_MAGIC = "\x00goob-tree\n"
+COMMIT_MAGIC = "\x00goob-commit\n"
+TREE_ENTRY = struct.Struct(">c42sH") # type code, hash, name length (then the name)
+TREE_TYPE_CODES = {"blob": "b", "tree": "t"}
+TREE_TYPES = dict((code, obj_type) for obj_type, code in TREE_TYPE_CODES.iteritems())
+VALUE_HEADER = struct.Struct(">cI") # type code, length (then the value)
+BLOCK_SIZE = 64 * 1024
+COMPRESS_BLOBS = False
+FSYNC_OBJECTS = True # fsync new objects (once per command) before anything points at them
+
+# CHUNKING
+# a big file can be stored as a list of chunks, each a blob of its own, so a new
+# version of it only adds the chunks that changed. Chunk boundaries depend only on
+# the last 32 bytes before them, not on offsets, so an insert only moves the
+# boundaries near it. The file's blob hash is still the hash of its whole contents.
+# Finding boundaries runs at about a third of the speed of hashing (some 40 MB/s;
+# see find_chunk_boundary), on top of it, for every chunked file added.
+CHUNK_BLOBS = False # chunk files of CHUNK_THRESHOLD bytes or more
+CHUNK_THRESHOLD = 8 * 1024 * 1024
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+CHUNK_BITS = 20 # a boundary every 2**20 bytes (past the minimum), on average
+CHUNK_ENTRY = struct.Struct(">42sQ") # chunk's blob hash, length
+CHUNK_SCAN_BLOCK = 64 * 1024 # bytes find_chunk_boundary looks at in one go
+# each byte gets a flag bit: one bit of sha1(byte) xor another of sha1(previous byte)
+CHUNK_FLAG_TABLES = ["".join(str(ord(sha1(chr(i)).digest()[j]) >> j & 1) for i in xrange(256))
+    for j in xrange(2)]
+CHUNK_FLAG_PATTERN = "11100100" # candidate boundaries end with these flags
+CHUNK_FLAG_RE = re.compile(CHUNK_FLAG_PATTERN) # (it can't overlap itself)
+
+# PACKS
+# a pack is a single file holding many objects back to back; its .idx file is a
+# header followed by fixed-size (hash, offset, length) entries sorted by hash.
+PACK_MAGIC = "GOOBPACK"
+PACK_IDX_MAGIC = "GOOBPIDX"
+PACK_VERSION = 1
+PACK_HEADER = struct.Struct(">8sII") # magic, version, object count
+PACK_IDX_ENTRY = struct.Struct(">42sQQ") # hash, offset, length
+PACK_FULL = "F" # entry kinds: a whole stored object,
+PACK_DELTA = "D" # or the hash of a base object in the same pack + a delta against it
+
+# DELTAS
+# a delta is a list of ops: copy (offset, length) from the base, or insert some
+# new bytes. Matches are found by indexing the base in DELTA_BLOCK-sized blocks.
+DELTA_COPY = struct.Struct(">cII") # "c", offset, length
+DELTA_INSERT = struct.Struct(">cI") # "i", length (then that many bytes)
+DELTA_BLOCK = 16
+DELTA_WINDOW = 10 # how many similar objects to try as bases
+DELTA_MAX_DEPTH = 10 # longest chain of deltas read_hash may have to apply
+# bigger blobs aren't deltified: make_delta matches byte by byte in Python, at
+# about 1.5MB/s, and each blob is tried against up to DELTA_WINDOW bases
+DELTA_MAX_SIZE = 1024 * 1024
+DELTA_CACHE_BYTES = 16 * 1024 * 1024
+
+# decoded objects kept in memory by read_hash (trees, commits and small blobs)
+OBJECT_CACHE_BYTES = 32 * 1024 * 1024 # roughly: see _object_size
+OBJECT_CACHE_MAX_BLOB = 64 * 1024
+
+# GC
+GC_GRACE_PERIOD = 14 * 24 * 60 * 60 # unreachable objects younger than this are kept
+GC_RUN_SIZE = 100000 # hashes gc holds in memory before spilling a sorted run to disk
+GC_SEEN_SIZE = 100000 # trees and commits gc remembers having walked (others get rewalked)
 
 # ERRORS
 class GoobError(Exception): pass
@@ -27,19 +128,104 @@ class RepoExistsError(GoobError): pass
 class NoFileError(GoobError): pass
 class NoChangesError(GoobError): pass
 class BadHashError(GoobError): pass
+class BadIndexError(GoobError): pass
+class UncommittedChangesError(GoobError): pass
+class BadImportError(GoobError): pass
 
 ObjectHash = namedtuple("ObjectHash", ["hash", "type"])
+StatData = namedtuple("StatData", ["mtime", "ctime", "size", "inode"])
+LogEntry = namedtuple("LogEntry", ["hash", "tree_hash", "parent", "timestamp", "generation"])
+BlameLine = namedtuple("BlameLine", ["commit", "line"])
+FSCK_PROGRESS_EVERY = 1000 # objects between progress lines
+GCStats = namedtuple("GCStats", ["reachable", "removed", "kept"])
+ImportStats = namedtuple("ImportStats", ["head", "commits", "blobs"])
+FetchStats = namedtuple("FetchStats", ["head", "commits", "objects", "updated"])
+ImportBlob = namedtuple("ImportBlob", ["mark", "data"])
+
+class ImportCommit(namedtuple("ImportCommit", ["mark", "message", "changes", "author",
+        "timestamp", "parent"])):
+    """A commit for fast_import. 'changes' is a list of ("M", path, blob) to add or
+        modify a file, ("D", path) to delete one, or ("deleteall",); blobs and
+        'parent' are either hashes or ":<mark>"s. 'timestamp' is seconds since
+        the epoch (default: now); 'parent' defaults to the previous commit."""
+    def __new__(cls, mark, message, changes, author="ME!", timestamp=None, parent=None):
+        return super(ImportCommit, cls).__new__(cls, mark, message, changes, author,
+            timestamp, parent)
+
+# extra data kept in the index alongside filename -> hash
+INDEX_EXTENSIONS = ["stat", "tree"]
+
+# INDEX
+# the index is a header, a table of offsets to each entry, the entries themselves
+# (sorted by path: hash, stat data, then the path), any extensions (e.g. the
+# tree cache), and finally a SHA-1 of all of the above.
+INDEX_MAGIC = "GOOBINDX"
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct(">8sII") # magic, version, entry count
+INDEX_OFFSET = struct.Struct(">I")
+INDEX_ENTRY = struct.Struct(">42sddqQH") # hash, mtime, ctime, size, inode, path length
+INDEX_EXTENSION_HEADER = struct.Struct(">4sI") # signature, length
+INDEX_TREE_ENTRY = struct.Struct(">42sH") # tree hash, directory length
+NO_STAT = StatData(0, 0, -1, 0) # size -1: no stat data, always rehash
+
+# COMMIT GRAPH
+# a header and then one fixed-size record per commit, appended as commits are
+# made, so a commit's parent always comes before it. Parents are stored as the
+# position of their record; generation is 1 for a root commit, parent's + 1 after.
+COMMIT_GRAPH_MAGIC = "GOOBCGRF"
+COMMIT_GRAPH_VERSION = 1
+COMMIT_GRAPH_HEADER = struct.Struct(">8sI") # magic, version
+COMMIT_GRAPH_RECORD = struct.Struct(">42s42sIdI") # commit, tree, parent position, timestamp, generation
+NO_PARENT = 0xFFFFFFFF
+
+# PATH FILTERS
+# alongside the commit graph, optionally: a Bloom filter per commit of the paths it
+# changed (and the directories they're in), so path-limited history can skip most
+# commits without reading a single tree. One record per commit graph position;
+# each record names its commit, so a stale one (the graph was rebuilt) is ignored.
+PATH_FILTER_MAGIC = "GOOBPFLT"
+PATH_FILTER_VERSION = 1
+PATH_FILTER_HEADER = struct.Struct(">8sI") # magic, version
+PATH_FILTER_BITS = 512
+PATH_FILTER_HASHES = 7
+PATH_FILTER_MAX_PATHS = 64 # commits changing more get a filter that matches everything
+PATH_FILTER_RECORD = struct.Struct(">42s%ds" % (PATH_FILTER_BITS // 8)) # commit, filter
+
+# REACHABILITY BITMAPS
+# optionally: for some commits, a bitmap of every object reachable from them (bit i
+# is the i'th object in the file's object list). Objects are listed in the order
+# they first appear in history, oldest first, so new ones just go on the end and
+# the bitmaps already written stay valid.
+BITMAP_MAGIC = "GOOBBMAP"
+BITMAP_VERSION = 1
+BITMAP_HEADER = struct.Struct(">8sIII") # magic, version, object count, bitmap count
+BITMAP_RECORD = struct.Struct(">42sI") # commit, length (then the zlib'd bitmap)
+BITMAP_INTERVAL = 100 # generations between stored bitmaps (HEAD always gets one)
+
+class TreeChange(namedtuple("TreeChange", ["path", "old_hash", "new_hash"])):
+    """A file that differs between two trees (hash is None where it's missing)."""
+    @property
+    def kind(self):
+        if self.old_hash is None:
+            return "added"
+        elif self.new_hash is None:
+            return "removed"
+        return "modified"
 
 ## DECORATORS
 def requires_repo(func):
+    @wraps(func)
     def checked_func(*args, **kwargs):
         if os.path.exists(REPO_PATH):
-            return func(*args, **kwargs)
+            # one ObjectWriter per command (nested commands share it)
+            with object_writer(), trace_command(func.__name__):
+                return func(*args, **kwargs)
         else:
             raise NoRepoError("Not a goob repo.")
     return checked_func
 
 def requires_extant_file(func):
+    @wraps(func)
     def checked_func(filename, *args, **kwargs):
         if os.path.exists(filename):
             return func(filename, *args, **kwargs)
@@ -47,6 +233,37 @@ def requires_extant_file(func):
             raise NoFileError("File does not exist.")
     return checked_func
 
+def requires_extant_files(func):
+    @wraps(func)
+    def checked_func(*filenames, **kwargs):
+        for filename in filenames:
+            if not os.path.exists(filename):
+                raise NoFileError("File does not exist: %s" % filename)
+        return func(*filenames, **kwargs)
+    return checked_func
+
+def traced(size=None):
+    """Records calls to the decorated function while tracing is on (see Tracer).
+        'size', if given, is called with the function's result and its args to
+        count bytes."""
+    def decorate(func):
+        name = func.__name__
+        @wraps(func)
+        def traced_func(*args, **kwargs):
+            tracer = _tracer
+            if tracer is None:
+                return func(*args, **kwargs)
+            start = time.time()
+            result = None
+            try:
+                result = func(*args, **kwargs)
+                return result
+            finally:
+                tracer.record(name, start, time.time() - start,
+                    size(result, args) if size and result is not None else 0)
+        return traced_func
+    return decorate
+
 ## USER COMMANDS
 def init():
     """Makes a new .goob directory in the current directory, populates
@@ -61,31 +278,119 @@ def init():
         os.mkdir(BLOB_PATH)
         os.mkdir(TREE_PATH)
         os.mkdir(COMMIT_PATH)
+        os.mkdir(PACK_PATH)
         open(INDEX_PATH, "a").close()
         open(POINTER_PATH, "a").close()
+        # different repo, different objects
+        object_cache.clear()
+        delta_base_cache.clear()
 
 @requires_repo
-@requires_extant_file
-def add(filename):
-    """Stages the given file for commit."""
-
-    # TODO: Add("-a") will add all files in the directory (except those in .goobignore)"""
+@requires_extant_files
+def add(*filenames, **kwargs):
+    """Stages the given file(s) for commit. Takes the same keyword args as
+        add_files."""
 
-    index_data = read_index()
+    report = add_files(filenames, **kwargs)
+    if not report.added:
+        raise NoChangesError("This file hasn't changed. Nothing added.")
+    return report
 
-    # index format: dict where index[filename] = hashhashash
+@requires_repo
+def add_all(path=".", **kwargs):
+    """Stages every file under the given directory (except those in .goobignore)
+        for commit. Takes the same keyword args as add_files."""
+
+    report = AddReport()
+    with object_writer() as writer:
+        writer.use_listings()
+    with report.timer("walk"):
+        top = os.path.normpath(path)
+        filenames = list(iter_working_files("" if top == "." else top))
+    add_files(filenames, report=report, **kwargs)
+    if not report.added:
+        raise NoChangesError("Nothing has changed. Nothing added.")
+    return report
+
+class AddReport(object):
+    """What a (bulk) add did, plus how long each phase of it took."""
+    def __init__(self):
+        self.added = []
+        self.unchanged = []
+        self.timings = OrderedDict() # phase name -> seconds
+
+    @contextmanager
+    def timer(self, phase):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[phase] = self.timings.get(phase, 0) + time.time() - start
 
-    with open(filename) as f:
-        contents = f.read()
-    hash = make_hash(contents, 'blob')
+    def __str__(self):
+        results = ["Added %d file(s), %d unchanged." % (len(self.added), len(self.unchanged))]
+        results.extend([("\t%s: %.3fs" % (phase, secs)) for phase, secs in self.timings.iteritems()])
+        return "\n".join(results)
 
-    if filename in index_data and index_data[filename] == hash:
-        raise NoChangesError("This file hasn't changed. Nothing added.")
-    else:
-        save_hash(contents, hash)
-        index_data[filename] = hash
+def add_files(filenames, workers=None, processes=False, compress=None, report=None,
+    verbose=False):
+    """Hashes and saves the given files on a pool of 'workers' threads (or processes,
+        if 'processes') and updates the index with a single write. Returns an AddReport.
+        Files whose stat data matches the index aren't even read. If 'compress',
+        blobs are zlib-compressed on disk (defaults to COMPRESS_BLOBS)."""
+
+    if report is None:
+        report = AddReport()
+
+    with report.timer("read index"):
+        index_data, extensions = read_index_ext()
+        stat_cache = extensions["stat"]
+
+    # cheap pass first: anything whose stat data is unchanged can be skipped
+    with report.timer("stat"):
+        to_hash = []
+        for filename in filenames:
+            if filename in index_data and stat_cache.get(filename) == get_stat_data(filename):
+                report.unchanged.append(filename)
+            else:
+                to_hash.append((filename, compress))
+
+    with report.timer("hash"):
+        if len(to_hash) > 1:
+            pool = (Pool if processes else ThreadPool)(workers or cpu_count())
+            try:
+                results = pool.map(_hash_and_save_file, to_hash, chunksize=16)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(_hash_and_save_file, to_hash)
 
-    write_index(index_data)
+    for filename, stat, hash in results:
+        stat_cache[filename] = stat
+        if index_data.get(filename) == hash:
+            report.unchanged.append(filename)
+        else:
+            index_data[filename] = hash
+            invalidate_tree_cache(extensions["tree"], filename)
+            report.added.append(filename)
+
+    # stat data may have been refreshed even if nothing was added
+    if results:
+        with report.timer("write index"):
+            write_index(index_data, extensions)
+
+    if verbose:
+        print report
+    return report
+
+def _hash_and_save_file(args):
+    """Worker for add_files: streams the file into a blob (unless that blob already
+        exists). Returns (filename, stat data, hash)."""
+    filename, compress = args
+    # stat before reading, so a write that lands mid-read shows up next time
+    stat = get_stat_data(filename)
+    return filename, stat, save_file_blob(filename, compress)
 
 @requires_repo
 @requires_extant_file
@@ -93,13 +398,15 @@ def rm(filename, cached=False):
     """If not 'cached': removes file from index and deletes the file. If 'cached':
         removes file from index but does not delete the file."""
 
-    index_data = read_index()
+    index_data, extensions = read_index_ext()
     try:
         del index_data[filename]
     except KeyError:
         raise NoFileError("%s isn't staged" % filename)
     else:
-        write_index(index_data)
+        extensions["stat"].pop(filename, None)
+        invalidate_tree_cache(extensions["tree"], filename)
+        write_index(index_data, extensions)
         if not cached:
             os.remove(filename)
 
@@ -113,13 +420,13 @@ def commit(message):
     make_commit(message)
 
 class Status(object):
-    def __init__(self, new=[], modified_added=[], removed=[], modified_not_added=[], untracked=[], deleted=[]):
-        self.new = new
-        self.modified_added = modified_added
-        self.removed = removed
-        self.modified_not_added = modified_not_added
-        self.untracked = untracked
-        self.deleted = deleted
+    def __init__(self, new=None, modified_added=None, removed=None, modified_not_added=None, untracked=None, deleted=None):
+        self.new = new or []
+        self.modified_added = modified_added or []
+        self.removed = removed or []
+        self.modified_not_added = modified_not_added or []
+        self.untracked = untracked or []
+        self.deleted = deleted or []
 
     def __str__(self):
         results = []
@@ -140,10 +447,13 @@ class Status(object):
             for attr, val in vars(self).iteritems():
                 if set(val) != set(other.__getattribute__(attr)):
                     return False
-                return True
+            return True
         else:
             return False
 
+    def __ne__(self, other):
+        return not self == other
+
 @requires_repo
 def status():
     """Displays untracked files, modified files, unmodified files."""
@@ -156,65 +466,671 @@ def status():
         # untracked = file in dir not in index (or goobignore)
         # deleted = file in the index not in the directory
             # ^^^ need to change how 'add' deals with this^^^
-    new, modified_added, removed, modified_not_added, untracked, deleted = [], [],[],[],[],[]
-
-    # TODO: work in GOOBIGNORE
-    cur_status = Status()
-
-    all_files = [os.path.join(root, file)[2:] for root, dirs, files in os.walk(".") \
-        for file in files if not ".goob" in root]
-
-    index_data = read_index()
+    # If a watcher (see watch()) is running and nothing else has changed since the
+    # last status, only the paths it saw change get looked at again. Otherwise
+    # it's a full scan.
 
+    index_data, extensions = read_index_ext()
+    stat_cache = extensions["stat"]
+    head = get_cur_head()
     try:
-        cur_commit = read_hash(get_cur_head())
+        tree_hash = read_hash(head).tree_hash
     except BadHashError:
-        cur_commit = None
+        tree_hash = None # nothing committed yet
+
+    # (where the journal's at *before* we look at anything, so nothing's missed)
+    token = fsmonitor_token()
+    result = None
+    if token:
+        result = _fsmonitor_status(index_data, stat_cache, head, tree_hash, token)
+    if result is None:
+        result = _full_status(index_data, stat_cache, tree_hash)
+    cur_status, refreshed = result
+
+    if refreshed:
+        write_index(index_data, extensions)
+    if token:
+        save_fsmonitor_state(token, head, cur_status)
 
-    for filename in all_files: # for every file in directory
-        if filename not in index_data: # if not in index:
-            if lookup_in_tree(filename, cur_commit.tree_hash): # if in last commit:
-                cur_status.removed.append(filename)
+    print cur_status
+    return cur_status
+
+def _full_status(index_data, stat_cache, tree_hash):
+    """Works out the status in one pass: the working directory, the index and the
+        current commit's tree are each streamed in sorted path order and merged,
+        so every file is looked at once, with all three of its states side by
+        side. Returns (Status, whether stat_cache was refreshed)."""
+    cur_status = Status()
+    refreshed = False
+
+    head_files = iter_tree(tree_hash) if tree_hash else iter([])
+    disk_files = ((filename, True) for filename in iter_working_files())
+    for filename, (on_disk, index_hash, head_hash) in merge_sorted(disk_files,
+            sorted(index_data.iteritems()), head_files):
+        if not on_disk:
+            # tracked files still count even if .goobignore hid them from the walk
+            on_disk = os.path.isfile(filename)
+        category, stat_refreshed = classify_file(filename, on_disk, index_hash,
+            head_hash, stat_cache)
+        if category:
+            getattr(cur_status, category).append(filename)
+        refreshed = refreshed or stat_refreshed
+
+    return cur_status, refreshed
+
+def _fsmonitor_status(index_data, stat_cache, head, tree_hash, token):
+    """Works out the status by starting from the last one and rechecking only the
+        paths the watcher has seen change since. Returns (Status, whether
+        stat_cache was refreshed), or None if that can't be trusted (the index,
+        HEAD or .goobignore changed, or the watcher was restarted)."""
+    state = load_fsmonitor_state()
+    if state is None:
+        return None
+    old_token, old_head, old_index, cur_status = state
+    if old_head != head or old_index != index_checksum() or old_token[0] != token[0]:
+        return None
+    changed = read_fsmonitor_journal(old_token[1], token[1])
+    if any(os.path.basename(path) == IGNORE_FILENAME for path in changed):
+        return None
+
+    # a changed directory means anything we knew of under it may have changed
+    candidates = set(changed)
+    known = set(index_data)
+    for category in vars(cur_status).itervalues():
+        known.update(category)
+    sorted_known = None
+    for path in changed:
+        if os.path.isdir(path):
+            candidates.update(iter_working_files(path))
+        elif path in known:
+            continue # a file then and now: nothing under it
+        # (it may have been a directory: look for what we knew under it)
+        if sorted_known is None:
+            sorted_known = sorted(known)
+        prefix = path + os.sep
+        i = bisect.bisect_left(sorted_known, prefix)
+        while i < len(sorted_known) and sorted_known[i].startswith(prefix):
+            candidates.add(sorted_known[i])
+            i += 1
+
+    for attr, filenames in vars(cur_status).items():
+        setattr(cur_status, attr, [filename for filename in filenames
+            if filename not in candidates])
+    refreshed = False
+    for filename in sorted(candidates):
+        on_disk = os.path.isfile(filename)
+        index_hash = index_data.get(filename)
+        # (a file may have become a directory or vice versa)
+        head_hash = lookup_path(tree_hash, filename)
+        if head_hash and not head_hash.startswith("bl"):
+            head_hash = None
+        if not (on_disk or index_hash or head_hash):
+            continue
+        if index_hash is None and head_hash is None and is_path_ignored(filename):
+            continue
+        category, stat_refreshed = classify_file(filename, on_disk, index_hash,
+            head_hash, stat_cache)
+        if category:
+            getattr(cur_status, category).append(filename)
+        refreshed = refreshed or stat_refreshed
+    return cur_status, refreshed
+
+def classify_file(filename, on_disk, index_hash, head_hash, stat_cache):
+    """Works out which Status list (if any) a file belongs in, given whether it's on
+        disk and its hashes in the index and current commit (None if not there).
+        Returns (name of the Status list or None, whether stat_cache was refreshed)."""
+    if on_disk:
+        if index_hash is None: # if not in index:
+            if head_hash: # if in last commit:
+                return "removed", False
+            return "untracked", False
+        if not head_hash:
+            return "new", False
+        file_hash, refreshed = get_cached_hash(filename, index_hash, stat_cache)
+        if file_hash != index_hash: # if hash of file diff from its hash in index
+            return "modified_not_added", refreshed
+        if file_hash != head_hash: # if hash of file (= hash in index) diff from hash in commit:
+            return "modified_added", refreshed
+        return None, refreshed # unchanged -- no action
+    if head_hash:
+        if index_hash:
+            return "deleted", False # uncommited delete (deleted)
+        return "removed", False # committed delete (removed)
+    return None, False
+
+def get_cached_hash(filename, index_hash, stat_cache):
+    """Returns (hash of the file, whether stat_cache was refreshed). The file is only
+        rehashed if its stat data doesn't match stat_cache."""
+    stat = get_stat_data(filename)
+    if stat_cache.get(filename) == stat:
+        return index_hash, False
+    file_hash = get_hash_of_file_contents(filename)
+    if file_hash == index_hash:
+        # file is unchanged, only its stat data is stale: refresh it
+        # so the next status doesn't have to rehash it
+        stat_cache[filename] = stat
+        return file_hash, True
+    return file_hash, False
+
+def merge_sorted(*streams):
+    """Merges streams of (path, value) pairs, each sorted by path, yielding
+        (path, (value from each stream, or None where a stream doesn't have it))
+        in path order."""
+    streams = [iter(stream) for stream in streams]
+    heads = [next(stream, None) for stream in streams]
+    while any(heads):
+        path = min(head[0] for head in heads if head)
+        values = []
+        for i, head in enumerate(heads):
+            if head and head[0] == path:
+                values.append(head[1])
+                heads[i] = next(streams[i], None)
             else:
-                cur_status.untracked.append(filename)
+                values.append(None)
+        yield path, tuple(values)
+
+def _sort_key(name, is_dir):
+    # sorting directories as "name/" puts entries in the same order as sorting the
+    # full paths they lead to (e.g. "a.txt" < "a/b", since "." < "/")
+    return name + "/" if is_dir else name
+
+def iter_working_files(top="", ignore_rules=None):
+    """Yields the path of every file under top (besides .goob and anything ignored
+        by .goobignore files), in sorted order. Ignored directories aren't
+        descended into at all."""
+    if ignore_rules is None:
+        ignore_rules = IgnoreRules.for_dir(top)
+    with trace("listdir"):
+        names = os.listdir(top or ".")
+    if IGNORE_FILENAME in names:
+        ignore_rules = ignore_rules.with_file(top)
+
+    entries = []
+    for name in names:
+        path = os.path.join(top, name)
+        is_dir = os.path.isdir(path)
+        if is_dir and (name == ".goob" or os.path.islink(path)):
+            continue
+        if not ignore_rules.is_ignored(path, is_dir):
+            entries.append((_sort_key(name, is_dir), path, is_dir))
+    for _, path, is_dir in sorted(entries):
+        if is_dir:
+            for filename in iter_working_files(path, ignore_rules):
+                yield filename
         else:
-            hash_in_commit = lookup_in_tree(filename, cur_commit.tree_hash)
-            file_hash = get_hash_of_file_contents(filename)
-            if hash_in_commit: # if in previous commit:
-                if file_hash != index_data[filename]: # if hash of file diff from its hash in index
-                    cur_status.modified_not_added.append(filename)
-                elif file_hash != hash_in_commit: # if hash of file (= hash in index) diff from hash in commit:
-                    cur_status.modified_added.append(filename)
+            yield path
+
+def is_path_ignored(path):
+    """True if .goobignore rules ignore the given file, or any directory it's in."""
+    parts = path.split(os.sep)
+    rules = IgnoreRules()
+    for i in xrange(len(parts)):
+        dir = os.path.join(*parts[:i]) if i else ""
+        if os.path.exists(os.path.join(dir, IGNORE_FILENAME)):
+            rules = rules.with_file(dir)
+        if rules.is_ignored(os.path.join(*parts[:i + 1]), i + 1 < len(parts)):
+            return True
+    return False
+
+class IgnoreRules(object):
+    """Compiled .goobignore patterns, gitignore-style: '#' comments, '!' to
+        un-ignore, a trailing '/' to only match directories, '*', '?', '[...]'
+        and '**' wildcards. A pattern with a '/' in it is matched against the
+        path relative to its .goobignore's directory, otherwise against the
+        file's name. Later patterns (and those in deeper directories) win."""
+    def __init__(self, rules=()):
+        self.rules = list(rules) # (base dir, regex, negated, dir only, anchored)
+
+    @classmethod
+    def for_dir(cls, dir):
+        """The rules in effect in 'dir': those from .goobignore files in it and all
+            of its parents, up to the repo root."""
+        rules = cls()
+        parts = dir.split(os.sep) if dir else []
+        for i in xrange(len(parts)):
+            parent = os.path.join(*parts[:i]) if i else ""
+            if os.path.exists(os.path.join(parent, IGNORE_FILENAME)):
+                rules = rules.with_file(parent)
+        return rules
+
+    def with_file(self, dir):
+        """Returns new rules with the patterns from dir's .goobignore added."""
+        new_rules = list(self.rules)
+        with open(os.path.join(dir, IGNORE_FILENAME)) as f:
+            for line in f:
+                rule = compile_ignore_pattern(line)
+                if rule:
+                    new_rules.append((dir,) + rule)
+        return IgnoreRules(new_rules)
+
+    def is_ignored(self, path, is_dir=False):
+        ignored = False
+        name = os.path.basename(path)
+        for base, regex, negated, dir_only, anchored in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if anchored:
+                if base:
+                    if not path.startswith(base + os.sep):
+                        continue
+                    target = path[len(base) + 1:]
                 else:
-                    # unchanged -- no action
-                    pass
+                    target = path
             else:
-                cur_status.new.append(filename)
+                target = name
+            if regex.match(target):
+                ignored = not negated
+        return ignored
+
+def compile_ignore_pattern(line):
+    """Turns a .goobignore line into (regex, negated, dir only, anchored), or None
+        if it's blank or a comment."""
+    line = line.rstrip("\n")
+    pattern = line.rstrip()
+    if pattern.endswith("\\") and len(pattern) < len(line):
+        pattern += " " # an escaped trailing space is kept
+    if not pattern or pattern.startswith("#"):
+        return None
+    negated = pattern.startswith("!")
+    if negated:
+        pattern = pattern[1:]
+    dir_only = pattern.endswith("/")
+    pattern = pattern.rstrip("/")
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+
+    regex = []
+    i = 0
+    while i < len(pattern):
+        if pattern[i] == "\\" and i + 1 < len(pattern):
+            # escaped, so taken literally (e.g. "\#file", "\!name", "\*")
+            regex.append(re.escape(pattern[i + 1]))
+            i += 2
+        elif pattern.startswith("**/", i):
+            regex.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("/**", i) and i + 3 == len(pattern):
+            regex.append("/.*")
+            i += 3
+        elif pattern.startswith("**", i):
+            regex.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            regex.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            regex.append("[^/]")
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 2:]:
+            end = pattern.index("]", i + 2)
+            char_class = pattern[i + 1:end]
+            if char_class.startswith("!"):
+                char_class = "^" + char_class[1:]
+            regex.append("[%s]" % char_class)
+            i = end + 1
+        else:
+            regex.append(re.escape(pattern[i]))
+            i += 1
+    return re.compile("".join(regex) + r"\Z"), negated, dir_only, anchored
+
+def iter_tree(tree_hash, prefix=""):
+    """Yields (path, blob hash) for every file in the given tree and its subtrees,
+        in sorted path order."""
+    entries = sorted(read_hash(tree_hash).iteritems(),
+        key=lambda entry: _sort_key(entry[0], entry[1].type == "tree"))
+    for name, (hash, obj_type) in entries:
+        path = os.path.join(prefix, name)
+        if obj_type == "tree":
+            for entry in iter_tree(hash, path):
+                yield entry
+        else:
+            yield path, hash
 
-    files_in_cur_commit = walk_tree(cur_commit.tree_hash)
-    for filename in set(files_in_cur_commit).difference(set(all_files)):
-        if filename in index_data:
-            cur_status.deleted.append(filename) # uncommited delete (deleted)
+@requires_repo
+def log(limit=None, offset=0, since=None, path=None):
+    """Displays a list of past commits, newest first: at most 'limit' of them,
+        skipping the first 'offset', and only those made at or after 'since' (a
+        Unix timestamp), and that changed 'path' (a file or directory), if given.
+        Returns them as LogEntry's. Which commits to show comes from the commit
+        graph; only the commits shown are read."""
+
+    entries = list_commits(limit, offset, since, path)
+    for entry in entries:
+        cur_commit = read_hash(entry.hash)
+        print colors.YELLOW + "commit %s" % entry.hash + colors.ENDC
+        print "Author: %s" % cur_commit.author
+        print "Date:   %s" % cur_commit.timestamp
+        print "\n    %s\n" % cur_commit.msg
+    return entries
+
+def list_commits(limit=None, offset=0, since=None, path=None):
+    """Returns LogEntry's for the commits in the current history (see log), newest
+        first, using only the commit graph (and, given a path, path filters and
+        as few trees as it takes -- see iter_path_history)."""
+    graph = CommitGraph.for_head()
+    results = []
+    if path is not None:
+        entries = iter_path_history(path, get_cur_head(), graph)
+    else:
+        entries = graph.walk(get_cur_head())
+    for entry in entries:
+        if since is not None and entry.timestamp < since:
+            continue
+        if offset:
+            offset -= 1
+            continue
+        if limit is not None and len(results) >= limit:
+            break
+        results.append(entry)
+    return results
+
+def iter_path_history(path, commit_hash, graph):
+    """Yields LogEntry's for the commits, from 'commit_hash' back, that changed the
+        file or directory at 'path': those where it differs from the parent.
+        Commits whose path filter rules the path out are skipped unread;
+        otherwise the two trees are compared a path component at a time, which
+        stops as soon as the subtrees holding the path are the same."""
+    path = os.path.normpath(path)
+    parts = path.split(os.sep)
+    filters = PathFilters.load()
+    for entry in graph.walk(commit_hash):
+        path_filter = filters.get(graph.positions[entry.hash], entry.hash)
+        if path_filter is not None and not PathFilters.might_contain(path_filter, path):
+            continue
+        parent = graph.get(entry.parent) if entry.parent else None
+        if _path_changed(parent.tree_hash if parent else None, entry.tree_hash, parts):
+            yield entry
+
+def _path_changed(old_hash, new_hash, parts):
+    """True if the entry at the path (given as a list of components) differs between
+        the two trees."""
+    for name in parts:
+        if old_hash == new_hash:
+            return False
+        old_hash, new_hash = _tree_child(old_hash, name), _tree_child(new_hash, name)
+    return old_hash != new_hash
+
+def _tree_child(tree_hash, name):
+    """Returns the hash of the named entry in the given tree, or None if there's no
+        such entry (or 'tree_hash' is None or a blob)."""
+    if not tree_hash or not tree_hash.startswith("tr"):
+        return None
+    entry = read_hash(tree_hash).get(name)
+    return entry.hash if entry else None
+
+def lookup_path(tree_hash, path):
+    """Returns the hash of the file or directory at 'path' in the given tree, or None."""
+    for name in os.path.normpath(path).split(os.sep):
+        tree_hash = _tree_child(tree_hash, name)
+    return tree_hash
+
+@requires_repo
+def write_path_filters():
+    """Writes (or brings up to date) the path filters that let log(path=...) and
+        blame skip commits that didn't touch a path. Once written, each commit
+        keeps them up to date. Returns how many commits were added."""
+    return update_path_filters(CommitGraph.for_head())
+
+def update_path_filters(graph):
+    """Adds a path filter for every commit in the graph that doesn't have one yet
+        (see PathFilters). Returns how many were added."""
+    filters = PathFilters.load()
+    # records past the first one that doesn't match the graph are stale
+    valid = 0
+    while valid < min(len(filters.records), len(graph)) and \
+            filters.records[valid][0] == graph.records[valid][0]:
+        valid += 1
+
+    new_records = []
+    for i in xrange(valid, len(graph)):
+        entry = graph._entry(i)
+        parent = graph.get(entry.parent) if entry.parent else None
+        paths = set()
+        for change in diff_trees(parent.tree_hash if parent else None, entry.tree_hash):
+            path = change.path
+            while path and path not in paths:
+                paths.add(path)
+                path = os.path.dirname(path)
+            if len(paths) > PATH_FILTER_MAX_PATHS:
+                break
+        new_records.append(PATH_FILTER_RECORD.pack(entry.hash, PathFilters.make(paths)))
+
+    if valid == len(filters.records) and os.path.exists(PATH_FILTERS_PATH):
+        if new_records:
+            with open(PATH_FILTERS_PATH, 'ab') as f:
+                f.write("".join(new_records))
+    else:
+        fd, temp_path = tempfile.mkstemp(dir=REPO_PATH, prefix="path-filters-")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(PATH_FILTER_HEADER.pack(PATH_FILTER_MAGIC, PATH_FILTER_VERSION))
+            f.write("".join(PATH_FILTER_RECORD.pack(*record) for record in filters.records[:valid]))
+            f.write("".join(new_records))
+        os.rename(temp_path, PATH_FILTERS_PATH)
+    return len(new_records)
+
+@requires_repo
+def blame(path, commit_hash=None):
+    """Displays, for each line of the file at 'path' (as of 'commit_hash', default
+        HEAD), the commit that last changed it. Works back through the commits
+        that changed the file (see iter_path_history), diffing each version
+        against the one before and passing the lines that weren't changed on
+        to it, until every line has been accounted for. Returns a BlameLine per
+        line."""
+    commit_hash = commit_hash or get_cur_head()
+    graph = CommitGraph.for_head()
+    graph.add(commit_hash)
+    entry = graph.get(commit_hash)
+    blob_hash = lookup_path(entry.tree_hash, path) if entry else None
+    if not blob_hash or not blob_hash.startswith("bl"):
+        raise NoFileError("%s isn't a file in that commit." % path)
+
+    lines = read_hash(blob_hash).splitlines()
+    blamed = [None] * len(lines)
+    pending = dict((i, i) for i in xrange(len(lines))) # line in cur_lines -> line in file
+    cur_lines = lines
+    for entry in iter_path_history(path, commit_hash, graph):
+        parent = graph.get(entry.parent) if entry.parent else None
+        parent_hash = lookup_path(parent.tree_hash, path) if parent else None
+        if parent_hash and parent_hash.startswith("bl"):
+            parent_lines = read_hash(parent_hash).splitlines()
         else:
-            cur_status.removed.append(filename) # committed delete (removed)
+            parent_lines = []
+        # lines this commit added are its; the rest came from the parent's version
+        still_pending = {}
+        old_line = new_line = 0
+        for op, line in diff_lines(parent_lines, cur_lines):
+            if op == "=":
+                if new_line in pending:
+                    still_pending[old_line] = pending[new_line]
+                old_line, new_line = old_line + 1, new_line + 1
+            elif op == "+":
+                if new_line in pending:
+                    blamed[pending[new_line]] = entry.hash
+                new_line += 1
+            else:
+                old_line += 1
+        pending, cur_lines = still_pending, parent_lines
+        if not pending:
+            break
+
+    results = [BlameLine(commit, line) for commit, line in zip(blamed, lines)]
+    authors = {}
+    for number, (commit, line) in enumerate(results, 1):
+        if commit not in authors:
+            authors[commit] = read_hash(commit).author if commit else "?"
+        print "%s (%s %4d) %s" % ((commit or "?")[:12], authors[commit], number, line)
+    return results
 
-    print cur_status
-    return cur_status
+@requires_repo
+def count_commits(since=None):
+    """Returns how many commits there are in the current history (made at or after
+        'since', if given), using only the commit graph."""
+    graph = CommitGraph.for_head()
+    if since is None:
+        head = graph.get(get_cur_head())
+        return head.generation if head else 0
+    return sum(1 for entry in graph.walk(get_cur_head()) if entry.timestamp >= since)
+
+@requires_repo
+def write_bitmaps(interval=BITMAP_INTERVAL):
+    """Writes (or brings up to date) the reachability bitmaps (see Bitmaps) for the
+        current history: one for every 'interval'th generation, and one for
+        HEAD. Returns how many bitmaps were added."""
+    graph = CommitGraph.for_head()
+    bitmaps = Bitmaps.load()
+    head = get_cur_head()
+    added = 0
+    for entry in reversed(list(bitmaps.walk_new(head, graph))):
+        if entry.generation % interval == 0 or entry.hash == head:
+            bitmaps.add(entry.hash, bitmaps.reachable(entry.hash, graph))
+            added += 1
+    bitmaps.write()
+    return added
+
+@requires_repo
+def count_objects(commit_hash=None):
+    """Returns how many objects (commits, trees and blobs) are reachable from
+        'commit_hash' (default: HEAD)."""
+    commit_hash = commit_hash or get_cur_head()
+    if not commit_hash:
+        return 0
+    return Bitmaps.count(Bitmaps.load().reachable(commit_hash))
 
 @requires_repo
-def log():
-    """Displays a list of past commits."""
-    pass
+def reachable_objects(commit_hash=None, exclude=None):
+    """Returns the sorted hashes of the objects reachable from 'commit_hash'
+        (default: HEAD) but not from commit 'exclude', if given."""
+    commit_hash = commit_hash or get_cur_head()
+    if not commit_hash:
+        return []
+    bitmaps = Bitmaps.load()
+    bits = bitmaps.reachable(commit_hash)
+    if exclude:
+        bits &= ~bitmaps.reachable(exclude)
+    return sorted(bitmaps.hashes_of(bits))
 
 @requires_repo
-def checkout(commit_hash):
-    """Restores filesystem to state represented by given commit."""
+def checkout(commit_hash, workers=None):
+    """Restores filesystem to state represented by given commit. Only files that
+        differ between the current commit and the given one are touched (found
+        with diff_trees, which skips identical subtrees); they're written on a
+        pool of 'workers' threads. Returns the list of TreeChange's made."""
     # currently only works for full commit hash
-    cur_status = status()
-    # if any files in status are files in the previous commit, don't let user checkout
-    # if modified files, ask you to add those changes first.
-    # (if dir is goob repo, if commit exists)
-    pass
+    target_commit = read_hash(commit_hash)
+    if not isinstance(target_commit, Commit):
+        raise BadHashError("%s isn't a commit." % commit_hash)
+    head = get_cur_head()
+    cur_tree = read_hash(head).tree_hash if head else None
+
+    index_data, extensions = read_index_ext()
+    stat_cache, tree_cache = extensions["stat"], extensions["tree"]
+
+    # if anything's staged, or modified files would be overwritten, don't let user
+    # checkout -- ask them to commit those changes first.
+    if tree_cache.get("") != cur_tree and index_data != dict(iter_tree(cur_tree) if cur_tree else []):
+        raise UncommittedChangesError("There are staged changes. Commit them first.")
+    changes = list(diff_trees(cur_tree, target_commit.tree_hash))
+    in_the_way = []
+    for path, old_hash, new_hash in changes:
+        if not os.path.isfile(path):
+            continue
+        if old_hash:
+            file_hash, _ = get_cached_hash(path, old_hash, stat_cache)
+            if file_hash != old_hash: # modified since the last commit
+                in_the_way.append(path)
+        elif get_hash_of_file_contents(path) != new_hash: # untracked
+            in_the_way.append(path)
+    # nor anything else where a file has to go: a directory that won't be empty
+    # once the files we're removing are gone, or a file where a directory has to be
+    removed = set(path for path, old_hash, new_hash in changes if new_hash is None)
+    for path, old_hash, new_hash in changes:
+        if new_hash is None:
+            continue
+        if os.path.isdir(path) and any((not filenames and not dirnames) or
+                any(os.path.join(dir, filename) not in removed for filename in filenames)
+                for dir, dirnames, filenames in os.walk(path)):
+            in_the_way.append(path)
+        dir = os.path.dirname(path)
+        while dir:
+            if os.path.lexists(dir) and not os.path.isdir(dir) and dir not in removed:
+                in_the_way.append(dir)
+                break
+            dir = os.path.dirname(dir)
+    if in_the_way:
+        raise UncommittedChangesError("These files would be overwritten:\n\t" +
+            "\n\t".join(sorted(set(in_the_way))))
+
+    for path, old_hash, new_hash in changes:
+        if new_hash is None:
+            if os.path.exists(path):
+                os.remove(path)
+                remove_empty_dirs(os.path.dirname(path))
+            del index_data[path]
+            stat_cache.pop(path, None)
+        invalidate_tree_cache(tree_cache, path)
+
+    mode = 0666 & ~_umask()
+    to_write = [(path, new_hash, mode) for path, old_hash, new_hash in changes if new_hash]
+    if len(to_write) > 1:
+        pool = ThreadPool(workers or cpu_count())
+        try:
+            results = pool.map(_checkout_file, to_write, chunksize=16)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(_checkout_file, to_write)
+    for (path, new_hash, mode), stat in zip(to_write, results):
+        index_data[path] = new_hash
+        stat_cache[path] = stat
+    # the index now matches the target, so the trees diff_trees just read can go
+    # back in the cache (and the next checkout needn't compare the whole index)
+    dirs = set([""])
+    for path, old_hash, new_hash in changes:
+        dir = os.path.dirname(path)
+        while dir and dir not in dirs:
+            dirs.add(dir)
+            dir = os.path.dirname(dir)
+    for dir in dirs:
+        tree_hash = lookup_path(target_commit.tree_hash, dir) if dir else target_commit.tree_hash
+        if tree_hash and tree_hash.startswith("tr"):
+            tree_cache[dir] = tree_hash
+
+    write_index(index_data, extensions)
+    update_head(commit_hash)
+    CommitGraph.load().add(commit_hash)
+    return changes
+
+def _checkout_file(args):
+    """Worker for checkout: writes the blob with the given hash to the given path
+        (via a temp file, so it's never half-written). Returns the file's stat data."""
+    path, hash, mode = args
+    dir = os.path.dirname(path)
+    if dir and not os.path.isdir(dir):
+        try:
+            os.makedirs(dir)
+        except OSError:
+            if not os.path.isdir(dir): # (another worker may have just made it)
+                raise
+    fd, temp_path = tempfile.mkstemp(dir=dir or ".", prefix=".goob-tmp-")
+    with os.fdopen(fd, 'wb') as out:
+        with read_hash(hash, stream=True) as f:
+            for data in iter(lambda: f.read(BLOCK_SIZE), ""):
+                out.write(data)
+    os.chmod(temp_path, mode)
+    os.rename(temp_path, path)
+    return get_stat_data(path)
+
+def _umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+def remove_empty_dirs(dir):
+    """Removes the given directory, and its parents, as long as they're empty."""
+    while dir and not os.listdir(dir):
+        os.rmdir(dir)
+        dir = os.path.dirname(dir)
 
 @requires_repo
 def list_files():
@@ -222,16 +1138,738 @@ def list_files():
     index_data = read_index
     print "\n".join(sorted(index_data.keys()))
 
+@requires_repo
+def pack(repack=False, delta=False, window=DELTA_WINDOW, max_depth=DELTA_MAX_DEPTH):
+    """Moves all loose objects into a new pack (and its index), then deletes them.
+        If 'repack', existing packs are folded into the new pack as well. If 'delta',
+        blobs are stored as deltas against similar blobs where that saves space
+        (see find_deltas). Returns the new pack's name, or None if there was
+        nothing to pack."""
+
+    loose = list_loose_objects()
+    old_packs = get_packs() if repack else []
+    hashes = set(loose)
+    for old_pack in old_packs:
+        hashes.update(old_pack.hashes())
+    if not hashes or (not loose and len(old_packs) < 2 and not delta):
+        return None
+
+    name = write_pack(sorted(hashes), delta, window, max_depth)
+
+    for hash in loose:
+        os.remove(hash_to_path(hash))
+        forget_object(hash)
+    for old_pack in old_packs:
+        old_pack.remove()
+    return name
+
+@requires_repo
+def migrate():
+    """Converts a repo made with pickled objects to the current object encoding.
+        Trees and commits get new hashes, so every commit reachable from HEAD is
+        rewritten (oldest first) and HEAD moved to the new top commit; pickled
+        blobs are rewritten in place (blob hashes don't change). The old trees
+        and commits are left behind, unreferenced. Returns the number of objects
+        converted."""
+
+    converted = {} # old hash -> new hash
+
+    def convert_blob(hash):
+        path = hash_to_path(hash)
+        if hash not in converted and os.path.exists(path):
+            with open(path, 'rb') as f:
+                legacy = f.read(1) != "\x00"
+            if legacy:
+                contents = read_hash(hash)
+                os.remove(path)
+                forget_object(hash)
+                save_blob_stream(BytesIO(contents))
+                converted[hash] = hash
+        return hash
+
+    def convert_tree(hash):
+        if hash not in converted:
+            new_tree = {}
+            for name, (entry_hash, obj_type) in read_hash(hash).iteritems():
+                if obj_type == "tree":
+                    new_tree[name] = ObjectHash(convert_tree(entry_hash), obj_type)
+                else:
+                    new_tree[name] = ObjectHash(convert_blob(entry_hash), obj_type)
+            data = encode_tree(new_tree)
+            converted[hash] = make_hash(data, "tree")
+            save_encoded(data, converted[hash])
+        return converted[hash]
+
+    commit_hashes = []
+    commit_hash = get_cur_head()
+    while commit_hash:
+        commit_hashes.append(commit_hash)
+        commit_hash = read_hash(commit_hash).parent
+
+    for commit_hash in reversed(commit_hashes):
+        old_commit = read_hash(commit_hash)
+        new_commit = Commit(convert_tree(old_commit.tree_hash), old_commit.timestamp,
+            old_commit.msg, converted.get(old_commit.parent), old_commit.author)
+        new_commit.save()
+        converted[commit_hash] = new_commit.__hash__()
+    if commit_hashes:
+        update_head(converted[commit_hashes[0]])
+
+    # staged blobs may never have been committed; cached trees are all old hashes
+    index_data, extensions = read_index_ext()
+    for hash in index_data.itervalues():
+        convert_blob(hash)
+    extensions["tree"] = {}
+    write_index(index_data, extensions)
+
+    object_cache.clear()
+    return len(converted)
+
+@requires_repo
+def gc(grace_period=GC_GRACE_PERIOD, delta=False):
+    """Deletes objects that nothing refers to: everything not reachable from HEAD
+        (through each commit's parents and trees) or from the index. Loose
+        objects are deleted; packs holding unreachable objects are repacked
+        without them. Anything modified less than 'grace_period' seconds ago is
+        kept, since another command may be about to point at it. With bitmaps
+        (see write_bitmaps), the history isn't walked, and the bitmaps are
+        rewritten afterwards. Returns a GCStats(reachable, removed, kept)."""
+
+    # reachable and loose hashes get sorted on disk, and pack indexes are sorted
+    # already, so memory use doesn't grow with the number of objects; sweeping
+    # is a merge of each sorted list of objects against the reachable ones
+    cutoff = time.time() - grace_period
+    reachable, loose, to_pack = HashSorter(), HashSorter(), HashSorter()
+    removed = kept = 0
+    try:
+        mark_reachable(reachable)
+        for hash in iter_loose_objects():
+            loose.add(hash)
+
+        for hash in sorted_difference(loose, reachable):
+            path = hash_to_path(hash)
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                forget_object(hash)
+                removed += 1
+            else:
+                kept += 1
+
+        old_packs = []
+        for cur_pack in get_packs():
+            garbage = sum(1 for _ in sorted_difference(cur_pack.iter_hashes(), reachable))
+            if not garbage:
+                continue
+            if os.path.getmtime(cur_pack.path) >= cutoff:
+                kept += garbage
+                continue
+            old_packs.append(cur_pack)
+            for hash in sorted_intersection(cur_pack.iter_hashes(), reachable):
+                to_pack.add(hash)
+            removed += garbage
+        if old_packs:
+            count = sum(1 for _ in to_pack)
+            if count:
+                write_pack(iter(to_pack), delta, count=count)
+            for old_pack in old_packs:
+                old_pack.remove()
+
+        # temp files left by writes that never finished
+        for dir in LOOSE_PATHS + [PACK_PATH]:
+            if not os.path.isdir(dir):
+                continue # repo made before packs existed
+            for filename in os.listdir(dir):
+                path = os.path.join(dir, filename)
+                if filename.startswith("tmp-") and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+
+        total = sum(1 for _ in reachable)
+    finally:
+        for sorter in [reachable, loose, to_pack]:
+            sorter.close()
+
+    forget_packs()
+    object_cache.clear()
+    delta_base_cache.clear()
+    # the commit graph may list commits that are gone now
+    if os.path.exists(COMMIT_GRAPH_PATH):
+        os.remove(COMMIT_GRAPH_PATH)
+    if get_cur_head():
+        CommitGraph.for_head()
+    # rewritten without the objects that are gone
+    if os.path.exists(BITMAPS_PATH):
+        os.remove(BITMAPS_PATH)
+        write_bitmaps()
+
+    print "Removed %d unreachable objects (kept %d recent ones)." % (removed, kept)
+    return GCStats(total, removed, kept)
+
+class FsckReport(object):
+    """What fsck found, plus how much it read and how fast."""
+    def __init__(self):
+        self.corrupt = []  # (hash, what's wrong)
+        self.missing = []  # referenced, but not stored
+        self.dangling = [] # stored, but not reachable from HEAD or the index
+        self.pickled = []  # old-style objects, which can't be checked (see migrate())
+        self.objects = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    @property
+    def ok(self):
+        return not (self.corrupt or self.missing)
+
+    def __str__(self):
+        results = ["Checked %d objects (%.1f MB) in %.2fs, %.1f MB/s." % (self.objects,
+            self.bytes / 1e6, self.seconds, self.bytes / 1e6 / max(self.seconds, 1e-6))]
+        results.extend([("\tcorrupt %s: %s" % problem) for problem in self.corrupt])
+        results.extend([("\tmissing %s" % hash) for hash in self.missing])
+        results.extend([("\tdangling %s" % hash) for hash in self.dangling])
+        if self.pickled:
+            results.append("\t%d old-style (pickled) objects not checked" % len(self.pickled))
+        return "\n".join(results)
+
+@requires_repo
+def fsck(workers=None, progress=True):
+    """Checks the object store: every object (loose or packed) is rehashed on a pool
+        of 'workers' processes to make sure it matches the hash it's stored under,
+        then history is walked from HEAD (and the index) to find objects that are
+        referenced but missing, and ones nothing refers to (dangling). Prints
+        progress as it goes unless 'progress' is False. Returns an FsckReport."""
+    report = FsckReport()
+    start = time.time()
+
+    stored = set(list_loose_objects())
+    for cur_pack in get_packs():
+        stored.update(cur_pack.hashes())
+    stored = sorted(stored)
+
+    pool = Pool(workers or cpu_count()) if workers != 1 else None
+    try:
+        results = (pool.imap_unordered(_verify_object, stored, chunksize=16) if pool
+            else (_verify_object(hash) for hash in stored))
+        for hash, problem, size, pickled in results:
+            report.objects += 1
+            report.bytes += size
+            if problem:
+                report.corrupt.append((hash, problem))
+            if pickled:
+                report.pickled.append(hash)
+            if progress and (report.objects % FSCK_PROGRESS_EVERY == 0 or
+                    report.objects == len(stored)):
+                elapsed = max(time.time() - start, 1e-6)
+                sys.stdout.write("\rChecking objects: %d/%d, %.1f MB/s" % (report.objects,
+                    len(stored), report.bytes / 1e6 / elapsed))
+                sys.stdout.flush()
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    if progress and stored:
+        print
+    report.corrupt.sort()
+    report.pickled.sort()
+
+    reachable = HashSorter()
+    try:
+        mark_reachable(reachable, report.missing)
+        report.dangling = list(sorted_difference(stored, reachable))
+    finally:
+        reachable.close()
+    report.missing = sorted(set(report.missing))
+
+    report.seconds = time.time() - start
+    print report
+    return report
+
+def _verify_object(hash):
+    """Worker for fsck: rehashes one stored object. Returns (hash, what's wrong or
+        None, bytes read, whether it's an old-style pickled object)."""
+    try:
+        if hash.startswith("bl"):
+            sha, size = sha1(), 0
+            with decode_object(open_object(hash, stream=True), stream=True) as f:
+                for data in iter(lambda: f.read(BLOCK_SIZE), ""):
+                    sha.update(data)
+                    size += len(data)
+            actual = 'bl%s' % sha.hexdigest()
+        else:
+            with open_object(hash) as f:
+                data = f.read()
+            size = len(data)
+            if not data.startswith("\x00"):
+                # its hash was made from its str(), which we can't reproduce
+                return hash, None, size, True
+            actual = make_hash(data, hash[:2])
+            decode_object(BytesIO(data))
+    except BadHashError:
+        return hash, "vanished while checking", 0, False
+    except Exception as e:
+        return hash, "unreadable (%s)" % e, 0, False
+    if actual != hash:
+        return hash, "contents hash to %s" % actual, size, False
+    return hash, None, size, False
+
+@requires_repo
+def fast_import(records=None, batch_size=1000, checkout_head=False):
+    """Imports history from 'records' (an iterable of ImportBlob's and ImportCommit's,
+        or a file to parse them from -- see parse_fast_import; default stdin).
+        Blobs, trees and commits are written straight to the object store:
+        nothing goes through the working directory or the index, and only the
+        trees of directories a commit changed are rebuilt. Objects are flushed
+        to disk every 'batch_size' commits, and HEAD is moved to the last
+        commit at the end (or checked out, if 'checkout_head', which also
+        updates the working directory and index). Returns ImportStats."""
+    if records is None:
+        records = sys.stdin
+    if hasattr(records, "read"):
+        records = parse_fast_import(records)
+
+    with object_writer() as writer:
+        writer.use_listings()
+    marks = {}
+    def resolve(ref):
+        if ref.startswith(":"):
+            try:
+                return marks[ref]
+            except KeyError:
+                raise BadImportError("Unknown mark %s" % ref)
+        return ref
+
+    graph = CommitGraph.load()
+    start_head = tip = get_cur_head()
+    files = {}
+    tree_cache = {}
+    if tip:
+        files = dict(iter_tree(read_hash(tip).tree_hash))
+    commits = blobs = 0
+
+    for record in records:
+        if isinstance(record, ImportBlob):
+            if isinstance(record.data, str):
+                data, size = BytesIO(record.data), len(record.data)
+            else:
+                data, size = record.data, getattr(record.data, "remaining", 0)
+            if CHUNK_BLOBS and size >= CHUNK_THRESHOLD:
+                hash = save_chunked_stream(data)
+            else:
+                hash = save_blob_stream(data)
+            if record.mark:
+                marks[record.mark] = hash
+            blobs += 1
+            continue
+
+        parent = resolve(record.parent) if record.parent is not None else tip
+        if parent != tip:
+            # branching off somewhere else: start from that commit's files
+            files = dict(iter_tree(read_hash(parent).tree_hash)) if parent else {}
+            tree_cache = {}
+        for change in record.changes:
+            if change[0] == "M":
+                files[change[1]] = resolve(change[2])
+                invalidate_tree_cache(tree_cache, change[1])
+            elif change[0] == "D":
+                files.pop(change[1], None)
+                invalidate_tree_cache(tree_cache, change[1])
+            elif change[0] == "deleteall":
+                files = {}
+                tree_cache = {}
+            else:
+                raise BadImportError("Unknown change %r" % (change,))
+
+        timestamp = record.timestamp if record.timestamp is not None else time.time()
+        new_commit = Commit(make_tree(files, tree_cache), time.ctime(timestamp),
+            record.message, parent, record.author)
+        new_commit.save()
+        tip = new_commit.__hash__()
+        if record.mark:
+            marks[record.mark] = tip
+        commits += 1
+        if commits % batch_size == 0:
+            flush_objects()
+            graph.add(tip)
+            object_cache.clear()
+
+    if tip != start_head:
+        graph.add(tip)
+        if os.path.exists(PATH_FILTERS_PATH):
+            update_path_filters(graph)
+        if checkout_head:
+            checkout(tip)
+        else:
+            update_head(tip)
+    print "Imported %d commits, %d blobs." % (commits, blobs)
+    return ImportStats(tip, commits, blobs)
+
+def parse_fast_import(f):
+    """Yields ImportBlob's and ImportCommit's read from file-like 'f', in this format
+        (a cut-down git fast-import stream):
+
+            blob
+            mark :1
+            data <length>
+            <that many bytes>
+
+            commit
+            mark :2
+            author <name>
+            time <seconds since the epoch>
+            from <:mark or commit hash>
+            data <length>
+            <message: that many bytes>
+            M <:mark or blob hash> <path>
+            D <path>
+            deleteall
+
+        Everything but 'data' is optional, and 'from' may come just after the
+        message instead (as git puts it). A blob's data is handed over as a
+        file-like object, so it's never all in memory: read it before asking
+        for the next record."""
+    line = f.readline()
+    while line:
+        command = line.rstrip("\n")
+        if not command or command.startswith("#"):
+            line = f.readline()
+        elif command == "done":
+            return
+        elif command == "blob":
+            mark, line = _read_import_field(f, "mark")
+            length = _read_import_length(line)
+            data = BoundedReader(f, length)
+            yield ImportBlob(mark, data)
+            while data.read(BLOCK_SIZE): # whatever the consumer didn't read
+                pass
+            line = f.readline()
+        elif command == "commit":
+            fields = {}
+            line = f.readline()
+            while line.split(" ", 1)[0] in IMPORT_COMMIT_FIELDS:
+                field, value = line.rstrip("\n").split(" ", 1)
+                fields[field] = value
+                line = f.readline()
+            message = f.read(_read_import_length(line))
+            changes = []
+            line = f.readline()
+            if line == "\n": # (after the message)
+                line = f.readline()
+            if line.startswith("from "): # (where git puts it)
+                fields["from"] = line.rstrip("\n")[len("from "):]
+                line = f.readline()
+            while line.strip():
+                change = line.rstrip("\n")
+                if change.startswith("M "):
+                    _, ref, path = change.split(" ", 2)
+                    changes.append(("M", path, ref))
+                elif change.startswith("D "):
+                    changes.append(("D", change[2:]))
+                elif change == "deleteall":
+                    changes.append(("deleteall",))
+                else:
+                    break # the next command
+                line = f.readline()
+            timestamp = float(fields["time"]) if "time" in fields else None
+            yield ImportCommit(fields.get("mark"), message, changes,
+                fields.get("author", "ME!"), timestamp, fields.get("from"))
+        else:
+            raise BadImportError("Unknown command %r" % command)
+
+IMPORT_COMMIT_FIELDS = ("mark", "author", "time", "from")
+
+def _read_import_field(f, name):
+    """Reads an optional '<name> <value>' line. Returns (value or None, next line)."""
+    line = f.readline()
+    if line.startswith(name + " "):
+        return line.rstrip("\n")[len(name) + 1:], f.readline()
+    return None, line
+
+def _read_import_length(line):
+    if not line.startswith("data "):
+        raise BadImportError("Expected 'data <length>', got %r" % line)
+    return int(line[len("data "):])
+
+def clone(src_path, dest_path=None):
+    """Makes a new repo at 'dest_path' (default: the current directory) with the
+        history of the repo at 'src_path', and checks out its HEAD. Returns
+        FetchStats (see fetch)."""
+    cwd = os.getcwd()
+    if dest_path:
+        src_path = os.path.abspath(src_path)
+        if not os.path.exists(dest_path):
+            os.makedirs(dest_path)
+        os.chdir(dest_path)
+    try:
+        init()
+        return fetch(src_path)
+    finally:
+        os.chdir(cwd)
+
+@requires_repo
+def fetch(src_path):
+    """Copies the commits in the history of the repo at 'src_path' that this repo
+        doesn't have, and the objects they need, as a single pack. Which commits
+        we have is found by walking back the source's parents until one is in
+        our commit graph; only objects those commits added (i.e. not in their
+        parent's tree) are sent, so catching up by one commit costs one
+        commit's worth of work (or, if the source has bitmaps, they say which
+        objects to send). If our HEAD is behind the source's (or there
+        isn't one), it's fast-forwarded with checkout; otherwise HEAD is left
+        alone. Either way the source's HEAD is written to refs/FETCH_HEAD.
+        Returns FetchStats(head, commits, objects, updated)."""
+    src_path = os.path.abspath(src_path)
+    if not os.path.exists(os.path.join(src_path, REPO_PATH)):
+        raise NoRepoError("Not a goob repo: %s" % src_path)
+    head = get_cur_head()
+    graph = CommitGraph.for_head() if head else CommitGraph.load()
+
+    # have/want: everything back to the first commit we already know of
+    with _in_repo(src_path):
+        src_head = get_cur_head()
+        wanted = []
+        commit_hash = src_head
+        while commit_hash and commit_hash not in graph:
+            cur_commit = read_hash(commit_hash)
+            wanted.append((commit_hash, cur_commit))
+            commit_hash = cur_commit.parent
+        objects = set()
+        if wanted and os.path.exists(BITMAPS_PATH):
+            # the source's bitmaps can tell what it has that the commit we stopped at doesn't
+            bitmaps = Bitmaps.load()
+            src_graph = CommitGraph.for_head()
+            bits = bitmaps.reachable(src_head, src_graph)
+            if commit_hash:
+                bits &= ~bitmaps.reachable(commit_hash, src_graph)
+            objects.update(bitmaps.hashes_of(bits))
+        else:
+            for commit_hash, cur_commit in wanted:
+                objects.add(commit_hash)
+                parent_tree = read_hash(cur_commit.parent).tree_hash if cur_commit.parent else None
+                _collect_new_objects(cur_commit.tree_hash, parent_tree, objects)
+    if not src_head:
+        print "Nothing to fetch."
+        return FetchStats(None, 0, 0, False)
+
+    # a file that came back, say, is new to the tree but not to us
+    objects = sorted(hash for hash in objects if not object_exists(hash))
+    if objects:
+        pack_dir = os.path.abspath(PACK_PATH)
+        with _in_repo(src_path):
+            write_pack(objects, pack_dir=pack_dir)
+        forget_packs()
+    graph.add(src_head)
+    with open(os.path.join(REFS_PATH, "FETCH_HEAD"), "w") as f:
+        f.write(src_head)
+
+    updated = False
+    if src_head == head:
+        print "Already up to date."
+    elif not head or any(entry.hash == head for entry in graph.walk(src_head)):
+        checkout(src_head)
+        updated = True
+        print "Fetched %d commits (%d objects); now at %s." % (len(wanted),
+            len(objects), src_head)
+    else:
+        print "Fetched %d commits (%d objects) into FETCH_HEAD; HEAD isn't behind " \
+            "it, so it was left alone." % (len(wanted), len(objects))
+    if os.path.exists(PATH_FILTERS_PATH):
+        update_path_filters(graph)
+    return FetchStats(src_head, len(wanted), len(objects), updated)
+
+def _collect_new_objects(tree_hash, old_tree_hash, objects):
+    """Adds to 'objects' the hashes of the trees and blobs under 'tree_hash' that
+        aren't under 'old_tree_hash' (the same tree in the parent commit), and
+        the chunks of any chunked blob among them. Identical subtrees are
+        skipped without being read."""
+    if tree_hash == old_tree_hash or tree_hash in objects:
+        return
+    objects.add(tree_hash)
+    old_tree = read_hash(old_tree_hash) if old_tree_hash else {}
+    for name, (hash, obj_type) in read_hash(tree_hash).iteritems():
+        old_hash, old_type = old_tree.get(name, (None, None))
+        if obj_type == "tree":
+            _collect_new_objects(hash, old_hash if old_type == "tree" else None, objects)
+        elif hash != old_hash and hash not in objects:
+            objects.add(hash)
+            for chunk_hash, _ in blob_chunks(hash) or []:
+                objects.add(chunk_hash)
+
+@contextmanager
+def _in_repo(path):
+    """Runs the body in the repo at 'path' (goob's paths are all relative), with
+        the current command's ObjectWriter set aside, since it only knows about
+        this repo's objects."""
+    global _object_writer
+    cwd, writer = os.getcwd(), _object_writer
+    os.chdir(path)
+    _object_writer = None
+    try:
+        yield
+    finally:
+        _object_writer = writer
+        os.chdir(cwd)
+
+@requires_repo
+def watch(interval=1.0, use_inotify=None):
+    """Runs a watcher that notes every path that changes in the working directory,
+        so status() only has to look at those. Uses inotify where available
+        (unless 'use_inotify' is False), otherwise rescans every 'interval'
+        seconds. Runs until stop_watching() is called (or it's killed)."""
+    monitor = FSMonitor(use_inotify)
+    monitor.start()
+    try:
+        while monitor.is_current():
+            monitor.poll_once(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        monitor.stop()
+
+@requires_repo
+def stop_watching():
+    """Tells the running watcher (if any) to stop."""
+    if os.path.exists(FSMONITOR_WATCHER_PATH):
+        os.remove(FSMONITOR_WATCHER_PATH)
+
 # Files I need
 # .goobignore file = this file will tell you which thigns to ignore (i.e. not add)
 
 #.goob/pointer = file containing the hash of the current commit <<< change later for branching, detached head, etc.
 #.goob/index = all the files that goob knows about, + hashes
 
+@requires_repo
+def diff_commits(old_commit_hash, new_commit_hash=None):
+    """Displays what changed between two commits (the second defaults to the current
+        commit): which files were added, removed or modified, and a line-by-line
+        diff of each modified file. Returns the TreeChange's."""
+    if new_commit_hash is None:
+        new_commit_hash = get_cur_head()
+    old_tree = read_hash(old_commit_hash).tree_hash
+    new_tree = read_hash(new_commit_hash).tree_hash
+
+    changes = []
+    for change in diff_trees(old_tree, new_tree):
+        changes.append(change)
+        if change.kind == "added":
+            print colors.GREEN + "Added: %s" % change.path + colors.ENDC
+        elif change.kind == "removed":
+            print colors.RED + "Removed: %s" % change.path + colors.ENDC
+        else:
+            print colors.YELLOW + "Modified: %s" % change.path + colors.ENDC
+            print "\n".join(diff_blobs(change.old_hash, change.new_hash, change.path))
+    return changes
+
 ## INTERNAL COMMANDS
 def diff(file1, file2):
     """If the files are at all different, return True. Otherwise, false."""
-    pass
+    if os.path.getsize(file1) != os.path.getsize(file2):
+        return True
+    return get_hash_of_file_contents(file1) != get_hash_of_file_contents(file2)
+
+def diff_blobs(old_hash, new_hash, path="", context=3):
+    """Returns a unified diff (a list of lines) between two blobs; empty if they're
+        the same blob, which is known without reading them."""
+    if old_hash == new_hash:
+        return []
+    old_contents = read_hash(old_hash) if old_hash else ""
+    new_contents = read_hash(new_hash) if new_hash else ""
+    header = ["--- a/%s" % path, "+++ b/%s" % path]
+    if "\x00" in old_contents or "\x00" in new_contents:
+        return header + ["Binary files differ"]
+    ops = diff_lines(old_contents.splitlines(), new_contents.splitlines())
+    return header + unified_hunks(ops, context)
+
+def diff_lines(a, b):
+    """Returns the shortest edit script turning list 'a' into list 'b', as a list
+        of (op, line) where op is "=" (in both), "-" (only in a) or "+" (only in b)."""
+    # lines the two have in common at either end don't need diffing
+    prefix = 0
+    while prefix < len(a) and prefix < len(b) and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < len(a) - prefix and suffix < len(b) - prefix and \
+            a[len(a) - 1 - suffix] == b[len(b) - 1 - suffix]:
+        suffix += 1
+    middle = _myers_diff(a[prefix:len(a) - suffix], b[prefix:len(b) - suffix])
+    return ([("=", line) for line in a[:prefix]] + middle +
+        [("=", line) for line in a[len(a) - suffix:]])
+
+def _myers_diff(a, b):
+    """Myers' O(ND) diff: for each number of edits d, follow each diagonal k as far
+        as it goes (v[k] = furthest x reached), until one reaches the end. Then
+        walk back through the saved v's to recover the edits."""
+    n, m = len(a), len(b)
+    v = {1: 0}
+    trace = []
+    for d in xrange(n + m + 1):
+        trace.append(dict(v))
+        for k in xrange(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                x = v[k + 1] # step down: insert b[y]
+            else:
+                x = v[k - 1] + 1 # step right: delete a[x]
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x, y = x + 1, y + 1
+            v[k] = x
+            if x >= n and y >= m:
+                return _myers_backtrack(trace, a, b)
+    return []
+
+def _myers_backtrack(trace, a, b):
+    ops = []
+    x, y = len(a), len(b)
+    for d in xrange(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[k - 1] < v[k + 1]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[prev_k]
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            ops.append(("=", a[x - 1]))
+            x, y = x - 1, y - 1
+        if d > 0:
+            if x == prev_x:
+                ops.append(("+", b[y - 1]))
+            else:
+                ops.append(("-", a[x - 1]))
+        x, y = prev_x, prev_y
+    ops.reverse()
+    return ops
+
+def unified_hunks(ops, context=3):
+    """Formats an edit script from diff_lines as unified diff hunks."""
+    # line numbers in a and b where each op starts
+    positions = []
+    a_line = b_line = 1
+    for op, line in ops:
+        positions.append((a_line, b_line))
+        if op != "+":
+            a_line += 1
+        if op != "-":
+            b_line += 1
+
+    changed = [i for i, (op, line) in enumerate(ops) if op != "="]
+    results = []
+    i = 0
+    while i < len(changed):
+        # a hunk runs from 'context' lines before a change to 'context' lines after
+        # the last change that's within 2 * context lines of the one before it
+        start = max(changed[i] - context, 0)
+        j = i
+        while j + 1 < len(changed) and changed[j + 1] - changed[j] <= 2 * context:
+            j += 1
+        end = min(changed[j] + context + 1, len(ops))
+        hunk = ops[start:end]
+        a_start, b_start = positions[start]
+        a_count = sum(1 for op, line in hunk if op != "+")
+        b_count = sum(1 for op, line in hunk if op != "-")
+        results.append("@@ -%d,%d +%d,%d @@" % (a_start if a_count else a_start - 1,
+            a_count, b_start if b_count else b_start - 1, b_count))
+        results.extend([("%s%s" % (" " if op == "=" else op, line)) for op, line in hunk])
+        i = j + 1
+    return results
 
 class Commit(object):
     def __init__(self, tree_hash, timestamp, msg, parent=None, author="ME!"):
@@ -245,7 +1883,7 @@ class Commit(object):
         return "Tree: %s\nTimestamp: %s\nMessage: %s\nParent: %s\nAuthor: %s" % (self.tree_hash, self.timestamp, self.msg, self.parent, self.author)
 
     def __hash__(self):
-        return make_hash(str(self), "commit")
+        return make_hash(encode_commit(self), "commit")
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
@@ -254,20 +1892,29 @@ class Commit(object):
             return False
 
     def save(self):
-        commit_hash = self.__hash__()
-        save_hash(self, commit_hash)
+        data = encode_commit(self)
+        save_encoded(data, make_hash(data, "commit"))
 
 def make_commit(msg):
     """makes a commit file"""
-    index_data = read_index()
-
-    tree_hash = make_tree(index_data)
+    index_data, extensions = read_index_ext()
+
+    # only the trees for directories touched since the last commit get rebuilt
+    tree_cache = extensions["tree"]
+    cached_trees = len(tree_cache)
+    tree_hash = make_tree(index_data, tree_cache)
+    if len(tree_cache) != cached_trees:
+        write_index(index_data, extensions)
     timestamp = time.ctime()
     parent = get_cur_head()
 
     new_commit = Commit(tree_hash, timestamp, msg, parent)
     new_commit.save()
     update_head(new_commit.__hash__())
+    graph = CommitGraph.load()
+    graph.add(new_commit.__hash__())
+    if os.path.exists(PATH_FILTERS_PATH):
+        update_path_filters(graph)
 
 def get_cur_head():
     """Returns the current head (i.e. the hash of the topmost commit)"""
@@ -276,11 +1923,18 @@ def get_cur_head():
 
 def update_head(commit_hash):
     """Updates HEAD to point to the given commit."""
+    flush_objects()
     with open(POINTER_PATH, "w") as f:
         f.write(commit_hash)
 
-def make_tree(path_dict):
-    """Makes a tree file and returns the hash."""
+def make_tree(path_dict, tree_cache=None, prefix=""):
+    """Makes a tree file and returns the hash. If given a tree_cache (a dict of
+        directory -> tree hash, "" being the top directory), any directory in it
+        is assumed unchanged and its tree is reused, and every tree made is
+        added to it."""
+
+    if tree_cache is not None and prefix in tree_cache:
+        return tree_cache[prefix]
 
     my_tree = {}
     directories = defaultdict(dict)
@@ -292,28 +1946,316 @@ def make_tree(path_dict):
             my_tree[path] = ObjectHash(hash, "blob")
 
     for dir, filedict in directories.iteritems():
-        my_tree[dir] = ObjectHash(make_tree(filedict), "tree")
+        my_tree[dir] = ObjectHash(make_tree(filedict, tree_cache, os.path.join(prefix, dir)), "tree")
 
-    hash = make_hash(str(sorted(my_tree.items())), "tree")
-    save_hash(my_tree, hash)
+    data = encode_tree(my_tree)
+    hash = make_hash(data, "tree")
+    save_encoded(data, hash)
+    if tree_cache is not None:
+        tree_cache[prefix] = hash
 
     return hash
 
     # to prettify -- 'subdivide' func that finds everything
         # belonging to a particular folder etc. all at once?
 
-def read_hash(hash):
-    """Returns contents of the file at given hash"""
-    # given hash xxyyyyyy, look in .goob/objects/xx/yyyyyy, return contents (text)
-        # when I implement contents-encoding, will need to decode here.
+@traced(size=lambda contents, args: len(contents) if isinstance(contents, str) else 0)
+def read_hash(hash, stream=False):
+    """Returns contents of the file at given hash. If 'stream', returns a file-like
+        object to read the contents from instead (blobs are then never fully
+        loaded into memory); the caller should close it."""
+    # given hash xxyyyyyy, look in the packs, then .goob/objects/xx/yyyyyy
         # if it's a tree or a commit, will need prettyprint method?
+    # objects are immutable (they're named for their contents), so anything we've
+    # decoded before can be handed back as is -- callers mustn't modify it.
+    contents = object_cache.get(hash)
+    if contents is not None:
+        # trees and commits come back decoded even when streamed
+        return BytesIO(contents) if stream and isinstance(contents, str) else contents
+    if stream:
+        return decode_object(open_object(hash, stream=True), stream=True)
+
+    contents = decode_object(open_object(hash))
+    if not isinstance(contents, str) or len(contents) <= OBJECT_CACHE_MAX_BLOB:
+        object_cache.add(hash, contents)
+    return contents
+
+@traced()
+def open_object(hash, stream=False):
+    """Returns a file-like object holding the stored (still encoded) object with the
+        given hash, from a pack if it's packed, otherwise from its loose file."""
+    for pack in get_packs():
+        if hash in pack:
+            return pack.open_object(hash) if stream else BytesIO(pack.read_object(hash))
     try:
-        path = hash_to_path(hash)
-        with open(path) as f:
-            return cPickle.load(f)
+        return open(hash_to_path(hash), 'rb')
     except IOError:
         raise BadHashError("No file exists at this hash.")
 
+@traced()
+def decode_object(f, stream=False):
+    """Decodes the stored object read from file-like 'f' (see read_hash)."""
+    first = f.read(1)
+    magic = first + f.readline() if first == "\x00" else None
+    if magic == BLOB_RAW_MAGIC:
+        blob = f
+    elif magic == BLOB_ZLIB_MAGIC:
+        blob = ZlibReader(f)
+    elif magic == BLOB_CHUNKED_MAGIC:
+        with f:
+            blob = ChunkedReader(decode_chunk_list(f.read()))
+    else:
+        with f:
+            if magic == TREE_MAGIC:
+                return decode_tree(f.read())
+            elif magic == COMMIT_MAGIC:
+                return decode_commit(f.read())
+            # an old-style pickled object; see migrate()
+            contents = cPickle.loads(first + f.read())
+        return BytesIO(contents) if stream else contents
+
+    if stream:
+        return blob
+    with blob:
+        return blob.read()
+
+def encode_tree(tree):
+    """Returns the canonical encoding of a tree (a dict of name -> ObjectHash):
+        one fixed-size (type, hash, name length) entry plus the name for each
+        entry, sorted by name."""
+    parts = [TREE_MAGIC]
+    for name in sorted(tree):
+        hash, obj_type = tree[name]
+        parts.append(TREE_ENTRY.pack(TREE_TYPE_CODES[obj_type], hash, len(name)))
+        parts.append(name)
+    return "".join(parts)
+
+def decode_tree(data, offset=0):
+    """Decodes a tree encoded by encode_tree (header already stripped)."""
+    tree = {}
+    unpack_entry, entry_size = TREE_ENTRY.unpack_from, TREE_ENTRY.size
+    while offset < len(data):
+        type_code, hash, name_len = unpack_entry(data, offset)
+        offset += entry_size
+        tree[data[offset:offset + name_len]] = ObjectHash(hash, TREE_TYPES[type_code])
+        offset += name_len
+    return tree
+
+def encode_commit(commit):
+    """Returns the canonical encoding of a Commit: each field as a typed,
+        length-prefixed value (see encode_value)."""
+    return COMMIT_MAGIC + "".join([encode_value(commit.tree_hash),
+        encode_value(commit.timestamp), encode_value(commit.msg),
+        encode_value(commit.parent), encode_value(commit.author)])
+
+def decode_commit(data, offset=0):
+    """Decodes a commit encoded by encode_commit (header already stripped)."""
+    fields = []
+    while offset < len(data):
+        value, offset = decode_value(data, offset)
+        fields.append(value)
+    return Commit(*fields)
+
+def encode_value(value):
+    """Encodes None, a string, or a number as a type code, a length, and the value."""
+    if value is None:
+        type_code, data = "n", ""
+    elif isinstance(value, str):
+        type_code, data = "s", value
+    elif isinstance(value, unicode):
+        type_code, data = "u", value.encode("utf-8")
+    elif isinstance(value, (int, long)) and not isinstance(value, bool):
+        type_code, data = "i", str(value)
+    elif isinstance(value, float):
+        type_code, data = "f", repr(value)
+    else:
+        raise TypeError("Can't encode a %s" % type(value).__name__)
+    return VALUE_HEADER.pack(type_code, len(data)) + data
+
+def decode_value(data, offset=0):
+    """Decodes the value at offset, returns (value, offset of whatever's next)."""
+    type_code, length = VALUE_HEADER.unpack_from(data, offset)
+    offset += VALUE_HEADER.size
+    value = data[offset:offset + length]
+    if type_code == "n":
+        value = None
+    elif type_code == "u":
+        value = value.decode("utf-8")
+    elif type_code == "i":
+        value = int(value)
+    elif type_code == "f":
+        value = float(value)
+    return value, offset + length
+
+def object_exists(hash):
+    """True if an object with the given hash is stored (loose or packed)."""
+    if _object_writer is not None:
+        return _object_writer.exists(hash)
+    return any(hash in pack for pack in get_packs()) or os.path.exists(hash_to_path(hash))
+
+class ObjectWriter(object):
+    """Writes new loose objects for the length of one command. Never rewrites an
+        object that's already stored, and fsyncs everything it wrote in one go
+        rather than once per object. Whether an object is stored is checked
+        one at a time, unless use_listings() is called first."""
+    def __init__(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.known = None  # object directory -> set of the names in it, if listing
+        self.unsynced = [] # paths written since the last flush
+
+    def use_listings(self):
+        """For commands writing lots of objects: lists each object directory once,
+            the first time it's asked about, rather than checking every object."""
+        with self.lock:
+            if self.known is None:
+                self.known = {}
+
+    def _names(self, hash):
+        names = self.known.get(hash[:2])
+        if names is None:
+            names = self.known[hash[:2]] = set(os.listdir(os.path.dirname(hash_to_path(hash))))
+        return names
+
+    def exists(self, hash):
+        if any(hash in pack for pack in get_packs()):
+            return True
+        with self.lock:
+            if self.known is not None:
+                return hash[2:] in self._names(hash)
+        return os.path.exists(hash_to_path(hash))
+
+    def add(self, temp_path, hash):
+        """Moves a completely written temp file into place as object 'hash', or just
+            deletes it if that object's already stored. Returns True if it was new."""
+        if self.exists(hash):
+            os.remove(temp_path)
+            freshen_object(hash)
+            return False
+        path = hash_to_path(hash)
+        if self.pid != os.getpid():
+            # a worker process: nobody's going to flush our list, so sync now
+            _fsync_paths([temp_path])
+            os.rename(temp_path, path)
+        else:
+            os.rename(temp_path, path)
+        with self.lock:
+            if self.known is not None:
+                self._names(hash).add(hash[2:])
+            if self.pid == os.getpid():
+                self.unsynced.append(path)
+        return True
+
+    def write(self, hash, data):
+        """Writes 'data' as object 'hash', unless it's already stored. Returns True
+            if it was new."""
+        if self.exists(hash):
+            freshen_object(hash)
+            return False
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(hash_to_path(hash)), prefix="tmp-")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            return self.add(temp_path, hash)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def forget(self, hash):
+        """Call when deleting a loose object."""
+        with self.lock:
+            if self.known is not None:
+                self.known.get(hash[:2], set()).discard(hash[2:])
+
+    def flush(self):
+        """fsyncs everything written so far (and the directories it's in)."""
+        with self.lock:
+            paths, self.unsynced = self.unsynced, []
+        if paths:
+            _fsync_paths(paths + sorted(set(os.path.dirname(path) for path in paths)))
+
+_object_writer = None
+
+@contextmanager
+def object_writer():
+    """Yields the current command's ObjectWriter, or makes one (flushing it at the
+        end) if there isn't one."""
+    global _object_writer
+    if _object_writer is not None:
+        yield _object_writer
+        return
+    _object_writer = ObjectWriter()
+    try:
+        yield _object_writer
+        _object_writer.flush()
+    finally:
+        _object_writer = None
+
+def flush_objects():
+    """Makes sure the objects written so far are on disk: call before updating
+        anything that points at them."""
+    if _object_writer is not None:
+        _object_writer.flush()
+
+def freshen_object(hash):
+    """Call when reusing a stored object instead of writing it: bumps the mtime of
+        its loose file (or its pack), so a concurrent gc sees it as recent and
+        leaves it alone until whatever is about to point at it does."""
+    try:
+        os.utime(hash_to_path(hash), None)
+        return
+    except OSError:
+        pass
+    for cur_pack in get_packs():
+        if hash in cur_pack:
+            os.utime(cur_pack.path, None)
+            return
+
+def forget_object(hash):
+    """Call after deleting a loose object, so it isn't mistaken for still stored."""
+    if _object_writer is not None:
+        _object_writer.forget(hash)
+
+def _fsync_paths(paths):
+    if not FSYNC_OBJECTS:
+        return
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+class ZlibReader(object):
+    """File-like wrapper that decompresses a zlib stream from 'f' as it's read."""
+    def __init__(self, f):
+        self.f = f
+        self.decompressor = zlib.decompressobj()
+        self.buffer = ""
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            data = self.f.read(BLOCK_SIZE)
+            if not data:
+                self.buffer += self.decompressor.flush()
+                break
+            self.buffer += self.decompressor.decompress(data)
+        if size < 0:
+            size = len(self.buffer)
+        result, self.buffer = self.buffer[:size], self.buffer[size:]
+        return result
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+@traced(size=lambda hash, args: len(args[0]))
 def make_hash(contents, type):
     """Return hash of the contents with type prepended."""
     # type -- tr (tree), bl (blob), co(commit)
@@ -321,52 +2263,1514 @@ def make_hash(contents, type):
     # e.g. tr/hash(contents) for a tree
     return '%s%s' % (type[:2], sha1(contents).hexdigest())
 
+@traced()
 def save_hash(contents, hash):
     """Save the contents at the given hash. """
 
-    path = os.path.join(OBJECTS_PATH, hash[:2], hash[2:])
-    with open(path, 'w') as f:
-        cPickle.dump(contents, f)
+    if object_exists(hash):
+        freshen_object(hash) # content-addressed: it's already there
+        return
+    if isinstance(contents, str) and hash.startswith("bl"):
+        save_blob_stream(BytesIO(contents))
+    elif isinstance(contents, dict):
+        save_encoded(encode_tree(contents), hash)
+    elif isinstance(contents, Commit):
+        save_encoded(encode_commit(contents), hash)
+    else:
+        raise TypeError("Can't save a %s" % type(contents).__name__)
+
+def save_encoded(data, hash):
+    """Save an already encoded tree or commit at the given hash (unless it's
+        already stored)."""
+    with object_writer() as writer, trace("save_encoded") as span:
+        span.bytes = len(data)
+        writer.write(hash, data)
+
+def save_file_blob(filename, compress=None, chunk=None):
+    """Saves the contents of the given file as a blob, a chunk at a time.
+        Returns the blob's hash. If 'chunk' (by default, if CHUNK_BLOBS is set
+        and the file is at least CHUNK_THRESHOLD bytes), it's stored as
+        content-defined chunks (see save_chunked_stream)."""
+    with open(filename, 'rb') as f:
+        if chunk is None:
+            chunk = CHUNK_BLOBS and os.fstat(f.fileno()).st_size >= CHUNK_THRESHOLD
+        if chunk:
+            return save_chunked_stream(f, compress)
+        return save_blob_stream(f, compress)
+
+def save_chunked_stream(f, compress=None):
+    """Saves everything read from file-like object 'f' as a chunked blob: each
+        content-defined chunk (see iter_chunks) is saved as a blob, unless it's
+        already stored, and the blob itself is just the list of its chunks.
+        Returns the blob's hash (the hash of the whole contents, as for any blob)."""
+    sha = sha1()
+    entries = []
+    for data in iter_chunks(f, CHUNK_MIN_SIZE, CHUNK_MAX_SIZE, CHUNK_BITS):
+        sha.update(data)
+        chunk_hash = make_hash(data, "blob")
+        save_hash(data, chunk_hash)
+        entries.append(CHUNK_ENTRY.pack(chunk_hash, len(data)))
+    hash = 'bl%s' % sha.hexdigest()
+    save_encoded(BLOB_CHUNKED_MAGIC + "".join(entries), hash)
+    return hash
+
+def iter_chunks(f, min_size=CHUNK_MIN_SIZE, max_size=CHUNK_MAX_SIZE, bits=CHUNK_BITS):
+    """Yields what's read from file-like object 'f' in content-defined chunks of
+        'min_size' to 'max_size' bytes (about 2**bits past the minimum, on average)."""
+    buf = ""
+    eof = False
+    while True:
+        if not eof and len(buf) < max_size:
+            data = f.read(max_size - len(buf))
+            eof = not data
+            buf += data
+            continue
+        if not buf:
+            return
+        cut = find_chunk_boundary(buf, min_size, max_size, bits)
+        yield buf[:cut]
+        buf = buf[cut:]
+
+def find_chunk_boundary(data, min_size=CHUNK_MIN_SIZE, max_size=CHUNK_MAX_SIZE,
+    bits=CHUNK_BITS):
+    """Returns where the first chunk of 'data' ends: at the first candidate past
+        'min_size' (bytes whose flags end in CHUNK_FLAG_PATTERN, about 1 in 2**8)
+        where the low 'bits' - 8 bits of the CRC of the 32 bytes before it are
+        all zero, or at 'max_size'."""
+    # a byte at a time in Python is slow (~8 MB/s), so each block's flags are
+    # worked out with translate and long arithmetic, and the regex finds the
+    # candidates: only those are looked at one by one
+    end = min(len(data), max_size)
+    if end <= min_size:
+        return end
+    mask = (1 << max(bits - len(CHUNK_FLAG_PATTERN), 0)) - 1
+    lookback = len(CHUNK_FLAG_PATTERN) + len(CHUNK_FLAG_TABLES) - 2
+    pos = min_size
+    while pos < end:
+        block_end = min(pos + CHUNK_SCAN_BLOCK, end)
+        start = max(pos - lookback, 0)
+        flags = _chunk_flags(data[start:block_end])
+        # flags at the start of the block don't know their previous bytes
+        first = max(pos - start - len(CHUNK_FLAG_PATTERN) + 1, len(CHUNK_FLAG_TABLES) - 1)
+        for match in CHUNK_FLAG_RE.finditer(flags, first):
+            cut = start + match.end()
+            if not zlib.crc32(data[max(cut - 32, 0):cut]) & mask:
+                return cut
+        pos = block_end
+    return end
+
+def _chunk_flags(data):
+    """Returns the flag of each byte of 'data' (see CHUNK_FLAG_TABLES), as a string
+        of "0"s and "1"s."""
+    bits = 0
+    for shift, table in enumerate(CHUNK_FLAG_TABLES):
+        bits ^= int(data.translate(table), 2) >> shift
+    return bin(bits)[2:].zfill(len(data))
+
+def decode_chunk_list(data):
+    """Returns the (hash, length) of each chunk listed in a chunked blob (with its
+        header already stripped)."""
+    return [CHUNK_ENTRY.unpack_from(data, offset)
+        for offset in xrange(0, len(data), CHUNK_ENTRY.size)]
+
+def blob_chunks(hash):
+    """Returns the (hash, length) of each of a blob's chunks, or None if it isn't
+        stored in chunks."""
+    f = open_object(hash, stream=True)
+    with f:
+        if f.read(len(BLOB_CHUNKED_MAGIC)) != BLOB_CHUNKED_MAGIC:
+            return None
+        return decode_chunk_list(f.read())
+
+class ChunkedReader(object):
+    """File-like object reading a chunked blob's chunks one after another."""
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.cur = None
+
+    def read(self, size=-1):
+        results = []
+        while size != 0:
+            if self.cur is None:
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    break
+                self.cur = read_hash(chunk[0], stream=True)
+            data = self.cur.read(size)
+            if not data:
+                self.cur.close()
+                self.cur = None
+                continue
+            results.append(data)
+            if size > 0:
+                size -= len(data)
+        return "".join(results)
+
+    def close(self):
+        if self.cur is not None:
+            self.cur.close()
+            self.cur = None
+        self.chunks = iter([])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def save_blob_stream(f, compress=None):
+    """Saves everything read from file-like object 'f' as a blob, hashing it as it's
+        written to a temp file, which then gets renamed into place. Memory use is
+        bounded by BLOCK_SIZE. Returns the blob's hash."""
+    if compress is None:
+        compress = COMPRESS_BLOBS
+    compressor = zlib.compressobj() if compress else None
+    sha = sha1()
+
+    fd, temp_path = tempfile.mkstemp(dir=BLOB_PATH, prefix="tmp-")
+    try:
+        with os.fdopen(fd, 'wb') as out, trace("save_blob_stream") as span:
+            out.write(BLOB_ZLIB_MAGIC if compress else BLOB_RAW_MAGIC)
+            for data in iter(lambda: f.read(BLOCK_SIZE), ""):
+                sha.update(data)
+                span.bytes += len(data)
+                out.write(compressor.compress(data) if compress else data)
+            if compress:
+                out.write(compressor.flush())
+        hash = 'bl%s' % sha.hexdigest()
+        with object_writer() as writer:
+            writer.add(temp_path, hash)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return hash
 
 def get_hash_of_file_contents(filename, type="blob"):
     """Returns a hash of the contents of the given file. Assumes a blob."""
-    with open(filename) as f:
-        contents = f.read()
-    return make_hash(contents, type)
+    with open(filename, 'rb') as f:
+        return hash_stream(f, type)
+
+def hash_stream(f, type="blob"):
+    """Like make_hash, but reads the contents from file-like object 'f' a chunk at
+        a time."""
+    sha = sha1()
+    with trace("hash_stream") as span:
+        for data in iter(lambda: f.read(BLOCK_SIZE), ""):
+            sha.update(data)
+            span.bytes += len(data)
+    return '%s%s' % (type[:2], sha.hexdigest())
 
 def get_hash_from_index(filename):
     """Given a file, looks up its hash in the index, returns result. If file not
         in index, raises error."""
-    with open(INDEX_PATH) as f:
-        try:
-            index_data = cPickle.load(f)
-        except EOFError:
-            index_data = {}
+    # binary search over the mmap'd index, so we only touch the entries we compare
+    with open(INDEX_PATH, 'rb') as f:
+        if not f.read(len(INDEX_MAGIC)) == INDEX_MAGIC:
+            # empty or old-style (pickled) index
+            index_data = read_index()
+            if filename not in index_data:
+                raise NoFileError("That file isn't in the index.")
+            return index_data[filename]
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
     try:
-        return index_data[filename]
-    except KeyError:
-        raise NoFileError("That file isn't in the index.")
+        _, _, count = INDEX_HEADER.unpack_from(buf)
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            path, hash, stat = _read_index_entry(buf, _index_entry_offset(buf, mid))
+            if path < filename:
+                lo = mid + 1
+            elif path > filename:
+                hi = mid
+            else:
+                return hash
+    finally:
+        buf.close()
+    raise NoFileError("That file isn't in the index.")
 
 def hash_to_path(hash):
     """Given a hash, turns it into the path to that file in the
         .goob/objects directory."""
     return os.path.join(OBJECTS_PATH, hash[:2], hash[2:])
 
+def get_stat_data(filename):
+    """Returns the stat data goob uses to tell whether a file has changed
+        since it was last hashed."""
+    st = os.stat(filename)
+    return StatData(st.st_mtime, st.st_ctime, st.st_size, st.st_ino)
+
 def read_index():
     """Returns the contents of the INDEX file. If INDEX is empty,
         returns an empty dict."""
-    with open(INDEX_PATH) as f:
+    return read_index_ext()[0]
+
+@traced()
+def read_index_ext():
+    """Like read_index, but also returns the index extensions: a dict of extra
+        cached data kept with the filename -> hash dict. extensions["stat"]
+        maps filename -> StatData as of the last time the file was hashed, and
+        extensions["tree"] maps directory -> tree hash for directories that
+        haven't changed since the last commit."""
+    with open(INDEX_PATH, 'rb') as f:
+        data = f.read()
+
+    index_data = {}
+    extensions = dict((name, {}) for name in INDEX_EXTENSIONS)
+    if not data:
+        return index_data, extensions
+    if not data.startswith(INDEX_MAGIC):
+        return _read_pickled_index(data)
+
+    if sha1(data[:-20]).digest() != data[-20:]:
+        raise BadIndexError("Index checksum doesn't match. Index is corrupt.")
+    magic, version, count = INDEX_HEADER.unpack_from(data)
+    if version != INDEX_VERSION:
+        raise BadIndexError("Unknown index version: %d" % version)
+
+    stat_cache = extensions["stat"]
+    offset = INDEX_HEADER.size + count * INDEX_OFFSET.size
+    for i in xrange(count):
+        path, hash, stat = _read_index_entry(data, offset)
+        index_data[path] = hash
+        if stat:
+            stat_cache[path] = stat
+        offset += INDEX_ENTRY.size + len(path)
+
+    # extensions: 4-byte signature, length, data
+    while offset < len(data) - 20:
+        signature, length = INDEX_EXTENSION_HEADER.unpack_from(data, offset)
+        offset += INDEX_EXTENSION_HEADER.size
+        if signature == "TREE":
+            tree_cache = extensions["tree"]
+            end = offset + length
+            while offset < end:
+                hash, path_len = INDEX_TREE_ENTRY.unpack_from(data, offset)
+                offset += INDEX_TREE_ENTRY.size
+                tree_cache[data[offset:offset + path_len]] = hash
+                offset += path_len
+        else:
+            offset += length # unknown extension, skip it
+    return index_data, extensions
+
+def _read_pickled_index(data):
+    """Reads an old-style index: the pickled filename -> hash dict, maybe followed
+        by pickled extensions."""
+    f = BytesIO(data)
+    index_data = cPickle.load(f)
+    try:
+        extensions = cPickle.load(f)
+    except EOFError:
+        extensions = {}
+    for name in INDEX_EXTENSIONS:
+        extensions.setdefault(name, {})
+    return index_data, extensions
+
+def _index_entry_offset(buf, i):
+    return INDEX_OFFSET.unpack_from(buf, INDEX_HEADER.size + i * INDEX_OFFSET.size)[0]
+
+def _read_index_entry(buf, offset):
+    """Returns (path, hash, StatData or None) of the index entry at offset."""
+    hash, mtime, ctime, size, inode, path_len = INDEX_ENTRY.unpack_from(buf, offset)
+    start = offset + INDEX_ENTRY.size
+    path = buf[start:start + path_len]
+    stat = StatData(mtime, ctime, size, inode) if size >= 0 else None
+    return path, hash, stat
+
+@traced()
+def write_index(contents, extensions=None):
+    """Writes 'contents' (presumably a dict. of filenames and hashes) to INDEX file,
+        along with the given index extensions (if any). The new index is written
+        to a temp file and renamed over the old one, so readers never see half
+        an index."""
+    extensions = extensions or {}
+    stat_cache = extensions.get("stat", {})
+    # racy timestamps: a file modified again in the same second as this index
+    # write would have the same mtime as the stat data we're about to save, so
+    # we couldn't tell it changed. Don't cache stat data that new; those files
+    # just get rehashed next time.
+    now = int(time.time())
+
+    entries = []
+    offsets = []
+    offset = INDEX_HEADER.size + len(contents) * INDEX_OFFSET.size
+    for path in sorted(contents):
+        stat = stat_cache.get(path)
+        if stat is None or stat.mtime >= now:
+            stat = NO_STAT
+        entry = INDEX_ENTRY.pack(contents[path], stat.mtime, stat.ctime, stat.size,
+            stat.inode, len(path)) + path
+        entries.append(entry)
+        offsets.append(INDEX_OFFSET.pack(offset))
+        offset += len(entry)
+
+    tree_cache = extensions.get("tree")
+    if tree_cache:
+        tree_data = "".join(INDEX_TREE_ENTRY.pack(hash, len(path)) + path
+            for path, hash in sorted(tree_cache.iteritems()))
+        entries.append(INDEX_EXTENSION_HEADER.pack("TREE", len(tree_data)) + tree_data)
+
+    data = INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(contents)) + \
+        "".join(offsets) + "".join(entries)
+    data += sha1(data).digest()
+
+    flush_objects()
+    fd, temp_path = tempfile.mkstemp(dir=REPO_PATH, prefix="index-")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(temp_path, INDEX_PATH)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def invalidate_tree_cache(tree_cache, filename):
+    """Forgets the cached trees of every directory containing the given file."""
+    dir = filename
+    while dir:
+        dir = os.path.dirname(dir)
+        tree_cache.pop(dir, None)
+
+# FILESYSTEM MONITOR
+# The watcher appends each path that changes to a journal. A token (watcher
+# session, offset in the journal) says how much of the journal status() has seen;
+# restarting the watcher starts a new session, which makes old tokens stale.
+
+IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+IN_DELETE_SELF, IN_MOVE_SELF, IN_Q_OVERFLOW, IN_IGNORED = 0x400, 0x800, 0x4000, 0x8000
+IN_ISDIR = 0x40000000
+INOTIFY_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+INOTIFY_EVENT = struct.Struct("iIII") # watch, mask, cookie, name length (then the name)
+
+class FSMonitor(object):
+    """Watches the working directory and journals changed paths (see watch())."""
+    def __init__(self, use_inotify=None):
+        self.libc = _load_inotify() if use_inotify is not False else None
+        if use_inotify and self.libc is None:
+            raise GoobError("inotify isn't available here.")
+        self.fd = None
+        self.watches = {} # inotify watch descriptor -> directory
+        self.snapshot = None
+        self.session = None
+
+    def start(self):
+        """Starts a new session: empties the journal and claims the watcher file."""
+        if not os.path.exists(FSMONITOR_PATH):
+            os.mkdir(FSMONITOR_PATH)
+        self.session = sha1(os.urandom(20)).hexdigest()[:16]
+        open(FSMONITOR_JOURNAL_PATH, "w").close()
+        fd, temp_path = tempfile.mkstemp(dir=FSMONITOR_PATH, prefix="tmp-")
+        with os.fdopen(fd, 'w') as f:
+            f.write("%d %s\n" % (os.getpid(), self.session))
+        os.rename(temp_path, FSMONITOR_WATCHER_PATH)
+
+        if self.libc:
+            if self.fd is not None:
+                os.close(self.fd)
+            self.fd = self.libc.inotify_init()
+            if self.fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init failed")
+            self.watches = {}
+            self._watch_tree("")
+        else:
+            self.snapshot = self._take_snapshot()
+
+    def is_current(self):
+        """False once another watcher has started, or stop_watching() was called."""
+        return _read_watcher() == (os.getpid(), self.session)
+
+    def stop(self):
+        if self.is_current():
+            os.remove(FSMONITOR_WATCHER_PATH)
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def record(self, paths):
+        if paths:
+            with open(FSMONITOR_JOURNAL_PATH, "a") as f:
+                f.write("".join(path + "\n" for path in paths))
+
+    def poll_once(self, timeout=0):
+        """Waits up to 'timeout' seconds for changes and journals them."""
+        if self.libc:
+            self._read_events(timeout)
+        else:
+            time.sleep(timeout)
+            snapshot = self._take_snapshot()
+            self.record(sorted(path for path in set(snapshot) | set(self.snapshot)
+                if snapshot.get(path) != self.snapshot.get(path)))
+            self.snapshot = snapshot
+
+    def _take_snapshot(self):
+        snapshot = {}
+        for filename in set(iter_working_files()) | set(read_index()):
+            try:
+                st = os.lstat(filename)
+            except OSError:
+                continue
+            snapshot[filename] = (st.st_mtime, st.st_ctime, st.st_size, st.st_ino)
+        return snapshot
+
+    def _watch_tree(self, top):
+        """Watches top and every (not ignored) directory under it. Returns the
+            files found, since they may have appeared before we were watching."""
+        found = []
+        wd = self.libc.inotify_add_watch(self.fd, top or ".", INOTIFY_MASK)
+        if wd < 0:
+            return found
+        self.watches[wd] = top
+        ignore_rules = IgnoreRules.for_dir(top)
+        for root, dirs, files in os.walk(top or "."):
+            root = os.path.normpath(root)
+            root = "" if root == "." else root
+            if os.path.exists(os.path.join(root, IGNORE_FILENAME)):
+                ignore_rules = IgnoreRules.for_dir(root)
+            dirs[:] = [dir for dir in dirs if dir != ".goob" and
+                not ignore_rules.is_ignored(os.path.join(root, dir), True)]
+            found.extend(os.path.join(root, file) for file in files)
+            for dir in dirs:
+                path = os.path.join(root, dir)
+                wd = self.libc.inotify_add_watch(self.fd, path, INOTIFY_MASK)
+                if wd >= 0:
+                    self.watches[wd] = path
+        return found
+
+    def _read_events(self, timeout):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return
+        data = os.read(self.fd, 64 * 1024)
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip("\x00")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # we've lost track of what changed: make everyone do a full scan
+                self.start()
+                return
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            dir = self.watches.get(wd)
+            if dir is None or (not dir and name == ".goob"):
+                continue
+            path = os.path.join(dir, name) if name else dir
+            paths.append(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and \
+                    not is_path_ignored(path):
+                paths.extend(self._watch_tree(path))
+        self.record(paths)
+
+def _load_inotify():
+    """Returns libc if it has inotify (i.e. we're on Linux), else None."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, "inotify_init") or not hasattr(libc, "inotify_add_watch"):
+        return None
+    return libc
+
+def _read_watcher():
+    """Returns (pid, session) of the watcher, or None if there isn't one."""
+    try:
+        with open(FSMONITOR_WATCHER_PATH) as f:
+            pid, session = f.read().split()
+        return int(pid), session
+    except (IOError, ValueError):
+        return None
+
+def fsmonitor_token():
+    """Returns (session, journal offset) if a watcher is running, else None."""
+    watcher = _read_watcher()
+    if watcher is None:
+        return None
+    pid, session = watcher
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno != errno.EPERM:
+            return None # watcher died
+    try:
+        with open(FSMONITOR_JOURNAL_PATH, 'rb') as f:
+            data = f.read()
+    except IOError:
+        return None
+    # only count whole lines; the watcher may be partway through writing one
+    return session, data.rfind("\n") + 1
+
+def read_fsmonitor_journal(start, end):
+    """Returns the set of paths journaled between the two offsets."""
+    with open(FSMONITOR_JOURNAL_PATH, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return set(path for path in data.split("\n") if path)
+
+def index_checksum():
+    """Returns the checksum at the end of the index (or its size, for an empty or
+        old-style index), which changes whenever the index does."""
+    with open(INDEX_PATH, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size < 20:
+            return str(size)
+        f.seek(-20, os.SEEK_END)
+        return f.read().encode("hex")
+
+def save_fsmonitor_state(token, head, cur_status):
+    """Saves what status() found, and as of which token, for next time."""
+    lines = ["token %s %d" % token, "head %s" % head, "index %s" % index_checksum()]
+    for attr, filenames in sorted(vars(cur_status).iteritems()):
+        lines.extend("%s\t%s" % (attr, filename) for filename in filenames)
+    fd, temp_path = tempfile.mkstemp(dir=FSMONITOR_PATH, prefix="tmp-")
+    with os.fdopen(fd, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    os.rename(temp_path, FSMONITOR_STATE_PATH)
+
+def load_fsmonitor_state():
+    """Returns (token, head, index checksum, Status) saved by the last status(), or
+        None."""
+    try:
+        with open(FSMONITOR_STATE_PATH) as f:
+            lines = f.read().splitlines()
+    except IOError:
+        return None
+    _, session, offset = lines[0].split(" ")
+    head = lines[1][len("head "):]
+    checksum = lines[2][len("index "):]
+    cur_status = Status()
+    for line in lines[3:]:
+        attr, filename = line.split("\t", 1)
+        getattr(cur_status, attr).append(filename)
+    return (session, int(offset)), head, checksum, cur_status
+
+def mark_reachable(sorter, missing=None):
+    """Adds the hash of every object reachable from HEAD or the index to 'sorter'
+        (a HashSorter). The last GC_SEEN_SIZE trees and commits walked are
+        remembered, so shared subtrees are mostly read just once (a forgotten
+        one is walked again); blobs, the bulk of any repo, are only kept in
+        'sorter'.
+        If a 'missing' list is given, referenced objects that aren't stored are
+        added to it (instead of raising BadHashError), and ones that can't be
+        read are skipped."""
+    seen = LRUCache(GC_SEEN_SIZE)
+
+    def read(hash):
+        try:
+            return read_hash(hash)
+        except BadHashError:
+            if missing is None:
+                raise
+            missing.append(hash)
+        except Exception:
+            if missing is None:
+                raise
+            # corrupt: fsck reports it when rehashing
+        return None
+
+    def mark_blob(hash):
+        sorter.add(hash)
+        if missing is not None and not object_exists(hash):
+            missing.append(hash)
+            return
         try:
-            index_data = cPickle.load(f)
-        except EOFError:
-            index_data = {}
-    return index_data
+            chunks = blob_chunks(hash)
+        except BadHashError:
+            if missing is None:
+                raise
+            chunks = None
+        for chunk_hash, _ in chunks or []:
+            mark_blob(chunk_hash)
+
+    def mark_tree(tree_hash):
+        if seen.get(tree_hash):
+            return
+        seen.add(tree_hash, True)
+        sorter.add(tree_hash)
+        tree = read(tree_hash)
+        for hash, obj_type in (tree or {}).itervalues():
+            if obj_type == "tree":
+                mark_tree(hash)
+            else:
+                mark_blob(hash)
+
+    commit_hash = get_cur_head()
+    if commit_hash and missing is None and os.path.exists(BITMAPS_PATH):
+        # the bitmaps already know what the history reaches
+        bitmaps = Bitmaps.load()
+        for hash in bitmaps.hashes_of(bitmaps.reachable(commit_hash)):
+            sorter.add(hash)
+            if not hash.startswith("bl"):
+                seen.add(hash, True)
+        commit_hash = None
+    while commit_hash and not seen.get(commit_hash):
+        seen.add(commit_hash, True)
+        sorter.add(commit_hash)
+        cur_commit = read(commit_hash)
+        if cur_commit is None:
+            break
+        mark_tree(cur_commit.tree_hash)
+        commit_hash = cur_commit.parent
+
+    index_data, extensions = read_index_ext()
+    for hash in index_data.itervalues():
+        mark_blob(hash)
+    # cached trees get reused by the next commit, so they have to stay
+    for hash in extensions["tree"].itervalues():
+        mark_tree(hash)
+
+class HashSorter(object):
+    """Collects hashes, and iterates over them sorted and without duplicates. Only
+        'run_size' hashes are held in memory at a time: beyond that, they're
+        sorted and spilled to temp files, which get merged when iterating."""
+    def __init__(self, run_size=GC_RUN_SIZE):
+        self.run_size = run_size
+        self.buffer = []
+        self.runs = []
+
+    def add(self, hash):
+        self.buffer.append(hash)
+        if len(self.buffer) >= self.run_size:
+            self._spill()
+
+    def _spill(self):
+        run = tempfile.TemporaryFile(dir=REPO_PATH)
+        run.write("".join(hash + "\n" for hash in sorted(set(self.buffer))))
+        self.runs.append(run)
+        self.buffer = []
+
+    def _read_run(self, run):
+        run.seek(0)
+        for line in run:
+            yield line[:-1]
+
+    def __iter__(self):
+        last = None
+        runs = [self._read_run(run) for run in self.runs]
+        for hash in heapq.merge(sorted(set(self.buffer)), *runs):
+            if hash != last:
+                yield hash
+                last = hash
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+
+def sorted_difference(hashes, exclude):
+    """Yields the hashes in sorted iterable 'hashes' that aren't in sorted iterable
+        'exclude', merging the two."""
+    exclude = iter(exclude)
+    cur = next(exclude, None)
+    for hash in hashes:
+        while cur is not None and cur < hash:
+            cur = next(exclude, None)
+        if hash != cur:
+            yield hash
+
+def sorted_intersection(hashes, include):
+    """Yields the hashes in sorted iterable 'hashes' that are also in sorted iterable
+        'include', merging the two."""
+    include = iter(include)
+    cur = next(include, None)
+    for hash in hashes:
+        while cur is not None and cur < hash:
+            cur = next(include, None)
+        if hash == cur:
+            yield hash
+
+# TRACING
+# Off unless GOOB_TRACE is set (to "summary" for a table on stderr, or to a file
+# name for a Chrome trace -- load it in chrome://tracing) or enable_tracing() is
+# called. Each command, and the hot paths inside it, are recorded as spans.
+
+TRACE_ENV = "GOOB_TRACE"
+
+class TraceSpan(object):
+    def __init__(self):
+        self.bytes = 0
+
+class Tracer(object):
+    """Counts calls, bytes and wall time per operation, and keeps each call as a
+        Chrome trace event if it's going to write a trace file. Times are
+        inclusive: a command's time includes everything it called."""
+    def __init__(self, output="summary"):
+        self.output = output
+        self.stats = OrderedDict() # operation -> [calls, bytes, seconds]
+        self.events = []
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def record(self, name, start, seconds, size=0):
+        with self.lock:
+            stats = self.stats.setdefault(name, [0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += size
+            stats[2] += seconds
+            if self.output != "summary":
+                self.events.append({"name": name, "ph": "X", "pid": os.getpid(),
+                    "tid": threading.current_thread().ident,
+                    "ts": (start - self.start) * 1e6, "dur": seconds * 1e6,
+                    "args": {"bytes": size}})
 
-def write_index(contents):
-    """Writes 'contents' (presumably a dict. of filenames and hashes) to INDEX file."""
-    with open(INDEX_PATH, 'w') as f:
-            cPickle.dump(contents, f)
+    def __str__(self):
+        results = ["%-20s %8s %12s %10s" % ("operation", "calls", "bytes", "seconds")]
+        for name, (calls, size, seconds) in sorted(self.stats.iteritems(),
+                key=lambda item: -item[1][2]):
+            results.append("%-20s %8d %12d %10.4f" % (name, calls, size, seconds))
+        return "\n".join(results)
 
+    def dump(self):
+        """Prints the summary to stderr, or writes the Chrome trace file."""
+        if self.output == "summary":
+            print >>sys.stderr, self
+        else:
+            with open(self.output, 'w') as f:
+                json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+_tracer = None
+
+def enable_tracing(output="summary"):
+    """Starts tracing every command from now on (until disable_tracing()). Returns
+        the Tracer, whose 'stats' can be read at any point."""
+    global _tracer
+    _tracer = Tracer(output)
+    return _tracer
+
+def disable_tracing():
+    """Stops tracing. Returns the Tracer (call its dump() for the results), or None."""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+@contextmanager
+def trace(name):
+    """Records the enclosed block as one call of operation 'name'. Yields a span;
+        add to its 'bytes' to count bytes."""
+    tracer = _tracer
+    span = TraceSpan()
+    if tracer is None:
+        yield span
+        return
+    start = time.time()
+    try:
+        yield span
+    finally:
+        tracer.record(name, start, time.time() - start, span.bytes)
+
+@contextmanager
+def trace_command(name):
+    """Traces a command. If GOOB_TRACE is set and tracing isn't already on, the
+        command gets a Tracer of its own, dumped when it finishes."""
+    global _tracer
+    owned = _tracer is None and bool(os.environ.get(TRACE_ENV))
+    if owned:
+        output = os.environ[TRACE_ENV]
+        _tracer = Tracer("summary" if output in ("1", "summary") else output)
+    try:
+        with trace(name):
+            yield
+    finally:
+        if owned:
+            disable_tracing().dump()
+
+def list_loose_objects():
+    """Returns the hashes of all loose (unpacked) objects."""
+    return list(iter_loose_objects())
+
+def iter_loose_objects():
+    """Yields the hashes of all loose objects, one object directory at a time."""
+    for path in LOOSE_PATHS:
+        prefix = os.path.basename(path)
+        for filename in os.listdir(path):
+            if not filename.startswith("tmp-"):
+                yield prefix + filename
+
+class Pack(object):
+    """A pack and its index, both mmap'd. 'hash in pack' is a binary search over
+        the index."""
+    def __init__(self, idx_path):
+        self.idx_path = idx_path
+        self.path = idx_path[:-len(".idx")] + ".pack"
+        with open(self.idx_path, 'rb') as f:
+            self.idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(self.path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count = PACK_HEADER.unpack_from(self.idx)
+        if magic != PACK_IDX_MAGIC or version != PACK_VERSION:
+            raise GoobError("Bad pack index: %s" % idx_path)
+
+    def _hash_at(self, i):
+        start = PACK_HEADER.size + i * PACK_IDX_ENTRY.size
+        return self.idx[start:start + 42]
+
+    def find(self, hash):
+        """Returns (offset, length) of the entry for the given hash, or None."""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._hash_at(mid) < hash:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self._hash_at(lo) == hash:
+            _, offset, length = PACK_IDX_ENTRY.unpack_from(self.idx,
+                PACK_HEADER.size + lo * PACK_IDX_ENTRY.size)
+            return offset, length
+        return None
+
+    def __contains__(self, hash):
+        return self.find(hash) is not None
+
+    def hashes(self):
+        return [self._hash_at(i) for i in xrange(self.count)]
+
+    def iter_hashes(self):
+        """Yields the pack's hashes in order, reading them from the index as it goes."""
+        for i in xrange(self.count):
+            yield self._hash_at(i)
+
+    def read_entry(self, hash):
+        """Returns (kind, payload) of the entry for the given hash."""
+        offset, length = self.find(hash)
+        return self.data[offset], self.data[offset + 1:offset + length]
+
+    def read_object(self, hash):
+        """Returns the stored (encoded) bytes of the object with the given hash,
+            applying deltas if need be."""
+        kind, payload = self.read_entry(hash)
+        if kind == PACK_FULL:
+            return payload
+
+        # walk down the delta chain to the nearest full (or cached) base...
+        chain = []
+        while kind == PACK_DELTA:
+            chain.append((hash, payload[42:]))
+            hash = payload[:42]
+            data = delta_base_cache.get(hash)
+            if data is not None:
+                break
+            kind, payload = self.read_entry(hash)
+        else:
+            data = payload
+        # ...then back up it, caching each object rebuilt along the way
+        for hash, delta in reversed(chain):
+            data = apply_delta(data, delta)
+            delta_base_cache.add(hash, data)
+        return data
+
+    def open_object(self, hash):
+        """Like read_object, but returns a file-like object reading from the pack."""
+        offset, length = self.find(hash)
+        if self.data[offset] == PACK_DELTA:
+            return BytesIO(self.read_object(hash))
+        f = open(self.path, 'rb')
+        f.seek(offset + 1)
+        return BoundedReader(f, length - 1)
+
+    def close(self):
+        self.idx.close()
+        self.data.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.idx_path)
+        os.remove(self.path)
+
+class BoundedReader(object):
+    """File-like wrapper that reads at most 'length' bytes from 'f'."""
+    def __init__(self, f, length):
+        self.f = f
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self):
+        data = self.f.readline(self.remaining)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+_packs = {"key": None, "packs": []}
+
+def get_packs():
+    """Returns a Pack for each pack in the repo. Packs stay open (and mmap'd)
+        until the pack directory changes."""
+    try:
+        key = (os.path.abspath(PACK_PATH), os.stat(PACK_PATH).st_mtime)
+    except OSError:
+        # repo made before packs existed
+        return []
+    if _packs["key"] != key:
+        for old_pack in _packs["packs"]:
+            old_pack.close()
+        _packs["packs"] = [Pack(os.path.join(PACK_PATH, filename))
+            for filename in sorted(os.listdir(PACK_PATH)) if filename.endswith(".idx")]
+        _packs["key"] = key
+    return _packs["packs"]
+
+def forget_packs():
+    """Makes the next get_packs() reread the pack directory."""
+    _packs["key"] = None
+
+def write_pack(hashes, delta=False, window=DELTA_WINDOW, max_depth=DELTA_MAX_DEPTH,
+        pack_dir=None, count=None):
+    """Writes the objects with the given (sorted) hashes to a new pack, deltifying
+        blobs if 'delta'. The pack goes in 'pack_dir' (default: this repo's pack
+        directory). 'hashes' may be any iterable, if 'count' says how many
+        there are; they're only read once (unless 'delta'). Returns the pack's
+        name."""
+    pack_dir = pack_dir or PACK_PATH
+    if not os.path.exists(pack_dir):
+        os.mkdir(pack_dir)
+    if count is None:
+        count = len(hashes)
+
+    deltas = {}
+    if delta:
+        hashes = list(hashes)
+        deltas = find_deltas([hash for hash in hashes if hash.startswith("bl")],
+            window, max_depth)
+    bases = set(base_hash for base_hash, _ in deltas.itervalues())
+
+    sha = sha1()
+    # the index entries go straight to the .idx's temp file, not into memory
+    idx_fd, idx_temp_path = tempfile.mkstemp(dir=pack_dir, prefix="tmp-")
+    fd, temp_path = tempfile.mkstemp(dir=pack_dir, prefix="tmp-")
+    with os.fdopen(fd, 'wb') as out, os.fdopen(idx_fd, 'wb') as idx:
+        idx.write(PACK_HEADER.pack(PACK_IDX_MAGIC, PACK_VERSION, count))
+        header = PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION, count)
+        out.write(header)
+        sha.update(header)
+        offset = len(header)
+        for hash in hashes:
+            if hash in deltas:
+                kind, f = PACK_DELTA, BytesIO("".join(deltas[hash]))
+            elif hash in bases:
+                # deltas were made against the uncompressed form of their bases
+                kind, f = PACK_FULL, BytesIO(_raw_blob(hash))
+            else:
+                kind, f = PACK_FULL, open_object(hash, stream=True)
+            length = 1
+            out.write(kind)
+            sha.update(kind)
+            with f:
+                for data in iter(lambda: f.read(BLOCK_SIZE), ""):
+                    out.write(data)
+                    sha.update(data)
+                    length += len(data)
+            idx.write(PACK_IDX_ENTRY.pack(hash, offset, length))
+            offset += length
+
+    # pack() and gc() delete what the pack replaces straight after, so it had
+    # better be on disk (see FSYNC_OBJECTS) by then
+    name = "pack-%s" % sha.hexdigest()
+    _fsync_paths([temp_path])
+    os.rename(temp_path, os.path.join(pack_dir, name + ".pack"))
+    # the .idx goes in last: packs aren't visible until it exists
+    _fsync_paths([idx_temp_path])
+    os.rename(idx_temp_path, os.path.join(pack_dir, name + ".idx"))
+    _fsync_paths([pack_dir])
+    forget_packs()
+    return name
+
+def find_deltas(hashes, window=DELTA_WINDOW, max_depth=DELTA_MAX_DEPTH):
+    """Picks a delta base for each of the given blobs where that saves space.
+        Blobs are sorted by name then size (biggest first), so versions of the
+        same file end up next to each other, and each one is tried against the
+        'window' blobs before it. Chains of deltas are kept to 'max_depth'.
+        Returns a dict of hash -> (base hash, delta)."""
+    names = _blob_names()
+    # chunked blobs share their chunks already
+    hashes = [hash for hash in hashes if blob_chunks(hash) is None]
+    sizes = {}
+    for hash in hashes:
+        with read_hash(hash, stream=True) as f:
+            sizes[hash] = _stream_size(f)
+    candidates = sorted([hash for hash in hashes if sizes[hash] <= DELTA_MAX_SIZE],
+        key=lambda hash: (os.path.basename(names.get(hash, "")), names.get(hash, ""),
+            -sizes[hash]))
+
+    deltas = {}
+    depths = {}
+    recent = [] # (hash, raw data) of the last 'window' blobs
+    for hash in candidates:
+        data = _raw_blob(hash)
+        best = None
+        for base_hash, base_data in recent:
+            if depths.get(base_hash, 0) >= max_depth:
+                continue
+            # the delta has to insert whatever the base is short by, so a base
+            # under half the size can never halve it
+            if len(base_data) < len(data) // 2:
+                continue
+            delta = make_delta(base_data, data)
+            # not worth it unless it at least halves the size
+            if len(delta) < len(data) // 2 and (best is None or len(delta) < len(best[1])):
+                best = (base_hash, delta)
+        if best:
+            deltas[hash] = best
+            depths[hash] = depths.get(best[0], 0) + 1
+        recent.append((hash, data))
+        if len(recent) > window:
+            recent.pop(0)
+    return deltas
+
+def _raw_blob(hash):
+    """Returns the blob with the given hash in its uncompressed stored form."""
+    return BLOB_RAW_MAGIC + read_hash(hash)
+
+def _stream_size(f):
+    size = 0
+    for data in iter(lambda: f.read(BLOCK_SIZE), ""):
+        size += len(data)
+    return size
+
+def _blob_names():
+    """Returns a dict of blob hash -> a path that blob has been stored at, from the
+        index and every commit's tree."""
+    names = dict((hash, filename) for filename, hash in read_index().iteritems())
+    seen_trees = set()
+    def visit(tree_hash, prefix):
+        seen_trees.add(tree_hash)
+        for filename, (hash, obj_type) in read_hash(tree_hash).iteritems():
+            path = os.path.join(prefix, filename)
+            if obj_type == "blob":
+                names.setdefault(hash, path)
+            elif hash not in seen_trees:
+                visit(hash, path)
+
+    commit_hash = get_cur_head()
+    while commit_hash:
+        cur_commit = read_hash(commit_hash)
+        if cur_commit.tree_hash not in seen_trees:
+            visit(cur_commit.tree_hash, "")
+        commit_hash = cur_commit.parent
+    return names
+
+def make_delta(base, target):
+    """Returns a delta that turns 'base' into 'target' (see apply_delta)."""
+    index = {}
+    for offset in xrange(0, len(base) - DELTA_BLOCK + 1, DELTA_BLOCK):
+        index.setdefault(base[offset:offset + DELTA_BLOCK], offset)
+
+    ops = []
+    def insert(data):
+        if data:
+            ops.append(DELTA_INSERT.pack("i", len(data)))
+            ops.append(data)
+
+    insert_start = i = 0
+    while i + DELTA_BLOCK <= len(target):
+        offset = index.get(target[i:i + DELTA_BLOCK])
+        if offset is None:
+            i += 1
+            continue
+        start = i
+        # grow the match backwards (into bytes we'd otherwise insert)...
+        while start > insert_start and offset > 0 and target[start - 1] == base[offset - 1]:
+            start -= 1
+            offset -= 1
+        # ...and forwards, a block at a time then a byte at a time
+        end = i + DELTA_BLOCK
+        base_end = offset + (end - start)
+        while end + DELTA_BLOCK <= len(target) and \
+                target[end:end + DELTA_BLOCK] == base[base_end:base_end + DELTA_BLOCK]:
+            end += DELTA_BLOCK
+            base_end += DELTA_BLOCK
+        while end < len(target) and base_end < len(base) and target[end] == base[base_end]:
+            end += 1
+            base_end += 1
+        insert(target[insert_start:start])
+        ops.append(DELTA_COPY.pack("c", offset, end - start))
+        insert_start = i = end
+    insert(target[insert_start:])
+    return "".join(ops)
+
+def apply_delta(base, delta):
+    """Rebuilds the target of the given delta from its base."""
+    results = []
+    i = 0
+    while i < len(delta):
+        if delta[i] == "c":
+            _, offset, length = DELTA_COPY.unpack_from(delta, i)
+            results.append(base[offset:offset + length])
+            i += DELTA_COPY.size
+        else:
+            _, length = DELTA_INSERT.unpack_from(delta, i)
+            i += DELTA_INSERT.size
+            results.append(delta[i:i + length])
+            i += length
+    return "".join(results)
+
+def _object_size(value):
+    """Roughly how many bytes a decoded object takes up in memory."""
+    if isinstance(value, str):
+        return len(value)
+    elif isinstance(value, dict): # a tree: name -> ObjectHash, each a few hundred bytes
+        return sum(len(name) + 250 for name in value)
+    elif isinstance(value, Commit):
+        return len(value.msg) + len(value.author) + 500
+    return sys.getsizeof(value)
+
+class LRUCache(object):
+    """Dict-ish cache that drops the least recently used items once their total
+        size goes over 'max_size'. Each item's size is sizeof(value) (or 1, so
+        by default max_size is a number of items). Counts hits and misses.
+        Safe to share between threads (checkout's workers read objects)."""
+    def __init__(self, max_size, sizeof=None):
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.pop(key, None)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.items[key] = value # most recently used goes last
+            return value
+
+    def add(self, key, value):
+        size = self.sizeof(value)
+        with self.lock:
+            if size > self.max_size or key in self.items:
+                return
+            self.items[key] = value
+            self.size += size
+            while self.size > self.max_size:
+                _, old = self.items.popitem(last=False)
+                self.size -= self.sizeof(old)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        return "%d items, %d hits, %d misses (%.1f%% hit rate)" % (len(self), self.hits,
+            self.misses, 100.0 * self.hits / lookups if lookups else 0)
+
+delta_base_cache = LRUCache(DELTA_CACHE_BYTES, sizeof=len)
+object_cache = LRUCache(OBJECT_CACHE_BYTES, sizeof=_object_size)
+
+class CommitGraph(object):
+    """The commit graph (see COMMIT_GRAPH_RECORD): parent, tree, timestamp and
+        generation for every commit we know of, without reading the commits."""
+    def __init__(self, records):
+        self.records = records # (hash, tree hash, parent position, timestamp, generation)
+        self.positions = dict((record[0], i) for i, record in enumerate(records))
+
+    @classmethod
+    def load(cls):
+        records = []
+        if os.path.exists(COMMIT_GRAPH_PATH):
+            with open(COMMIT_GRAPH_PATH, 'rb') as f:
+                data = f.read()
+            magic, version = COMMIT_GRAPH_HEADER.unpack_from(data)
+            if magic != COMMIT_GRAPH_MAGIC or version != COMMIT_GRAPH_VERSION:
+                raise GoobError("Bad commit graph.")
+            # a half-written record at the end (from a crash) is just ignored
+            for offset in xrange(COMMIT_GRAPH_HEADER.size,
+                    len(data) - COMMIT_GRAPH_RECORD.size + 1, COMMIT_GRAPH_RECORD.size):
+                records.append(COMMIT_GRAPH_RECORD.unpack_from(data, offset))
+        return cls(records)
+
+    @classmethod
+    def for_head(cls):
+        """Loads the commit graph, first adding any commits in the current history
+            it's missing (e.g. the repo predates commit graphs)."""
+        graph = cls.load()
+        graph.add(get_cur_head())
+        return graph
+
+    def __contains__(self, commit_hash):
+        return commit_hash in self.positions
+
+    def __len__(self):
+        return len(self.records)
+
+    def _entry(self, i):
+        commit_hash, tree_hash, parent, timestamp, generation = self.records[i]
+        parent = self.records[parent][0] if parent != NO_PARENT else None
+        return LogEntry(commit_hash, tree_hash, parent, timestamp, generation)
+
+    def get(self, commit_hash):
+        """Returns the LogEntry for the given commit, or None if it isn't in the graph."""
+        i = self.positions.get(commit_hash)
+        return self._entry(i) if i is not None else None
+
+    def walk(self, commit_hash):
+        """Yields LogEntry's for the given commit and its ancestors, newest first."""
+        i = self.positions.get(commit_hash)
+        while i is not None and i != NO_PARENT:
+            yield self._entry(i)
+            i = self.records[i][2]
+
+    def add(self, commit_hash):
+        """Adds the given commit, and any of its ancestors that are missing, to the
+            graph (reading just those commits), and appends them to the file."""
+        missing = []
+        while commit_hash and commit_hash not in self.positions:
+            cur_commit = read_hash(commit_hash)
+            missing.append((commit_hash, cur_commit))
+            commit_hash = cur_commit.parent
+        if not missing:
+            return
+
+        new_records = []
+        for commit_hash, cur_commit in reversed(missing):
+            parent = self.positions.get(cur_commit.parent, NO_PARENT)
+            generation = self.records[parent][4] + 1 if parent != NO_PARENT else 1
+            record = (commit_hash, cur_commit.tree_hash, parent,
+                commit_epoch(cur_commit), generation)
+            self.positions[commit_hash] = len(self.records)
+            self.records.append(record)
+            new_records.append(COMMIT_GRAPH_RECORD.pack(*record))
+
+        if not os.path.exists(COMMIT_GRAPH_PATH):
+            self.write()
+        else:
+            with open(COMMIT_GRAPH_PATH, 'r+b') as f:
+                # drop any half-written record before appending
+                f.seek(0, os.SEEK_END)
+                f.truncate(COMMIT_GRAPH_HEADER.size + (f.tell() - COMMIT_GRAPH_HEADER.size)
+                    // COMMIT_GRAPH_RECORD.size * COMMIT_GRAPH_RECORD.size)
+                f.seek(0, os.SEEK_END)
+                f.write("".join(new_records))
+
+    def write(self):
+        """Rewrites the whole commit graph file."""
+        fd, temp_path = tempfile.mkstemp(dir=REPO_PATH, prefix="commit-graph-")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(COMMIT_GRAPH_HEADER.pack(COMMIT_GRAPH_MAGIC, COMMIT_GRAPH_VERSION))
+            f.write("".join(COMMIT_GRAPH_RECORD.pack(*record) for record in self.records))
+        os.rename(temp_path, COMMIT_GRAPH_PATH)
+
+class PathFilters(object):
+    """The path filters (see PATH_FILTER_RECORD): a Bloom filter per commit of the
+        paths it changed."""
+    def __init__(self, records):
+        self.records = records # (commit hash, filter bytes), by commit graph position
+
+    @classmethod
+    def load(cls):
+        records = []
+        if os.path.exists(PATH_FILTERS_PATH):
+            with open(PATH_FILTERS_PATH, 'rb') as f:
+                data = f.read()
+            magic, version = PATH_FILTER_HEADER.unpack_from(data)
+            if magic != PATH_FILTER_MAGIC or version != PATH_FILTER_VERSION:
+                raise GoobError("Bad path filters.")
+            for offset in xrange(PATH_FILTER_HEADER.size,
+                    len(data) - PATH_FILTER_RECORD.size + 1, PATH_FILTER_RECORD.size):
+                records.append(PATH_FILTER_RECORD.unpack_from(data, offset))
+        return cls(records)
+
+    def get(self, position, commit_hash):
+        """Returns the filter for the commit at the given graph position, or None if
+            there isn't one (or it's stale)."""
+        if position < len(self.records) and self.records[position][0] == commit_hash:
+            return self.records[position][1]
+        return None
+
+    @staticmethod
+    def _bits(path):
+        # double hashing: the i'th bit is h1 + i * h2
+        h1, h2 = struct.unpack_from(">II", sha1(path).digest())
+        return [(h1 + i * h2) % PATH_FILTER_BITS for i in xrange(PATH_FILTER_HASHES)]
+
+    @staticmethod
+    def make(paths):
+        """Returns a filter holding the given paths (or matching everything, if
+            there are more than PATH_FILTER_MAX_PATHS)."""
+        if len(paths) > PATH_FILTER_MAX_PATHS:
+            return "\xff" * (PATH_FILTER_BITS // 8)
+        bits = bytearray(PATH_FILTER_BITS // 8)
+        for path in paths:
+            for bit in PathFilters._bits(path):
+                bits[bit // 8] |= 1 << (bit % 8)
+        return str(bits)
+
+    @staticmethod
+    def might_contain(path_filter, path):
+        """False if the path definitely isn't in the filter."""
+        return all(ord(path_filter[bit // 8]) & (1 << (bit % 8))
+            for bit in PathFilters._bits(path))
+
+class Bitmaps(object):
+    """The reachability bitmaps (see BITMAP_RECORD). A bitmap is a Python long, with
+        bit i set if self.hashes[i] is reachable, so set operations on them are
+        just |, & and ~. Commits without a stored bitmap start from their
+        nearest ancestor with one and add what each commit since added; any
+        objects that aren't in the list yet are appended (in memory, until
+        write())."""
+    def __init__(self, hashes, stored):
+        self.hashes = hashes
+        self.positions = dict((hash, i) for i, hash in enumerate(hashes))
+        self.stored = stored # commit -> zlib'd bitmap, as in the file
+        self.cache = {} # commit -> bitmap
+
+    @classmethod
+    def load(cls):
+        hashes, stored = [], OrderedDict()
+        if os.path.exists(BITMAPS_PATH):
+            with open(BITMAPS_PATH, 'rb') as f:
+                data = f.read()
+            magic, version, count, bitmap_count = BITMAP_HEADER.unpack_from(data)
+            if magic != BITMAP_MAGIC or version != BITMAP_VERSION:
+                raise GoobError("Bad bitmaps.")
+            offset = BITMAP_HEADER.size
+            hashes = [data[i:i + 42] for i in xrange(offset, offset + count * 42, 42)]
+            offset += count * 42
+            for _ in xrange(bitmap_count):
+                commit_hash, length = BITMAP_RECORD.unpack_from(data, offset)
+                offset += BITMAP_RECORD.size
+                stored[commit_hash] = data[offset:offset + length]
+                offset += length
+        return cls(hashes, stored)
+
+    def get(self, commit_hash):
+        """Returns the stored bitmap for the given commit, or None."""
+        bits = self.cache.get(commit_hash)
+        if bits is None and commit_hash in self.stored:
+            data = zlib.decompress(self.stored[commit_hash])
+            bits = self.cache[commit_hash] = int(binascii.hexlify(data), 16) if data else 0
+        return bits
+
+    def walk_new(self, commit_hash, graph):
+        """Yields LogEntry's for the given commit and its ancestors, newest first,
+            stopping before the first one with a stored bitmap."""
+        graph.add(commit_hash)
+        for entry in graph.walk(commit_hash):
+            if entry.hash in self.stored:
+                break
+            yield entry
+
+    def reachable(self, commit_hash, graph=None):
+        """Returns the bitmap of the objects reachable from the given commit."""
+        bits = self.cache.get(commit_hash)
+        if bits is not None:
+            return bits
+        graph = graph or CommitGraph.load()
+        new = list(self.walk_new(commit_hash, graph))
+        parent = new[-1].parent if new else commit_hash
+        bits = self.get(parent) if parent else 0
+        for entry in reversed(new):
+            objects = set([entry.hash])
+            _collect_new_objects(entry.tree_hash,
+                graph.get(entry.parent).tree_hash if entry.parent else None, objects)
+            bits |= self.bits_of(objects)
+        self.cache[commit_hash] = bits
+        return bits
+
+    def bits_of(self, hashes):
+        """Returns the bitmap of the given hashes, listing any that are new."""
+        bits = 0
+        for hash in hashes:
+            i = self.positions.get(hash)
+            if i is None:
+                i = self.positions[hash] = len(self.hashes)
+                self.hashes.append(hash)
+            bits |= 1 << i
+        return bits
+
+    def hashes_of(self, bits):
+        """Returns the hashes of the objects in the bitmap."""
+        return [self.hashes[i] for i, bit in enumerate(reversed(bin(bits)[2:])) if bit == "1"]
+
+    @staticmethod
+    def count(bits):
+        return bin(bits).count("1")
+
+    def add(self, commit_hash, bits):
+        """Stores the bitmap for the given commit (written by write())."""
+        hex = "%x" % bits
+        self.stored[commit_hash] = zlib.compress(binascii.unhexlify("0" * (len(hex) % 2) + hex))
+        self.cache[commit_hash] = bits
+
+    def write(self):
+        """Rewrites the whole bitmaps file."""
+        fd, temp_path = tempfile.mkstemp(dir=REPO_PATH, prefix="bitmaps-")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(BITMAP_HEADER.pack(BITMAP_MAGIC, BITMAP_VERSION, len(self.hashes),
+                len(self.stored)))
+            f.write("".join(self.hashes))
+            for commit_hash, data in self.stored.iteritems():
+                f.write(BITMAP_RECORD.pack(commit_hash, len(data)))
+                f.write(data)
+        os.rename(temp_path, BITMAPS_PATH)
+
+def commit_epoch(cur_commit):
+    """Returns a commit's timestamp as seconds since the epoch (commits store
+        time.ctime() strings)."""
+    if isinstance(cur_commit.timestamp, (int, long, float)):
+        return float(cur_commit.timestamp)
+    try:
+        return time.mktime(time.strptime(cur_commit.timestamp))
+    except (TypeError, ValueError):
+        return 0.0
+
+def diff_trees(old_tree_hash, new_tree_hash, prefix=""):
+    """Yields a TreeChange(path, old hash, new hash) for every file that differs
+        between the two trees (a hash is None if the file isn't in that tree).
+        Subtrees with the same hash in both are skipped without being read."""
+    if old_tree_hash == new_tree_hash:
+        return
+    old_tree = read_hash(old_tree_hash) if old_tree_hash else {}
+    new_tree = read_hash(new_tree_hash) if new_tree_hash else {}
+    for name in sorted(set(old_tree) | set(new_tree)):
+        old_entry, new_entry = old_tree.get(name), new_tree.get(name)
+        if old_entry == new_entry:
+            continue
+        path = os.path.join(prefix, name)
+        # (a name can go from being a file to a directory or back)
+        old_blob, old_subtree = _split_entry(old_entry)
+        new_blob, new_subtree = _split_entry(new_entry)
+        if old_blob != new_blob:
+            yield TreeChange(path, old_blob, new_blob)
+        if old_subtree != new_subtree:
+            for change in diff_trees(old_subtree, new_subtree, path):
+                yield change
+
+def _split_entry(entry):
+    """Returns (blob hash, subtree hash) for a tree entry; one or both are None."""
+    if entry is None:
+        return None, None
+    if entry.type == "tree":
+        return None, entry.hash
+    return entry.hash, None
+
+@traced()
 def lookup_in_tree(filename, tree_hash):
     """Searches given tree and its subtrees for the given filename, returns file's hash."""
     # currently expects the full file-path rather than just the file name: maybe a
@@ -389,6 +3793,7 @@ def lookup_in_tree(filename, tree_hash):
 
     return found_hash
 
+@traced()
 def walk_tree(tree_hash, prefix=None):
     """Given a tree, returns a list of files in that tree and all subtrees."""
     results = []
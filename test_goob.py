@@ -1,9 +1,15 @@
 import unittest
 import os
 import goob
+import bench_goob
 import shutil
 import cPickle
 import tempfile
+import time
+import random
+import json
+import threading
+from io import BytesIO
 import pudb
 
 class BaseTest(unittest.TestCase):
@@ -85,6 +91,179 @@ class testAddFunc(BaseTest):
         self.assertFileAdded(self.filename)
         self.assertFileAdded(self.filename2)
 
+class testBulkAdd(BaseTest):
+    def setUp(self):
+        super(testBulkAdd, self).setUp()
+        goob.init()
+
+    def test_add_several_files_at_once(self):
+        make_test_file("a", "contents of file a")
+        make_test_file("b", "contents of file b")
+        report = goob.add("a", "b")
+
+        self.assertEqual(sorted(report.added), ["a", "b"])
+        index_data = goob.read_index()
+        self.assertEqual(sorted(index_data.keys()), ["a", "b"])
+        self.assertEqual(goob.read_hash(index_data["b"]), "contents of file b")
+
+    def test_add_several_files_some_unchanged(self):
+        make_test_file("a", "contents of file a")
+        make_test_file("b", "contents of file b")
+        goob.add("a")
+        report = goob.add("a", "b")
+        self.assertEqual(report.added, ["b"])
+        self.assertEqual(report.unchanged, ["a"])
+
+    def test_add_all(self):
+        files_made = make_lotsa_test_files(add_all=False)
+        report = goob.add_all(processes=True)
+
+        self.assertEqual(sorted(report.added), sorted(files_made))
+        self.assertEqual(sorted(goob.read_index().keys()), sorted(files_made))
+        for phase in ["walk", "stat", "hash", "write index"]:
+            self.assertIn(phase, report.timings)
+
+    def test_add_all_respects_goobignore(self):
+        files_made = make_lotsa_test_files(add_all=False)
+        make_test_file(".goobignore", "# comment\nbar/\n*.log\n")
+        make_test_file("debug.log", "lots of logging")
+
+        goob.add_all()
+        index_data = goob.read_index()
+        self.assertIn(".goobignore", index_data)
+        self.assertNotIn("debug.log", index_data)
+        for filename in files_made:
+            if "bar" in filename:
+                self.assertNotIn(filename, index_data)
+            else:
+                self.assertIn(filename, index_data)
+
+    def test_add_all_nothing_changed_raises_error(self):
+        make_lotsa_test_files(add_all=False)
+        goob.add_all()
+        with self.assertRaises(goob.NoChangesError) as e:
+            goob.add_all()
+
+class testGoobignore(BaseTest):
+    def setUp(self):
+        super(testGoobignore, self).setUp()
+        goob.init()
+
+    def assertIgnored(self, patterns, path, is_dir=False, ignored=True):
+        make_test_file(".goobignore", patterns)
+        rules = goob.IgnoreRules.for_dir("").with_file("")
+        self.assertEqual(rules.is_ignored(path, is_dir), ignored)
+
+    def test_patterns(self):
+        self.assertIgnored("*.pyc", os.path.join("foo", "a.pyc"))
+        self.assertIgnored("*.pyc", "a.py", ignored=False)
+        self.assertIgnored("build/", "build", is_dir=True)
+        self.assertIgnored("build/", "build", is_dir=False, ignored=False)
+        self.assertIgnored("/top", "top")
+        self.assertIgnored("/top", os.path.join("foo", "top"), ignored=False)
+        self.assertIgnored("foo/*.log", os.path.join("foo", "a.log"))
+        self.assertIgnored("foo/*.log", os.path.join("foo", "bar", "a.log"), ignored=False)
+        self.assertIgnored("**/cache", os.path.join("a", "b", "cache"), is_dir=True)
+        self.assertIgnored("a/**/z", os.path.join("a", "b", "c", "z"))
+        self.assertIgnored("a/**", os.path.join("a", "b"))
+        self.assertIgnored("file[0-9].txt", "file7.txt")
+        self.assertIgnored("file?.txt", "fileab.txt", ignored=False)
+        self.assertIgnored("*.log\n!keep.log\n", "keep.log", ignored=False)
+        self.assertIgnored("*.log\n!keep.log\n", "other.log")
+        self.assertIgnored("# comment\n\n", "# comment", ignored=False)
+        self.assertIgnored("\\#file\n", "#file")
+        self.assertIgnored("\\!name\n", "!name")
+        self.assertIgnored("\\!name\n", "name", ignored=False)
+        self.assertIgnored("star\\*\n", "star*")
+        self.assertIgnored("star\\*\n", "stars", ignored=False)
+        self.assertIgnored("trailing\\ \n", "trailing ")
+
+    def test_status_skips_ignored(self):
+        files_made = make_lotsa_test_files(add_all=False)
+        make_test_file(".goobignore", "bar/\n*.log\n")
+        make_test_file("debug.log", "lots of logging")
+        make_test_file(os.path.join("foo", ".goobignore"), "d\n!important.log\n")
+        make_test_file(os.path.join("foo", "important.log"), "keep me")
+
+        expected = [".goobignore", "a", "b", "c", os.path.join("foo", ".goobignore"),
+            os.path.join("foo", "e"), os.path.join("foo", "f"), os.path.join("foo", "important.log")]
+        self.assertEqual(sorted(goob.status().untracked), sorted(expected))
+        goob.add_all()
+        self.assertEqual(sorted(goob.read_index().keys()), sorted(expected))
+
+    def test_ignored_directory_not_walked(self):
+        os.mkdir("node_modules")
+        make_test_file(os.path.join("node_modules", "x"), "a dependency")
+        make_test_file(".goobignore", "node_modules/\n")
+        listed = []
+        real_listdir = os.listdir
+        def listdir(path):
+            listed.append(path)
+            return real_listdir(path)
+        os.listdir = listdir
+        try:
+            files = list(goob.iter_working_files())
+        finally:
+            os.listdir = real_listdir
+        self.assertEqual(files, [".goobignore"])
+        self.assertNotIn("node_modules", listed)
+
+    def test_add_all_in_subdirectory_uses_parent_rules(self):
+        make_lotsa_test_files(add_all=False)
+        make_test_file(".goobignore", "e\n")
+        goob.add_all("foo")
+        self.assertNotIn(os.path.join("foo", "e"), goob.read_index())
+        self.assertIn(os.path.join("foo", "d"), goob.read_index())
+
+    def test_tracked_ignored_file_not_reported_deleted(self):
+        make_test_file("debug.log", "lots of logging")
+        goob.add("debug.log")
+        goob.commit("first commit")
+        make_test_file(".goobignore", "*.log\n")
+        self.assertEqual(goob.status(), goob.Status(untracked=[".goobignore"]))
+
+class testStatCache(BaseTest):
+    def setUp(self):
+        super(testStatCache, self).setUp()
+        goob.init()
+        self.filename = "testfile"
+        make_test_file(self.filename, "contents of my file")
+        # pretend the file was written a while ago, so it isn't racy
+        os.utime(self.filename, (1000000000, 1000000000))
+
+    def test_add_records_stat_data(self):
+        goob.add(self.filename)
+        index_data, extensions = goob.read_index_ext()
+        self.assertEqual(extensions["stat"][self.filename], goob.get_stat_data(self.filename))
+
+    def test_racily_clean_file_not_cached(self):
+        make_test_file(self.filename, "just written")
+        goob.add(self.filename)
+        index_data, extensions = goob.read_index_ext()
+        self.assertIn(self.filename, index_data)
+        self.assertNotIn(self.filename, extensions["stat"])
+
+    def test_status_skips_rehash_of_unchanged_file(self):
+        goob.add(self.filename)
+        goob.commit("first commit")
+
+        real_hash_func = goob.get_hash_of_file_contents
+        def fail(*args, **kwargs):
+            raise AssertionError("rehashed a file with unchanged stat data")
+        goob.get_hash_of_file_contents = fail
+        try:
+            goob.status()
+        finally:
+            goob.get_hash_of_file_contents = real_hash_func
+
+    def test_add_notices_change_with_same_size(self):
+        goob.add(self.filename)
+        make_test_file(self.filename, "CONTENTS OF MY FILE")
+        os.utime(self.filename, (1000000001, 1000000001))
+        goob.add(self.filename)
+        self.assertEqual(goob.get_hash_from_index(self.filename),
+            goob.make_hash("CONTENTS OF MY FILE", "blob"))
+
 class testRmFunc(BaseTest):
     def setUp(self):
         super(testRmFunc, self).setUp()
@@ -160,6 +339,55 @@ class testGetHashFromIndex(BaseTest):
         with self.assertRaises(goob.NoFileError) as e:
             goob.get_hash_from_index("nonexistant")
 
+class testIndexFormat(BaseTest):
+    def setUp(self):
+        super(testIndexFormat, self).setUp()
+        goob.init()
+        self.files_made = make_lotsa_test_files()
+
+    def test_index_round_trip(self):
+        index_data, extensions = goob.read_index_ext()
+        extensions["stat"]["a"] = goob.StatData(1000000000.5, 1000000000.25, 18, 1234)
+        extensions["tree"]["foo"] = goob.make_hash("a tree", "tree")
+        goob.write_index(index_data, extensions)
+
+        self.assertEqual(goob.read_index_ext(), (index_data, extensions))
+        with open(goob.INDEX_PATH, 'rb') as f:
+            self.assertTrue(f.read().startswith(goob.INDEX_MAGIC))
+
+    def test_lookup_every_file(self):
+        index_data = goob.read_index()
+        for filename in self.files_made:
+            self.assertEqual(goob.get_hash_from_index(filename), index_data[filename])
+        for filename in ["0", "a0", "foo", "zzz"]:
+            with self.assertRaises(goob.NoFileError) as e:
+                goob.get_hash_from_index(filename)
+
+    def test_corrupt_index_raises_error(self):
+        with open(goob.INDEX_PATH, 'rb') as f:
+            data = f.read()
+        with open(goob.INDEX_PATH, 'wb') as f:
+            f.write(data[:30] + "X" + data[31:])
+        with self.assertRaises(goob.BadIndexError) as e:
+            goob.read_index()
+
+    def test_reads_old_pickled_index(self):
+        index_data = goob.read_index()
+        with open(goob.INDEX_PATH, 'wb') as f:
+            cPickle.dump(index_data, f)
+        self.assertEqual(goob.read_index(), index_data)
+        self.assertEqual(goob.get_hash_from_index("a"), index_data["a"])
+
+        # and it's upgraded the next time it's written
+        make_test_file("a", "new contents of file a")
+        goob.add("a")
+        with open(goob.INDEX_PATH, 'rb') as f:
+            self.assertTrue(f.read().startswith(goob.INDEX_MAGIC))
+
+    def test_no_temp_files_left_behind(self):
+        self.assertEqual([filename for filename in os.listdir(goob.REPO_PATH)
+            if filename.startswith("index-")], [])
+
 class testGetHashOfFileContents(BaseTest):
     def setUp(self):
         super(testGetHashOfFileContents, self).setUp()
@@ -189,6 +417,435 @@ class testReadHash(BaseTest):
         with self.assertRaises(goob.BadHashError) as e:
             goob.read_hash("garuebidwjaofefaef")
 
+class testBlobStreaming(BaseTest):
+    def setUp(self):
+        super(testBlobStreaming, self).setUp()
+        goob.init()
+        self.filename = "bigfile"
+        # bigger than a few blocks, so it's written in several chunks
+        self.contents = "".join("line %d of a big file\n" % i for i in xrange(20000))
+        make_test_file(self.filename, self.contents)
+
+    def test_hash_matches_make_hash(self):
+        self.assertEqual(goob.get_hash_of_file_contents(self.filename),
+            goob.make_hash(self.contents, "blob"))
+
+    def test_save_and_stream_back(self):
+        hash = goob.save_file_blob(self.filename)
+        self.assertEqual(hash, goob.make_hash(self.contents, "blob"))
+        with goob.read_hash(hash, stream=True) as f:
+            self.assertEqual(f.read(10), self.contents[:10])
+            self.assertEqual(f.read(), self.contents[10:])
+        self.assertEqual(goob.read_hash(hash), self.contents)
+
+    def test_compressed_blob(self):
+        goob.add_files([self.filename], compress=True)
+        hash = goob.get_hash_from_index(self.filename)
+        self.assertLess(os.path.getsize(goob.hash_to_path(hash)), len(self.contents))
+        self.assertEqual(goob.read_hash(hash), self.contents)
+        with goob.read_hash(hash, stream=True) as f:
+            self.assertEqual(goob.hash_stream(f), hash)
+
+    def test_no_temp_files_left_behind(self):
+        goob.add(self.filename)
+        for filename in os.listdir(goob.BLOB_PATH):
+            self.assertFalse(filename.startswith("tmp-"))
+
+    def test_single_add_doesnt_list_object_dirs(self):
+        make_lotsa_test_files()
+        goob.commit("first commit")
+        make_test_file("a", "changed")
+        listed = []
+        orig_listdir = os.listdir
+        def listdir(path):
+            listed.append(path)
+            return orig_listdir(path)
+        os.listdir = listdir
+        try:
+            goob.add("a")
+        finally:
+            os.listdir = orig_listdir
+        self.assertNotIn(goob.BLOB_PATH, listed)
+        self.assertTrue(goob.object_exists(goob.get_hash_from_index("a")))
+
+class testPack(BaseTest):
+    def setUp(self):
+        super(testPack, self).setUp()
+        goob.init()
+        self.files_made = make_lotsa_test_files()
+        goob.commit("first commit")
+
+    def test_pack_moves_loose_objects(self):
+        loose = goob.list_loose_objects()
+        goob.pack()
+
+        self.assertEqual(goob.list_loose_objects(), [])
+        packs = goob.get_packs()
+        self.assertEqual(len(packs), 1)
+        self.assertEqual(sorted(packs[0].hashes()), sorted(loose))
+
+    def test_pack_synced_before_loose_objects_removed(self):
+        events = []
+        orig_fsync_paths, orig_remove = goob._fsync_paths, os.remove
+        def fsync_paths(paths):
+            events.extend(("sync", path) for path in paths)
+            orig_fsync_paths(paths)
+        def remove(path):
+            events.append(("remove", path))
+            orig_remove(path)
+        goob._fsync_paths, os.remove = fsync_paths, remove
+        try:
+            goob.pack()
+        finally:
+            goob._fsync_paths, os.remove = orig_fsync_paths, orig_remove
+
+        first_remove = [kind for kind, _ in events].index("remove")
+        synced = [path for kind, path in events[:first_remove] if kind == "sync"]
+        self.assertEqual(len(synced), 3)
+        self.assertEqual(synced[-1], goob.PACK_PATH)
+
+    def test_read_packed_objects(self):
+        goob.pack()
+
+        cur_commit = goob.read_hash(goob.get_cur_head())
+        self.assertEqual(set(goob.walk_tree(cur_commit.tree_hash)), set(self.files_made))
+        for filename in self.files_made:
+            hash = goob.get_hash_from_index(filename)
+            self.assertEqual(goob.read_hash(hash), "contents of file %s" % os.path.basename(filename))
+            with goob.read_hash(hash, stream=True) as f:
+                self.assertEqual(f.read(), "contents of file %s" % os.path.basename(filename))
+
+    def test_loose_objects_still_read_after_pack(self):
+        goob.pack()
+        make_test_file("a", "new contents of file a")
+        goob.add("a")
+        self.assertEqual(goob.read_hash(goob.get_hash_from_index("a")), "new contents of file a")
+
+    def test_nothing_to_pack(self):
+        goob.pack()
+        self.assertIsNone(goob.pack())
+
+    def test_repack_consolidates_packs(self):
+        goob.pack()
+        make_test_file("a", "new contents of file a")
+        goob.add("a")
+        goob.commit("second commit")
+        goob.pack()
+        self.assertEqual(len(goob.get_packs()), 2)
+
+        goob.pack(repack=True)
+        self.assertEqual(len(goob.get_packs()), 1)
+        cur_commit = goob.read_hash(goob.get_cur_head())
+        self.assertEqual(set(goob.walk_tree(cur_commit.tree_hash)), set(self.files_made))
+
+    def test_missing_hash_with_packs(self):
+        goob.pack()
+        with self.assertRaises(goob.BadHashError) as e:
+            goob.read_hash(goob.make_hash("not stored", "blob"))
+
+class testDeltaPack(BaseTest):
+    def setUp(self):
+        super(testDeltaPack, self).setUp()
+        goob.init()
+        self.filename = "config"
+        self.versions = []
+        lines = ["setting_%d = %d\n" % (i, i) for i in xrange(500)]
+        for version in xrange(5):
+            lines[version * 7] = "setting_changed = %d\n" % version
+            contents = "".join(lines)
+            make_test_file(self.filename, contents)
+            goob.add_files([self.filename], compress=(version == 2))
+            goob.commit("version %d" % version)
+            self.versions.append((goob.get_hash_from_index(self.filename), contents))
+
+    def test_delta_round_trip(self):
+        base = "".join("line %d\n" % i for i in xrange(300))
+        target = base[:500] + "something new\n" + base[520:] + "appended"
+        self.assertEqual(goob.apply_delta(base, goob.make_delta(base, target)), target)
+        self.assertEqual(goob.apply_delta("", goob.make_delta("", target)), target)
+
+    def test_pack_with_deltas(self):
+        goob.pack(delta=True)
+        pack = goob.get_packs()[0]
+        kinds = [pack.read_entry(hash)[0] for hash, contents in self.versions]
+        self.assertEqual(kinds.count(goob.PACK_FULL), 1)
+        self.assertEqual(kinds.count(goob.PACK_DELTA), 4)
+
+        for hash, contents in self.versions:
+            self.assertEqual(goob.read_hash(hash), contents)
+            with goob.read_hash(hash, stream=True) as f:
+                self.assertEqual(f.read(), contents)
+
+    def test_smaller_than_plain_pack(self):
+        goob.pack()
+        plain_size = os.path.getsize(goob.get_packs()[0].path)
+        goob.pack(repack=True, delta=True)
+        self.assertLess(os.path.getsize(goob.get_packs()[0].path), plain_size / 2)
+
+    def test_small_bases_not_tried(self):
+        # sorts right before the other versions, so it's in their window
+        os.mkdir("a")
+        make_test_file("a/config", "setting_0 = 0\n")
+        goob.add("a/config")
+        small = goob.get_hash_from_index("a/config")
+        tried = []
+        orig_make_delta = goob.make_delta
+        def record(base, target):
+            tried.append(len(base))
+            return orig_make_delta(base, target)
+        goob.make_delta = record
+        self.addCleanup(setattr, goob, "make_delta", orig_make_delta)
+
+        deltas = goob.find_deltas([small] + [hash for hash, contents in self.versions])
+        self.assertEqual(len(deltas), 4)
+        self.assertNotIn(small, [base for base, delta in deltas.values()])
+        self.assertNotIn(len(goob._raw_blob(small)), tried)
+
+    def test_max_depth(self):
+        goob.pack(delta=True, max_depth=1)
+        pack = goob.get_packs()[0]
+        for hash, contents in self.versions:
+            kind, payload = pack.read_entry(hash)
+            if kind == goob.PACK_DELTA:
+                self.assertEqual(pack.read_entry(payload[:42])[0], goob.PACK_FULL)
+            self.assertEqual(goob.read_hash(hash), contents)
+
+class testObjectWriter(BaseTest):
+    def setUp(self):
+        super(testObjectWriter, self).setUp()
+        goob.init()
+        self.synced = []
+        orig_fsync_paths = goob._fsync_paths
+        def record(paths):
+            self.synced.append(list(paths))
+            orig_fsync_paths(paths)
+        goob._fsync_paths = record
+        self.addCleanup(setattr, goob, "_fsync_paths", orig_fsync_paths)
+
+    def test_existing_object_not_rewritten(self):
+        tree = {"a": goob.ObjectHash(goob.make_hash("a", "blob"), "blob")}
+        tree_hash = goob.make_tree({"a": tree["a"].hash})
+        os.utime(goob.hash_to_path(tree_hash), (1000000, 1000000))
+        inode = os.stat(goob.hash_to_path(tree_hash)).st_ino
+
+        goob.save_hash(tree, tree_hash)
+        goob.make_tree({"a": tree["a"].hash})
+        self.assertEqual(os.stat(goob.hash_to_path(tree_hash)).st_ino, inode)
+        # but it's marked as recently used, for gc's sake
+        self.assertGreater(os.stat(goob.hash_to_path(tree_hash)).st_mtime, 1000000)
+
+    def test_reused_objects_survive_gc(self):
+        make_test_file("x", "used to be unreachable")
+        goob.add("x")
+        hash = goob.get_hash_from_index("x")
+        goob.rm("x", cached=True)
+        os.utime(goob.hash_to_path(hash), (1000000, 1000000))
+        goob.pack() # and packed, too
+        os.utime(goob.get_packs()[0].path, (1000000, 1000000))
+
+        # a command about to point at it again, racing a gc
+        self.assertEqual(goob.save_file_blob("x"), hash)
+        stats = goob.gc()
+        self.assertEqual((stats.removed, stats.kept), (0, 1))
+        self.assertEqual(goob.read_hash(hash), "used to be unreachable")
+
+    def test_fsyncs_grouped_per_command(self):
+        make_lotsa_test_files(add_all=False)
+        goob.add_all()
+        # all nine blobs synced at once, before the index pointed at them
+        self.assertEqual(len(self.synced), 1)
+        self.assertEqual(len([path for path in self.synced[0]
+            if path.startswith(goob.BLOB_PATH + os.sep)]), 9)
+        self.assertIn(goob.BLOB_PATH, self.synced[0])
+
+        del self.synced[:]
+        goob.commit("first commit")
+        synced = sum(self.synced, [])
+        self.assertIn(goob.hash_to_path(goob.get_cur_head()), synced)
+        self.assertEqual(len([path for path in synced if path.startswith(goob.TREE_PATH + os.sep)]), 3)
+
+    def test_object_dirs_listed_once_per_command(self):
+        make_lotsa_test_files(add_all=False)
+        listed = []
+        orig_listdir = os.listdir
+        def listdir(path):
+            listed.append(path)
+            return orig_listdir(path)
+        os.listdir = listdir
+        try:
+            goob.add_all()
+        finally:
+            os.listdir = orig_listdir
+        self.assertEqual(listed.count(goob.BLOB_PATH), 1)
+
+    def test_no_temp_files_left(self):
+        make_lotsa_test_files()
+        goob.commit("first commit")
+        for dir in goob.LOOSE_PATHS:
+            self.assertFalse([name for name in os.listdir(dir) if name.startswith("tmp-")])
+
+    def test_deleted_object_rewritten(self):
+        make_test_file("a", "contents")
+        with goob.object_writer():
+            hash = goob.save_file_blob("a")
+            os.remove(goob.hash_to_path(hash))
+            goob.forget_object(hash)
+            goob.save_file_blob("a")
+        self.assertTrue(os.path.exists(goob.hash_to_path(hash)))
+
+class testChunkedBlobs(BaseTest):
+    def setUp(self):
+        super(testChunkedBlobs, self).setUp()
+        goob.init()
+        for name, value in [("CHUNK_BLOBS", True), ("CHUNK_THRESHOLD", 64 * 1024),
+                ("CHUNK_MIN_SIZE", 2 * 1024), ("CHUNK_MAX_SIZE", 32 * 1024), ("CHUNK_BITS", 12)]:
+            self.addCleanup(setattr, goob, name, getattr(goob, name))
+            setattr(goob, name, value)
+        rand = random.Random(0)
+        self.contents = "".join(chr(rand.randrange(256)) for _ in xrange(300 * 1024))
+        make_test_file("big", self.contents)
+
+    def test_round_trip(self):
+        goob.add("big")
+        hash = goob.get_hash_from_index("big")
+        self.assertEqual(hash, goob.make_hash(self.contents, "blob"))
+        chunks = goob.blob_chunks(hash)
+        self.assertGreater(len(chunks), 5)
+        self.assertEqual(sum(length for _, length in chunks), len(self.contents))
+        self.assertEqual(goob.read_hash(hash), self.contents)
+        with goob.read_hash(hash, stream=True) as f:
+            self.assertEqual(f.read(10) + f.read(), self.contents)
+
+    def test_small_files_not_chunked(self):
+        make_test_file("small", "not big enough")
+        goob.add("small")
+        self.assertIsNone(goob.blob_chunks(goob.get_hash_from_index("small")))
+
+    def test_edit_only_stores_changed_chunks(self):
+        goob.add("big")
+        before = set(goob.list_loose_objects())
+        middle = len(self.contents) // 2
+        make_test_file("big", self.contents[:middle] + "an edit" + self.contents[middle:])
+        goob.add("big")
+
+        new = set(goob.list_loose_objects()) - before
+        new_size = sum(os.path.getsize(goob.hash_to_path(hash)) for hash in new)
+        self.assertLess(len(new), 5) # the manifest, plus a chunk or two around the edit
+        self.assertLess(new_size, len(self.contents) // 4)
+
+    def test_boundaries_follow_content(self):
+        chunks = list(goob.iter_chunks(BytesIO(self.contents), 2 * 1024, 32 * 1024, 12))
+        self.assertEqual("".join(chunks), self.contents)
+        self.assertTrue(all(2 * 1024 <= len(chunk) <= 32 * 1024 for chunk in chunks[:-1]))
+        shifted = list(goob.iter_chunks(BytesIO("x" * 1000 + self.contents), 2 * 1024, 32 * 1024, 12))
+        self.assertGreater(len(set(chunks) & set(shifted)), len(chunks) - 3)
+
+    def test_boundaries_in_text(self):
+        # text uses few byte values, but its boundaries should still follow the content
+        rand = random.Random(1)
+        words = ["goob", "blob", "tree", "commit", "the", "a", "of", "\n", "index"]
+        text = " ".join(rand.choice(words) for _ in xrange(60000))
+        chunks = list(goob.iter_chunks(BytesIO(text), 2 * 1024, 32 * 1024, 12))
+        self.assertEqual("".join(chunks), text)
+        self.assertLess(sum(1 for chunk in chunks if len(chunk) == 32 * 1024), len(chunks) // 4)
+        shifted = list(goob.iter_chunks(BytesIO("an edit " + text), 2 * 1024, 32 * 1024, 12))
+        self.assertGreater(len(set(chunks) & set(shifted)), len(chunks) - 3)
+
+    def test_checkout_gc_and_fsck(self):
+        goob.add("big")
+        goob.commit("first commit")
+        first = goob.get_cur_head()
+        make_test_file("big", "small now")
+        goob.add("big")
+        goob.commit("second commit")
+
+        goob.checkout(first)
+        self.assertEqual(open("big", 'rb').read(), self.contents)
+        # only the second commit, its tree and its blob are unreachable now
+        self.assertEqual(goob.gc(grace_period=0).removed, 3)
+        self.assertEqual(goob.read_hash(goob.get_hash_from_index("big")), self.contents)
+        report = goob.fsck(workers=1, progress=False)
+        self.assertTrue(report.ok)
+        self.assertEqual(report.dangling, [])
+
+class testObjectCache(BaseTest):
+    def test_lru_evicts_least_recently_used(self):
+        cache = goob.LRUCache(2)
+        cache.add("a", 1)
+        cache.add("b", 2)
+        cache.get("a")
+        cache.add("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+    def test_lru_size_bound(self):
+        cache = goob.LRUCache(10, sizeof=len)
+        cache.add("a", "12345")
+        cache.add("b", "123456")
+        cache.add("c", "this is too big to cache")
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get("b"), "123456")
+
+    def test_lru_shared_between_threads(self):
+        cache = goob.LRUCache(50)
+        errors = []
+        def hammer(seed):
+            rand = random.Random(seed)
+            try:
+                for _ in xrange(5000):
+                    key = rand.randrange(100)
+                    if cache.get(key) is None:
+                        cache.add(key, key)
+                    if rand.random() < 0.001:
+                        cache.clear()
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=hammer, args=(i,)) for i in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(cache), 50)
+        self.assertEqual(cache.size, len(cache))
+
+    def test_object_cache_bounded_by_bytes(self):
+        self.assertEqual(goob.object_cache.max_size, goob.OBJECT_CACHE_BYTES)
+        self.assertEqual(goob.object_cache.sizeof("x" * 1000), 1000)
+        tree = {"a": goob.ObjectHash("bl" + "0" * 40, "blob"),
+                "b": goob.ObjectHash("tr" + "0" * 40, "tree")}
+        self.assertGreater(goob.object_cache.sizeof(tree), 2 * 42)
+
+    def test_tree_walks_hit_cache(self):
+        goob.init()
+        files_made = make_lotsa_test_files()
+        goob.commit("first commit")
+        cur_commit = goob.read_hash(goob.get_cur_head())
+
+        goob.walk_tree(cur_commit.tree_hash)
+        hits, misses = goob.object_cache.hits, goob.object_cache.misses
+        for filename in files_made:
+            goob.lookup_in_tree(filename, cur_commit.tree_hash)
+        self.assertEqual(goob.object_cache.misses, misses)
+        self.assertGreater(goob.object_cache.hits, hits)
+
+    def test_streamed_cache_hits_match_misses(self):
+        goob.init()
+        make_lotsa_test_files()
+        goob.commit("first commit")
+        commit_hash = goob.get_cur_head()
+        tree_hash = goob.read_hash(commit_hash).tree_hash
+        goob.object_cache.clear()
+
+        for hash in (commit_hash, tree_hash):
+            uncached = goob.read_hash(hash, stream=True)
+            goob.read_hash(hash)
+            cached = goob.read_hash(hash, stream=True)
+            self.assertIs(type(cached), type(uncached))
+        self.assertIsInstance(cached, dict)
+
 class testTreeCreation(BaseTest):
     def setUp(self):
         super(testTreeCreation, self).setUp()
@@ -240,6 +897,49 @@ class testTreeCreation(BaseTest):
         for filename in self.morefiles1:
             self.assertIn(filename, subtree1_data)
 
+class testTreeCache(BaseTest):
+    def setUp(self):
+        super(testTreeCache, self).setUp()
+        goob.init()
+        self.files_made = make_lotsa_test_files()
+        goob.commit("first commit")
+
+    def test_commit_fills_tree_cache(self):
+        index_data, extensions = goob.read_index_ext()
+        cur_commit = goob.read_hash(goob.get_cur_head())
+        self.assertEqual(extensions["tree"][""], cur_commit.tree_hash)
+        self.assertEqual(sorted(extensions["tree"].keys()), ["", "foo", os.path.join("foo", "bar")])
+
+    def test_add_invalidates_only_parent_dirs(self):
+        make_test_file("a", "new contents of file a")
+        goob.add("a")
+        index_data, extensions = goob.read_index_ext()
+        self.assertEqual(sorted(extensions["tree"].keys()), ["foo", os.path.join("foo", "bar")])
+
+        goob.rm(os.path.join("foo", "bar", "g"), cached=True)
+        index_data, extensions = goob.read_index_ext()
+        self.assertEqual(extensions["tree"], {})
+
+    def test_commit_only_writes_changed_trees(self):
+        make_test_file(os.path.join("foo", "d"), "new contents of file d")
+        goob.add(os.path.join("foo", "d"))
+
+        saved = []
+        real_save_encoded = goob.save_encoded
+        def save_encoded(data, hash):
+            saved.append(hash)
+            real_save_encoded(data, hash)
+        goob.save_encoded = save_encoded
+        try:
+            goob.commit("second commit")
+        finally:
+            goob.save_encoded = real_save_encoded
+
+        # the top tree, foo's tree and the commit -- not foo/bar's tree
+        self.assertEqual(len(saved), 3)
+        cur_commit = goob.read_hash(goob.get_cur_head())
+        self.assertEqual(cur_commit.tree_hash, goob.make_tree(goob.read_index()))
+
 class testLookupInTree(BaseTest):
     def setUp(self):
         super(testLookupInTree, self).setUp()
@@ -286,6 +986,486 @@ class testLookupInTree(BaseTest):
         found_hash = goob.lookup_in_tree("nofile", tree_hash)
         self.assertIsNone(found_hash)
 
+class testObjectEncoding(BaseTest):
+    def test_tree_round_trip(self):
+        tree = {"a": goob.ObjectHash(goob.make_hash("a", "blob"), "blob"),
+                "dir": goob.ObjectHash(goob.make_hash("dir", "tree"), "tree")}
+        data = goob.encode_tree(tree)
+        self.assertTrue(data.startswith(goob.TREE_MAGIC))
+        self.assertEqual(goob.decode_tree(data, len(goob.TREE_MAGIC)), tree)
+
+    def test_tree_encoding_is_canonical(self):
+        names = ["b", "a", "c", "a.txt"]
+        tree1 = dict((name, goob.ObjectHash(goob.make_hash(name, "blob"), "blob")) for name in names)
+        tree2 = dict((name, goob.ObjectHash(goob.make_hash(name, "blob"), "blob")) for name in reversed(names))
+        self.assertEqual(goob.encode_tree(tree1), goob.encode_tree(tree2))
+
+    def test_commit_round_trip(self):
+        for commit in [goob.Commit(goob.make_hash("tree", "tree"), "Sat Oct 17 12:00:00 2026", "msg"),
+                       goob.Commit(123, 1.5, u"unicode \u2603", "parent", "author")]:
+            data = goob.encode_commit(commit)
+            self.assertEqual(goob.decode_commit(data, len(goob.COMMIT_MAGIC)), commit)
+
+    def test_no_pickles_written(self):
+        goob.init()
+        make_lotsa_test_files()
+        goob.commit("first commit")
+        for hash in goob.list_loose_objects():
+            with open(goob.hash_to_path(hash), 'rb') as f:
+                self.assertEqual(f.read(1), "\x00")
+
+class testGC(BaseTest):
+    def setUp(self):
+        super(testGC, self).setUp()
+        goob.init()
+        make_test_file("x", "first version")
+        goob.add("x")
+        self.orphan = goob.get_hash_from_index("x")
+        make_test_file("x", "second version")
+        goob.add("x")
+        make_lotsa_test_files()
+        goob.commit("first commit")
+
+    def make_old(self, path):
+        os.utime(path, (1000000, 1000000))
+
+    def test_unreachable_objects_removed(self):
+        self.make_old(goob.hash_to_path(self.orphan))
+        loose_before = len(goob.list_loose_objects())
+
+        stats = goob.gc()
+        self.assertEqual(stats, goob.GCStats(loose_before - 1, 1, 0))
+        self.assertFalse(goob.object_exists(self.orphan))
+        self.assertEqual(len(goob.list_loose_objects()), loose_before - 1)
+        self.assertEqual(goob.Status(), goob.status())
+
+    def test_recent_objects_kept(self):
+        stats = goob.gc()
+        self.assertEqual(stats.removed, 0)
+        self.assertEqual(stats.kept, 1)
+        self.assertTrue(goob.object_exists(self.orphan))
+
+    def test_repo_without_pack_dir(self):
+        # repos made before packs existed don't have one
+        os.rmdir(goob.PACK_PATH)
+        goob.forget_packs()
+        self.make_old(goob.hash_to_path(self.orphan))
+        stats = goob.gc()
+        self.assertEqual(stats.removed, 1)
+        self.assertEqual(goob.Status(), goob.status())
+
+    def test_history_and_index_kept(self):
+        first = goob.get_cur_head()
+        make_test_file("b", "changed")
+        goob.add("b")
+        goob.commit("second commit")
+        make_test_file("new", "staged, never committed")
+        goob.add("new")
+        for hash in goob.list_loose_objects():
+            self.make_old(goob.hash_to_path(hash))
+
+        goob.gc()
+        self.assertEqual(len(goob.log()), 2)
+        self.assertEqual(goob.read_hash(goob.get_hash_from_index("new")), "staged, never committed")
+        goob.rm("new")
+        goob.checkout(first)
+        self.assertEqual(open("b").read(), "contents of file b")
+
+    def test_packed_garbage_repacked(self):
+        goob.pack()
+        old_pack = goob.get_packs()[0]
+        self.make_old(old_pack.path)
+
+        stats = goob.gc()
+        self.assertEqual(stats.removed, 1)
+        self.assertFalse(goob.object_exists(self.orphan))
+        self.assertFalse(os.path.exists(old_pack.path))
+        self.assertEqual(len(goob.get_packs()), 1)
+        self.assertEqual(goob.read_hash(goob.get_hash_from_index("x")), "second version")
+
+    def test_recent_pack_kept(self):
+        goob.pack()
+        stats = goob.gc()
+        self.assertEqual((stats.removed, stats.kept), (0, 1))
+        self.assertTrue(goob.object_exists(self.orphan))
+
+    def test_small_memory_limits(self):
+        # everything spills to disk and trees get forgotten, but the result is the same
+        for name, value in [("GC_RUN_SIZE", 2), ("GC_SEEN_SIZE", 1)]:
+            self.addCleanup(setattr, goob, name, getattr(goob, name))
+            setattr(goob, name, value)
+        make_test_file("b", "changed")
+        goob.add("b")
+        goob.commit("second commit")
+        goob.pack()
+        make_test_file("loose", "a loose blob")
+        goob.add("loose")
+        self.make_old(goob.get_packs()[0].path)
+        # everything packed but the orphan, plus the new loose blob
+        reachable = len(goob.get_packs()[0].hashes())
+
+        stats = goob.gc()
+        self.assertEqual(stats, goob.GCStats(reachable, 1, 0))
+        self.assertFalse(goob.object_exists(self.orphan))
+        self.assertEqual(len(goob.log()), 2)
+        self.assertEqual(goob.read_hash(goob.get_hash_from_index("loose")), "a loose blob")
+        self.assertTrue(goob.fsck(progress=False).ok)
+
+    def test_hash_sorter_spills_to_disk(self):
+        sorter = goob.HashSorter(run_size=3)
+        hashes = ["bl%040d" % random.randrange(20) for _ in xrange(50)]
+        for hash in hashes:
+            sorter.add(hash)
+        self.assertTrue(sorter.runs)
+        self.assertEqual(list(sorter), sorted(set(hashes)))
+        self.assertEqual(list(sorter), sorted(set(hashes))) # can be read again
+        sorter.close()
+
+class testBitmaps(BaseTest):
+    def setUp(self):
+        super(testBitmaps, self).setUp()
+        goob.init()
+        make_lotsa_test_files()
+        goob.commit("first commit")
+        self.commits = [goob.get_cur_head()]
+        for i in xrange(4):
+            make_test_file("b", "version %d" % i)
+            make_test_file(os.path.join("foo", "new%d" % i), "new file %d" % i)
+            goob.add("b", os.path.join("foo", "new%d" % i))
+            goob.commit("commit %d" % i)
+            self.commits.append(goob.get_cur_head())
+
+    def all_objects(self):
+        return sorted(goob.list_loose_objects())
+
+    def test_write_bitmaps(self):
+        self.assertEqual(goob.write_bitmaps(interval=2), 3)
+        bitmaps = goob.Bitmaps.load()
+        # generations 2 and 4, and HEAD
+        self.assertEqual(list(bitmaps.stored), [self.commits[1], self.commits[3], self.commits[4]])
+        self.assertEqual(sorted(bitmaps.hashes), self.all_objects())
+        self.assertEqual(bitmaps.hashes_of(bitmaps.get(self.commits[4])), bitmaps.hashes)
+        # already up to date
+        self.assertEqual(goob.write_bitmaps(interval=2), 0)
+
+    def test_same_answers_with_and_without(self):
+        without = [goob.count_objects(), goob.count_objects(self.commits[2]),
+            goob.reachable_objects(self.commits[3], exclude=self.commits[1])]
+        goob.write_bitmaps(interval=2)
+        with_bitmaps = [goob.count_objects(), goob.count_objects(self.commits[2]),
+            goob.reachable_objects(self.commits[3], exclude=self.commits[1])]
+        self.assertEqual(without, with_bitmaps)
+        self.assertEqual(without[0], len(self.all_objects()))
+        # 2 commits, each with a new root tree, foo tree, b and new file
+        self.assertEqual(len(without[2]), 10)
+
+    def test_no_trees_read(self):
+        goob.write_bitmaps()
+        read = []
+        orig_read_hash = goob.read_hash
+        def read_hash(hash, stream=False):
+            read.append(hash)
+            return orig_read_hash(hash, stream)
+        goob.read_hash = read_hash
+        self.addCleanup(setattr, goob, "read_hash", orig_read_hash)
+        self.assertEqual(goob.count_objects(), len(self.all_objects()))
+        self.assertEqual(read, [])
+
+    def test_commits_since_bitmaps(self):
+        goob.write_bitmaps()
+        make_test_file("c", "changed")
+        goob.add("c")
+        goob.commit("after the bitmaps")
+        self.assertEqual(goob.count_objects(), len(self.all_objects()))
+        self.assertEqual(len(goob.reachable_objects(exclude=self.commits[4])), 3)
+
+    def test_gc(self):
+        make_test_file("x", "never committed")
+        goob.add("x")
+        orphan = goob.get_hash_from_index("x")
+        goob.rm("x", cached=True)
+        os.utime(goob.hash_to_path(orphan), (1000000, 1000000))
+        goob.write_bitmaps()
+
+        stats = goob.gc()
+        self.assertEqual(stats.removed, 1)
+        self.assertEqual(stats.reachable, len(self.all_objects()))
+        self.assertFalse(goob.object_exists(orphan))
+        self.assertEqual(sorted(goob.Bitmaps.load().hashes), self.all_objects())
+
+class testFsck(BaseTest):
+    def setUp(self):
+        super(testFsck, self).setUp()
+        goob.init()
+        make_lotsa_test_files()
+        goob.commit("first commit")
+
+    def test_clean_repo(self):
+        report = goob.fsck(workers=1, progress=False)
+        self.assertTrue(report.ok)
+        self.assertEqual(report.dangling, [])
+        self.assertEqual(report.objects, len(goob.list_loose_objects()))
+
+    def test_packed_objects_on_process_pool(self):
+        goob.pack(delta=True)
+        report = goob.fsck(workers=2)
+        self.assertTrue(report.ok)
+        self.assertGreater(report.bytes, 0)
+
+    def test_corrupt_objects(self):
+        blob = goob.get_hash_from_index("a")
+        with open(goob.hash_to_path(blob), 'wb') as f:
+            f.write(goob.BLOB_RAW_MAGIC + "not what was added")
+        tree = goob.read_hash(goob.get_cur_head()).tree_hash
+        with open(goob.hash_to_path(tree), 'ab') as f:
+            f.write("x")
+
+        report = goob.fsck(workers=1, progress=False)
+        self.assertFalse(report.ok)
+        self.assertEqual([hash for hash, problem in report.corrupt], sorted([blob, tree]))
+        self.assertEqual(report.missing, [])
+
+    def test_missing_and_dangling_objects(self):
+        missing = goob.get_hash_from_index(os.path.join("foo", "bar", "g"))
+        os.remove(goob.hash_to_path(missing))
+        make_test_file("a", "a new version")
+        goob.add("a")
+        dangling = goob.read_index()["a"]
+        make_test_file("a", "a newer version")
+        goob.add("a")
+
+        report = goob.fsck(workers=1, progress=False)
+        self.assertEqual(report.missing, [missing])
+        self.assertEqual(report.dangling, [dangling])
+        self.assertEqual(report.corrupt, [])
+
+class testFastImport(BaseTest):
+    def setUp(self):
+        super(testFastImport, self).setUp()
+        goob.init()
+
+    def test_import_stream(self):
+        stream = BytesIO("\n".join([
+            "blob", "mark :1", "data 5", "hello",
+            "blob", "mark :2", "data 11", "in a subdir",
+            "commit", "mark :3", "author someone", "time 1000000000", "data 5", "first",
+            "M :1 a", "M :2 foo/b", "",
+            "blob", "mark :4", "data 6", "hello!",
+            "commit", "mark :5", "data 6", "second", "from :3", "M :4 a", "D foo/b", "",
+            "done", ""]))
+        stats = goob.fast_import(stream)
+        self.assertEqual((stats.commits, stats.blobs), (2, 3))
+        self.assertEqual(goob.get_cur_head(), stats.head)
+
+        entries = goob.log()
+        self.assertEqual(len(entries), 2)
+        first = goob.read_hash(entries[1].hash)
+        self.assertEqual((first.msg, first.author, first.parent), ("first", "someone", ""))
+        self.assertEqual(goob.commit_epoch(first), 1000000000)
+        self.assertEqual(sorted(goob.iter_tree(first.tree_hash)), [
+            ("a", goob.make_hash("hello", "blob")),
+            (os.path.join("foo", "b"), goob.make_hash("in a subdir", "blob"))])
+        self.assertEqual(list(goob.iter_tree(entries[0].tree_hash)),
+            [("a", goob.make_hash("hello!", "blob"))])
+        # nothing in the working directory or the index
+        self.assertEqual(os.listdir("."), [".goob"])
+        self.assertEqual(goob.read_index(), {})
+
+    def test_import_records_on_top_of_history(self):
+        make_lotsa_test_files()
+        goob.commit("first commit")
+        first = goob.get_cur_head()
+        records = [goob.ImportBlob(":1", "new a")]
+        for i in xrange(5):
+            records.append(goob.ImportBlob(":b%d" % i, "b version %d" % i))
+            records.append(goob.ImportCommit(None, "commit %d" % i, [("M", "a", ":1"),
+                ("M", os.path.join("foo", "bar", "g"), ":b%d" % i)]))
+
+        stats = goob.fast_import(records, batch_size=2, checkout_head=True)
+        self.assertEqual(stats.commits, 5)
+        self.assertEqual(len(goob.log()), 6)
+        self.assertEqual(goob.CommitGraph.load().get(stats.head).generation, 6)
+        self.assertEqual(goob.read_hash(goob.read_hash(stats.head).parent).msg, "commit 3")
+        self.assertEqual(open("a").read(), "new a")
+        self.assertEqual(open(os.path.join("foo", "bar", "g")).read(), "b version 4")
+        self.assertEqual(goob.Status(), goob.status())
+
+        goob.fast_import([goob.ImportCommit(None, "branch", [("deleteall",)], parent=first)])
+        self.assertEqual(goob.read_hash(goob.get_cur_head()).parent, first)
+
+    def test_only_changed_trees_rebuilt(self):
+        make_lotsa_test_files()
+        goob.commit("first commit")
+        encoded = []
+        orig_encode_tree = goob.encode_tree
+        def encode_tree(tree):
+            encoded.append(tree)
+            return orig_encode_tree(tree)
+        goob.encode_tree = encode_tree
+        self.addCleanup(setattr, goob, "encode_tree", orig_encode_tree)
+
+        goob.fast_import([goob.ImportBlob(":1", "x"), goob.ImportCommit(None, "one",
+            [("M", os.path.join("foo", "bar", "g"), ":1")]), goob.ImportCommit(None, "two",
+            [("M", "b", ":1")])])
+        # foo/bar, foo and the top for the first commit; just the top for the second
+        self.assertEqual(len(encoded), 4)
+
+    def test_unknown_mark(self):
+        with self.assertRaises(goob.BadImportError):
+            goob.fast_import([goob.ImportCommit(None, "oops", [("M", "a", ":9")])])
+
+class testCloneFetch(BaseTest):
+    def setUp(self):
+        super(testCloneFetch, self).setUp()
+        os.mkdir("src")
+        os.chdir("src")
+        goob.init()
+        make_lotsa_test_files()
+        goob.commit("first commit")
+        os.chdir("..")
+        self.stats = goob.clone("src", "dest")
+
+    def src_commit(self, filename, contents, msg):
+        os.chdir("src")
+        make_test_file(filename, contents)
+        goob.add(filename)
+        goob.commit(msg)
+        os.chdir("..")
+
+    def test_clone(self):
+        self.assertTrue(self.stats.updated)
+        self.assertEqual(self.stats.commits, 1)
+        # commit, 3 trees, 9 blobs
+        self.assertEqual(self.stats.objects, 13)
+        os.chdir("dest")
+        self.assertEqual(goob.get_cur_head(), self.stats.head)
+        self.assertEqual(open(os.path.join("foo", "bar", "g")).read(), "contents of file g")
+        self.assertEqual(goob.Status(), goob.status())
+        self.assertEqual(goob.fsck(progress=False).ok, True)
+        self.assertEqual(goob.list_loose_objects(), [])
+
+    def test_fetch_one_commit(self):
+        self.src_commit(os.path.join("foo", "bar", "g"), "changed", "second commit")
+        os.chdir("dest")
+        stats = goob.fetch(os.path.join("..", "src"))
+        # commit, 3 trees on the path to g, g
+        self.assertEqual((stats.commits, stats.objects, stats.updated), (1, 5, True))
+        self.assertEqual(open(os.path.join("foo", "bar", "g")).read(), "changed")
+        self.assertEqual([entry.hash for entry in goob.log()][0], stats.head)
+        self.assertEqual(len(goob.log()), 2)
+
+        stats = goob.fetch(os.path.join("..", "src"))
+        self.assertEqual((stats.commits, stats.objects, stats.updated), (0, 0, False))
+
+    def test_fetch_skips_unchanged_subtrees(self):
+        self.src_commit("a", "changed", "second commit")
+        os.chdir("dest")
+        foo_tree = goob.read_hash(goob.read_hash(goob.get_cur_head()).tree_hash)["foo"].hash
+        read = []
+        orig_read_hash = goob.read_hash
+        def read_hash(hash, stream=False):
+            read.append(hash)
+            return orig_read_hash(hash, stream)
+        goob.read_hash = read_hash
+        self.addCleanup(setattr, goob, "read_hash", orig_read_hash)
+        # (checkout has its own reading to do)
+        orig_checkout = goob.checkout
+        goob.checkout = lambda commit_hash: goob.update_head(commit_hash)
+        self.addCleanup(setattr, goob, "checkout", orig_checkout)
+        stats = goob.fetch(os.path.join("..", "src"))
+        # the commit, its tree and "a"
+        self.assertEqual(stats.objects, 3)
+        self.assertNotIn(foo_tree, read)
+
+    def test_diverged(self):
+        self.src_commit("a", "src version", "src commit")
+        os.chdir("dest")
+        make_test_file("b", "dest version")
+        goob.add("b")
+        goob.commit("dest commit")
+        head = goob.get_cur_head()
+        stats = goob.fetch(os.path.join("..", "src"))
+        self.assertEqual((stats.commits, stats.updated), (1, False))
+        self.assertEqual(goob.get_cur_head(), head)
+        self.assertEqual(open(os.path.join(goob.REFS_PATH, "FETCH_HEAD")).read(), stats.head)
+        self.assertEqual(goob.read_hash(stats.head).msg, "src commit")
+        self.assertEqual(open("a").read(), "contents of file a")
+
+    def test_fetch_with_bitmaps(self):
+        self.src_commit(os.path.join("foo", "bar", "g"), "changed", "second commit")
+        os.chdir("src")
+        goob.write_bitmaps()
+        os.chdir(os.path.join("..", "dest"))
+        stats = goob.fetch(os.path.join("..", "src"))
+        self.assertEqual((stats.commits, stats.objects, stats.updated), (1, 5, True))
+        self.assertEqual(goob.fsck(progress=False).ok, True)
+
+    def test_not_a_repo(self):
+        os.mkdir("empty")
+        os.chdir("dest")
+        self.assertRaises(goob.NoRepoError, goob.fetch, os.path.join("..", "empty"))
+
+    def test_chunked_blobs(self):
+        for name, value in [("CHUNK_BLOBS", True), ("CHUNK_THRESHOLD", 64 * 1024),
+                ("CHUNK_MIN_SIZE", 2 * 1024), ("CHUNK_MAX_SIZE", 32 * 1024), ("CHUNK_BITS", 12)]:
+            self.addCleanup(setattr, goob, name, getattr(goob, name))
+            setattr(goob, name, value)
+        rand = random.Random(0)
+        contents = "".join(chr(rand.randrange(256)) for _ in xrange(300 * 1024))
+        self.src_commit("big", contents, "big file")
+        os.chdir("dest")
+        stats = goob.fetch(os.path.join("..", "src"))
+        self.assertGreater(stats.objects, 5)
+        self.assertEqual(open("big").read(), contents)
+        self.assertEqual(goob.fsck(progress=False).ok, True)
+
+class testMigrate(BaseTest):
+    def setUp(self):
+        super(testMigrate, self).setUp()
+        goob.init()
+        self.files_made = make_lotsa_test_files(add_all=False)
+        # build a repo the old way: everything pickled, old-style hashes
+        index_data = {}
+        for filename in self.files_made:
+            with open(filename) as f:
+                contents = f.read()
+            index_data[filename] = goob.make_hash(contents, "blob")
+            with open(goob.hash_to_path(index_data[filename]), 'wb') as f:
+                cPickle.dump(contents, f)
+        parent = ""
+        for msg in ["first commit", "second commit"]:
+            old_commit = goob.Commit(make_pickled_tree(index_data), "Sat Oct 17 12:00:00 2026", msg, parent)
+            parent = goob.make_hash(str(old_commit), "commit")
+            with open(goob.hash_to_path(parent), 'wb') as f:
+                cPickle.dump(old_commit, f)
+        goob.update_head(parent)
+        goob.write_index(index_data)
+        self.old_head = parent
+
+    def test_migrate(self):
+        goob.migrate()
+
+        self.assertNotEqual(goob.get_cur_head(), self.old_head)
+        cur_commit = goob.read_hash(goob.get_cur_head())
+        self.assertEqual(cur_commit.msg, "second commit")
+        self.assertEqual(goob.read_hash(cur_commit.parent).msg, "first commit")
+        self.assertEqual(set(goob.walk_tree(cur_commit.tree_hash)), set(self.files_made))
+        self.assertEqual(cur_commit.tree_hash, goob.make_tree(goob.read_index()))
+        for filename in self.files_made:
+            hash = goob.get_hash_from_index(filename)
+            with open(goob.hash_to_path(hash), 'rb') as f:
+                self.assertEqual(f.read(), goob.BLOB_RAW_MAGIC + "contents of file %s" % os.path.basename(filename))
+        self.assertEqual(goob.status(), goob.Status())
+
+    def test_fsck_after_migrate(self):
+        goob.migrate()
+        report = goob.fsck(workers=1, progress=False)
+        # the old objects are left behind, unreferenced and uncheckable, but fine
+        self.assertTrue(report.ok)
+        self.assertEqual(report.corrupt, [])
+        self.assertGreater(len(report.pickled), 0)
+        self.assertTrue(set(report.pickled) <= set(report.dangling))
+
 class testCommitCreation(BaseTest):
     def setUp(self):
         super(testCommitCreation, self).setUp()
@@ -339,7 +1519,7 @@ class testStatusFunc(BaseTest):
         goob.add("new_file")
 
         # print "\n"
-        # returned_status = goob.status()
+        returned_status = goob.status()
 
         expected_status = goob.Status(new=["new_file"],
                             modified_added=["modify_and_add_me"],
@@ -351,6 +1531,503 @@ class testStatusFunc(BaseTest):
         self.assertEqual(expected_status, returned_status)
 
 
+    def test_status_before_first_commit(self):
+        make_test_file("added", "this file is added")
+        make_test_file("untracked_file", "this file isn't")
+        goob.add("added")
+
+        expected_status = goob.Status(new=["added"], untracked=["untracked_file"])
+        self.assertEqual(expected_status, goob.status())
+
+    def test_status_in_subdirectories(self):
+        files_made = make_lotsa_test_files()
+        make_test_file("foo.txt", "sorts between foo and foo/...")
+        goob.commit("first commit")
+        make_test_file(os.path.join("foo", "bar", "g"), "modified")
+        os.remove(os.path.join("foo", "e"))
+
+        expected_status = goob.Status(modified_not_added=[os.path.join("foo", "bar", "g")],
+                            deleted=[os.path.join("foo", "e")],
+                            untracked=["foo.txt"])
+        self.assertEqual(expected_status, goob.status())
+
+    def test_status_not_equal(self):
+        self.assertNotEqual(goob.Status(new=["a"]), goob.Status(untracked=["a"]))
+
+class testMergeSorted(unittest.TestCase):
+    def runTest(self):
+        merged = list(goob.merge_sorted([("a", 1), ("c", 3)], [("b", 2), ("c", 4)], []))
+        self.assertEqual(merged, [("a", (1, None, None)), ("b", (None, 2, None)),
+            ("c", (3, 4, None))])
+
+class testFSMonitor(BaseTest):
+    def setUp(self):
+        super(testFSMonitor, self).setUp()
+        goob.init()
+        make_lotsa_test_files()
+        goob.commit("first commit")
+        self.monitor = goob.FSMonitor(use_inotify=False)
+        self.monitor.start()
+        goob.status() # full scan, saves the state
+
+    def tearDown(self):
+        self.monitor.stop()
+        super(testFSMonitor, self).tearDown()
+
+    def full_scan_fails(self):
+        def fail(*args, **kwargs):
+            raise AssertionError("did a full scan")
+        self._orig_full_status = goob._full_status
+        goob._full_status = fail
+        self.addCleanup(setattr, goob, "_full_status", self._orig_full_status)
+
+    def test_only_changed_paths_checked(self):
+        make_test_file("a", "modified")
+        make_test_file(os.path.join("foo", "new"), "new file")
+        os.remove(os.path.join("foo", "bar", "g"))
+        self.monitor.poll_once()
+        self.full_scan_fails()
+
+        expected_status = goob.Status(modified_not_added=["a"],
+                            untracked=[os.path.join("foo", "new")],
+                            deleted=[os.path.join("foo", "bar", "g")])
+        self.assertEqual(expected_status, goob.status())
+        # and it's remembered for next time
+        self.assertEqual(expected_status, goob.status())
+
+    def test_changed_files_not_matched_against_everything(self):
+        make_test_file("a", "modified")
+        make_test_file(os.path.join("foo", "bar", "h"), "modified")
+        self.monitor.poll_once()
+        self.full_scan_fails()
+        # files that were files before too can't have anything under them
+        orig_bisect_left = goob.bisect.bisect_left
+        def bisect_left(*args):
+            raise AssertionError("looked for paths under a file")
+        goob.bisect.bisect_left = bisect_left
+        try:
+            status = goob.status()
+        finally:
+            goob.bisect.bisect_left = orig_bisect_left
+        self.assertEqual(goob.Status(modified_not_added=["a", os.path.join("foo", "bar", "h")]),
+            status)
+
+    def test_full_scan_after_index_changes(self):
+        make_test_file("z", "new file")
+        self.monitor.poll_once()
+        goob.add("z")
+        self.assertIsNone(goob._fsmonitor_status(goob.read_index(), {},
+            goob.get_cur_head(), None, goob.fsmonitor_token()))
+        self.assertEqual(goob.Status(new=["z"]), goob.status())
+
+    def test_full_scan_after_watcher_restarts(self):
+        make_test_file("a", "modified behind the watcher's back")
+        self.monitor.start()
+        self.assertEqual(goob.Status(modified_not_added=["a"]), goob.status())
+
+    def test_no_watcher(self):
+        self.monitor.stop()
+        self.assertIsNone(goob.fsmonitor_token())
+        make_test_file("a", "modified")
+        self.assertEqual(goob.Status(modified_not_added=["a"]), goob.status())
+
+    def test_ignored_files_skipped(self):
+        make_test_file(".goobignore", "*.log\n")
+        goob.add(".goobignore")
+        goob.commit("ignore logs")
+        self.monitor.poll_once()
+        goob.status() # .goobignore changed, so a full scan
+        make_test_file(os.path.join("foo", "debug.log"), "noise")
+        self.monitor.poll_once()
+        self.full_scan_fails()
+        self.assertEqual(goob.Status(), goob.status())
+
+    def test_file_replaced_by_directory(self):
+        os.remove("a")
+        os.mkdir("a")
+        make_test_file(os.path.join("a", "x"), "where a file used to be")
+        os.remove(os.path.join("foo", "d"))
+        os.rename(os.path.join("foo", "bar"), os.path.join("foo", "d"))
+        self.monitor.poll_once()
+        self.full_scan_fails()
+
+        expected_status = goob.Status(untracked=[os.path.join("a", "x")] +
+                            [os.path.join("foo", "d", name) for name in "ghi"],
+                            deleted=["a", os.path.join("foo", "bar", "g"),
+                                os.path.join("foo", "bar", "h"), os.path.join("foo", "bar", "i"),
+                                os.path.join("foo", "d")])
+        self.assertEqual(expected_status, goob.status())
+
+    @unittest.skipIf(goob._load_inotify() is None, "no inotify here")
+    def test_inotify(self):
+        monitor = goob.FSMonitor(use_inotify=True)
+        monitor.start()
+        self.addCleanup(monitor.stop)
+        goob.status()
+        make_test_file(os.path.join("foo", "bar", "h"), "modified")
+        os.mkdir("baz")
+        make_test_file(os.path.join("baz", "j"), "in a new directory")
+        monitor.poll_once(1)
+        monitor.poll_once(0.1)
+
+        journal = goob.read_fsmonitor_journal(0, goob.fsmonitor_token()[1])
+        self.assertIn(os.path.join("foo", "bar", "h"), journal)
+        self.assertIn(os.path.join("baz", "j"), journal)
+        expected_status = goob.Status(modified_not_added=[os.path.join("foo", "bar", "h")],
+                            untracked=[os.path.join("baz", "j")])
+        self.assertEqual(expected_status, goob.status())
+
+class testLog(BaseTest):
+    def setUp(self):
+        super(testLog, self).setUp()
+        goob.init()
+        self.commits = []
+        for i in xrange(5):
+            make_test_file("testfile", "version %d" % i)
+            goob.add("testfile")
+            goob.commit("commit %d" % i)
+            self.commits.append(goob.get_cur_head())
+        self.commits.reverse() # newest first, like log
+
+    def test_log_lists_all_commits(self):
+        entries = goob.log()
+        self.assertEqual([entry.hash for entry in entries], self.commits)
+        self.assertEqual([entry.generation for entry in entries], [5, 4, 3, 2, 1])
+        self.assertEqual(entries[0].parent, self.commits[1])
+        self.assertIsNone(entries[-1].parent)
+        self.assertEqual(entries[0].tree_hash, goob.read_hash(self.commits[0]).tree_hash)
+
+    def test_log_paging(self):
+        self.assertEqual([entry.hash for entry in goob.log(limit=2)], self.commits[:2])
+        self.assertEqual([entry.hash for entry in goob.log(limit=2, offset=2)], self.commits[2:4])
+        self.assertEqual(goob.log(offset=5), [])
+
+    def test_log_since(self):
+        # make the first two commits look old
+        graph = goob.CommitGraph.load()
+        for commit_hash in self.commits[3:]:
+            i = graph.positions[commit_hash]
+            graph.records[i] = graph.records[i][:3] + (1000000000.0,) + graph.records[i][4:]
+        graph.write()
+
+        since = time.time() - 3600
+        self.assertEqual([entry.hash for entry in goob.log(since=since)], self.commits[:3])
+        self.assertEqual(goob.count_commits(since=since), 3)
+        self.assertEqual(goob.count_commits(), 5)
+
+    def test_listing_doesnt_read_commits(self):
+        goob.object_cache.clear()
+        real_read_hash = goob.read_hash
+        def read_hash(hash, stream=False):
+            raise AssertionError("read a commit")
+        goob.read_hash = read_hash
+        try:
+            self.assertEqual(len(goob.list_commits()), 5)
+            self.assertEqual(goob.count_commits(), 5)
+        finally:
+            goob.read_hash = real_read_hash
+
+    def test_graph_rebuilt_for_old_repo(self):
+        os.remove(goob.COMMIT_GRAPH_PATH)
+        self.assertEqual([entry.hash for entry in goob.list_commits()], self.commits)
+        self.assertEqual(len(goob.CommitGraph.load()), 5)
+
+    def test_half_written_record_ignored(self):
+        with open(goob.COMMIT_GRAPH_PATH, 'ab') as f:
+            f.write("garbage")
+        self.assertEqual(len(goob.CommitGraph.load()), 5)
+        make_test_file("testfile", "version 5")
+        goob.add("testfile")
+        goob.commit("commit 5")
+        self.assertEqual(goob.count_commits(), 6)
+        self.assertEqual(len(goob.CommitGraph.load()), 6)
+
+class testPathHistory(BaseTest):
+    def setUp(self):
+        super(testPathHistory, self).setUp()
+        goob.init()
+        make_lotsa_test_files()
+        goob.commit("first commit")
+        self.commits = [goob.get_cur_head()]
+        for filename, contents in [("a", "a 2"), (os.path.join("foo", "d"), "d 2"),
+                ("a", "a 3"), (os.path.join("foo", "bar", "g"), "g 2"), ("b", "b 2")]:
+            make_test_file(filename, contents)
+            goob.add(filename)
+            goob.commit("change %s" % filename)
+            self.commits.append(goob.get_cur_head())
+
+    def history(self, path):
+        return [entry.hash for entry in goob.log(path=path)]
+
+    def test_file_history(self):
+        c = self.commits
+        self.assertEqual(self.history("a"), [c[3], c[1], c[0]])
+        self.assertEqual(self.history(os.path.join("foo", "bar", "h")), [c[0]])
+        self.assertEqual(self.history("nonexistent"), [])
+
+    def test_directory_history(self):
+        c = self.commits
+        self.assertEqual(self.history("foo"), [c[4], c[2], c[0]])
+        self.assertEqual(self.history(os.path.join("foo", "bar") + os.sep), [c[4], c[0]])
+
+    def test_path_filters_skip_commits(self):
+        self.assertEqual(goob.write_path_filters(), 6)
+        self.assertEqual(goob.write_path_filters(), 0)
+        make_test_file("c", "c 2")
+        goob.add("c")
+        goob.commit("change c") # keeps the filters up to date
+        self.assertEqual(len(goob.PathFilters.load().records), 7)
+
+        reads = []
+        orig_tree_child = goob._tree_child
+        def tree_child(tree_hash, name):
+            reads.append(tree_hash)
+            return orig_tree_child(tree_hash, name)
+        goob._tree_child = tree_child
+        self.addCleanup(setattr, goob, "_tree_child", orig_tree_child)
+
+        c = self.commits
+        self.assertEqual(self.history("a"), [c[3], c[1], c[0]])
+        # only the commits that changed 'a' (including the first, whose filter
+        # matches everything) had their trees looked at
+        self.assertEqual(len(reads), 3 * 2)
+
+    def test_stale_path_filters_ignored(self):
+        goob.write_path_filters()
+        os.remove(goob.COMMIT_GRAPH_PATH)
+        goob.fast_import([goob.ImportBlob(":1", "x"), goob.ImportCommit(None, "other history",
+            [("deleteall",), ("M", "a", ":1")], parent="")])
+        # the graph's been rebuilt with just the new commit, so every old filter
+        # was stale and got replaced
+        self.assertEqual(len(goob.CommitGraph.for_head()), 1)
+        self.assertEqual(len(goob.PathFilters.load().records), 1)
+        self.assertEqual(self.history("a"), [goob.get_cur_head()])
+
+    def test_blame(self):
+        make_test_file("poem", "one\ntwo\nthree\n")
+        goob.add("poem")
+        goob.commit("poem")
+        first = goob.get_cur_head()
+        make_test_file("poem", "one\n2\nthree\nfour\n")
+        goob.add("poem")
+        goob.commit("poem again")
+        second = goob.get_cur_head()
+        make_test_file("b", "unrelated")
+        goob.add("b")
+        goob.commit("unrelated")
+        make_test_file("poem", "zero\none\n2\nthree\nfour\n")
+        goob.add("poem")
+        goob.commit("poem a third time")
+        third = goob.get_cur_head()
+
+        self.assertEqual(goob.blame("poem"), [goob.BlameLine(third, "zero"),
+            goob.BlameLine(first, "one"), goob.BlameLine(second, "2"),
+            goob.BlameLine(first, "three"), goob.BlameLine(second, "four")])
+        self.assertEqual([line.commit for line in goob.blame("poem", second)],
+            [first, second, first, second])
+        with self.assertRaises(goob.NoFileError):
+            goob.blame("foo")
+
+class testCheckout(BaseTest):
+    def setUp(self):
+        super(testCheckout, self).setUp()
+        goob.init()
+        self.files_made = make_lotsa_test_files()
+        goob.commit("first commit")
+        self.first_commit = goob.get_cur_head()
+
+        make_test_file("a", "new contents of file a")
+        goob.add("a")
+        goob.rm(os.path.join("foo", "bar", "g"))
+        os.mkdir("baz")
+        make_test_file(os.path.join("baz", "new"), "a new file")
+        goob.add(os.path.join("baz", "new"))
+        goob.commit("second commit")
+        self.second_commit = goob.get_cur_head()
+
+    def assertFileContents(self, filename, contents):
+        with open(filename) as f:
+            self.assertEqual(f.read(), contents)
+
+    def test_checkout_previous_commit(self):
+        changes = goob.checkout(self.first_commit)
+
+        self.assertEqual(len(changes), 3)
+        self.assertEqual(goob.get_cur_head(), self.first_commit)
+        self.assertFileContents("a", "contents of file a")
+        self.assertFileContents(os.path.join("foo", "bar", "g"), "contents of file g")
+        self.assertFalse(os.path.exists("baz"))
+        self.assertEqual(sorted(goob.read_index().keys()), sorted(self.files_made))
+        self.assertEqual(goob.status(), goob.Status())
+
+    def test_checkout_and_back(self):
+        goob.checkout(self.first_commit)
+        goob.checkout(self.second_commit)
+        self.assertFileContents("a", "new contents of file a")
+        self.assertFileContents(os.path.join("baz", "new"), "a new file")
+        self.assertFalse(os.path.exists(os.path.join("foo", "bar", "g")))
+        self.assertEqual(goob.status(), goob.Status())
+
+    def test_unchanged_files_not_touched(self):
+        inode = os.stat("b").st_ino
+        goob.checkout(self.first_commit)
+        self.assertEqual(os.stat("b").st_ino, inode)
+
+    def test_file_replaced_by_directory(self):
+        goob.rm("c")
+        os.mkdir("c")
+        make_test_file(os.path.join("c", "inside"), "file in a directory named c")
+        goob.add(os.path.join("c", "inside"))
+        goob.commit("third commit")
+        third_commit = goob.get_cur_head()
+
+        goob.checkout(self.first_commit)
+        self.assertFileContents("c", "contents of file c")
+        goob.checkout(third_commit)
+        self.assertFileContents(os.path.join("c", "inside"), "file in a directory named c")
+
+    def test_switching_back_and_forth_reads_only_the_diff(self):
+        os.mkdir("many")
+        for i in xrange(50):
+            make_test_file(os.path.join("many", "f%d" % i), "file %d" % i)
+        goob.add_all()
+        goob.commit("lots of files")
+        a = goob.get_cur_head()
+        make_test_file("a", "one more change")
+        goob.add("a")
+        goob.commit("one file changed")
+        b = goob.get_cur_head()
+
+        read = []
+        orig_read_hash = goob.read_hash
+        def read_hash(hash, stream=False):
+            read.append(hash)
+            return orig_read_hash(hash, stream)
+        goob.read_hash = read_hash
+        self.addCleanup(setattr, goob, "read_hash", orig_read_hash)
+        counts = []
+        for commit_hash in [a, b, a, b]:
+            del read[:]
+            goob.checkout(commit_hash)
+            counts.append(len(read))
+        # every switch costs the same, and nowhere near the 60-odd objects in the tree
+        self.assertEqual(len(set(counts)), 1)
+        self.assertLess(counts[0], 10)
+        self.assertEqual(goob.status(), goob.Status())
+
+    def test_modified_file_blocks_checkout(self):
+        make_test_file("a", "uncommitted changes")
+        with self.assertRaises(goob.UncommittedChangesError) as e:
+            goob.checkout(self.first_commit)
+        self.assertEqual(goob.get_cur_head(), self.second_commit)
+        self.assertFileContents("a", "uncommitted changes")
+
+    def test_staged_changes_block_checkout(self):
+        make_test_file("b", "staged changes")
+        goob.add("b")
+        with self.assertRaises(goob.UncommittedChangesError) as e:
+            goob.checkout(self.first_commit)
+
+    def test_untracked_file_in_the_way_blocks_checkout(self):
+        goob.checkout(self.first_commit)
+        os.mkdir("baz")
+        make_test_file(os.path.join("baz", "new"), "something else")
+        with self.assertRaises(goob.UncommittedChangesError) as e:
+            goob.checkout(self.second_commit)
+
+    def test_untracked_directory_in_the_way_blocks_checkout(self):
+        goob.checkout(self.first_commit)
+        os.mkdir("baz")
+        os.mkdir(os.path.join("baz", "new"))
+        make_test_file(os.path.join("baz", "new", "x"), "untracked")
+        with self.assertRaises(goob.UncommittedChangesError):
+            goob.checkout(self.second_commit)
+        # nothing was touched
+        self.assertEqual(goob.get_cur_head(), self.first_commit)
+        self.assertFileContents("a", "contents of file a")
+        self.assertTrue(os.path.exists(os.path.join("foo", "bar", "g")))
+
+        os.remove(os.path.join("baz", "new", "x"))
+        with self.assertRaises(goob.UncommittedChangesError):
+            goob.checkout(self.second_commit)
+
+    def test_untracked_file_where_directory_goes_blocks_checkout(self):
+        goob.checkout(self.first_commit)
+        make_test_file("baz", "untracked")
+        with self.assertRaises(goob.UncommittedChangesError):
+            goob.checkout(self.second_commit)
+        self.assertEqual(goob.get_cur_head(), self.first_commit)
+        self.assertFileContents("a", "contents of file a")
+        self.assertFileContents("baz", "untracked")
+
+class testDiff(BaseTest):
+    def test_diff_lines_is_minimal(self):
+        rand = random.Random(1234)
+        for trial in xrange(50):
+            a = [rand.choice("abcd") for i in xrange(rand.randint(0, 20))]
+            b = [rand.choice("abcd") for i in xrange(rand.randint(0, 20))]
+            ops = goob.diff_lines(a, b)
+            self.assertEqual([line for op, line in ops if op != "+"], a)
+            self.assertEqual([line for op, line in ops if op != "-"], b)
+            self.assertEqual(len([op for op, line in ops if op == "="]), lcs_length(a, b))
+
+    def test_unified_hunks(self):
+        a = ["line %d" % i for i in xrange(20)]
+        b = a[:2] + ["inserted"] + a[2:15] + a[16:]
+        self.assertEqual(goob.unified_hunks(goob.diff_lines(a, b)), [
+            "@@ -1,5 +1,6 @@", " line 0", " line 1", "+inserted", " line 2", " line 3", " line 4",
+            "@@ -13,7 +14,6 @@", " line 12", " line 13", " line 14", "-line 15", " line 16",
+            " line 17", " line 18"])
+
+    def test_diff_files(self):
+        make_test_file("a", "contents of file a")
+        make_test_file("b", "contents of file b")
+        make_test_file("c", "contents of file a")
+        self.assertTrue(goob.diff("a", "b"))
+        self.assertFalse(goob.diff("a", "c"))
+
+    def test_diff_commits(self):
+        goob.init()
+        make_lotsa_test_files()
+        goob.commit("first commit")
+        first_commit = goob.get_cur_head()
+        make_test_file("a", "contents of file a\nand another line")
+        goob.add("a")
+        goob.rm("b")
+        make_test_file(os.path.join("foo", "new"), "new file")
+        goob.add(os.path.join("foo", "new"))
+        goob.commit("second commit")
+
+        changes = goob.diff_commits(first_commit)
+        self.assertEqual([(change.path, change.kind) for change in changes],
+            [("a", "modified"), ("b", "removed"), (os.path.join("foo", "new"), "added")])
+        self.assertEqual(goob.diff_blobs(changes[0].old_hash, changes[0].new_hash, "a"),
+            ["--- a/a", "+++ b/a", "@@ -1,1 +1,2 @@", " contents of file a", "+and another line"])
+        self.assertEqual(goob.diff_blobs(changes[0].old_hash, changes[0].old_hash), [])
+
+    def test_diff_trees_skips_unchanged_subtrees(self):
+        goob.init()
+        make_lotsa_test_files()
+        goob.commit("first commit")
+        first_tree = goob.read_hash(goob.get_cur_head()).tree_hash
+        make_test_file("a", "changed")
+        goob.add("a")
+        goob.commit("second commit")
+        second_tree = goob.read_hash(goob.get_cur_head()).tree_hash
+
+        read = []
+        real_read_hash = goob.read_hash
+        def read_hash(hash, stream=False):
+            read.append(hash)
+            return real_read_hash(hash, stream)
+        goob.read_hash = read_hash
+        try:
+            changes = list(goob.diff_trees(first_tree, second_tree))
+        finally:
+            goob.read_hash = real_read_hash
+        self.assertEqual([change.path for change in changes], ["a"])
+        self.assertEqual(read, [first_tree, second_tree])
+
 class testWalkTree(BaseTest):
     def runTest(self):
         goob.init()
@@ -368,6 +2045,34 @@ def make_test_file(filename, contents):
     with open(filename, 'w') as f:
         f.write(contents)
 
+def lcs_length(a, b):
+    lengths = [[0] * (len(b) + 1) for i in xrange(len(a) + 1)]
+    for i in xrange(len(a)):
+        for j in xrange(len(b)):
+            if a[i] == b[j]:
+                lengths[i + 1][j + 1] = lengths[i][j] + 1
+            else:
+                lengths[i + 1][j + 1] = max(lengths[i][j + 1], lengths[i + 1][j])
+    return lengths[len(a)][len(b)]
+
+def make_pickled_tree(path_dict):
+    """Saves a tree the way goob used to (pickled, hashed over its repr), returns
+        its hash."""
+    my_tree = {}
+    directories = {}
+    for path, hash in path_dict.iteritems():
+        if os.sep in path:
+            dir, rest = path.split(os.sep, 1)
+            directories.setdefault(dir, {})[rest] = hash
+        else:
+            my_tree[path] = goob.ObjectHash(hash, "blob")
+    for dir, filedict in directories.iteritems():
+        my_tree[dir] = goob.ObjectHash(make_pickled_tree(filedict), "tree")
+    hash = goob.make_hash(str(sorted(my_tree.items())), "tree")
+    with open(goob.hash_to_path(hash), 'wb') as f:
+        cPickle.dump(my_tree, f)
+    return hash
+
 def make_lotsa_test_files(add_all=True):
     subdir0 = "foo"
     subdir1 = "bar"
@@ -397,5 +2102,80 @@ def make_lotsa_test_files(add_all=True):
 
     return files_made
 
+class testTracing(BaseTest):
+    def setUp(self):
+        super(testTracing, self).setUp()
+        goob.init()
+        self.addCleanup(goob.disable_tracing)
+        self.addCleanup(os.environ.pop, goob.TRACE_ENV, None)
+
+    def test_enable_tracing(self):
+        tracer = goob.enable_tracing()
+        make_lotsa_test_files()
+        goob.commit("first commit")
+        goob.status()
+        self.assertIs(goob.disable_tracing(), tracer)
+
+        self.assertEqual(tracer.stats["add"][0], 9)
+        self.assertEqual(tracer.stats["commit"][0], 1)
+        self.assertEqual(tracer.stats["save_blob_stream"][:2], [9, sum(len(
+            "contents of file %s" % name) for name in "abcdefghi")])
+        for name in ["make_hash", "save_encoded", "read_index_ext", "write_index", "listdir"]:
+            self.assertGreater(tracer.stats[name][0], 0)
+        self.assertGreater(tracer.stats["commit"][2], 0)
+        self.assertEqual(tracer.events, [])
+        self.assertIn("save_blob_stream", str(tracer))
+
+    def test_disabled_by_default(self):
+        make_test_file("a", "contents")
+        goob.add("a")
+        self.assertIsNone(goob.disable_tracing())
+
+    def test_chrome_trace_from_environment(self):
+        trace_path = os.path.join(self._temp_dir, "trace.json")
+        os.environ[goob.TRACE_ENV] = trace_path
+        make_test_file("a", "contents")
+        goob.add("a")
+
+        with open(trace_path) as f:
+            events = json.load(f)["traceEvents"]
+        names = [event["name"] for event in events]
+        self.assertIn("add", names)
+        self.assertIn("save_blob_stream", names)
+        add_event = events[names.index("add")]
+        for event in events:
+            # everything happened within the command
+            self.assertGreaterEqual(event["ts"], add_event["ts"])
+            self.assertLessEqual(event["ts"] + event["dur"], add_event["ts"] + add_event["dur"] + 1)
+        # the command's tracer is gone once it's dumped
+        self.assertIsNone(goob._tracer)
+
+class testBenchmarks(BaseTest):
+    def test_make_repo(self):
+        filenames = bench_goob.make_repo("repo", files=30, depth=2, fanout=2,
+            file_size=100, commits=3, changes=5)
+        self.assertEqual(len(filenames), 30)
+        os.chdir("repo")
+        self.assertEqual(len(goob.log()), 3)
+        self.assertEqual(goob.Status(), goob.status())
+        self.assertTrue(all(os.path.getsize(filename) == 100 for filename in filenames))
+        self.assertTrue(any(filename.count(os.sep) == 2 for filename in filenames))
+
+    def test_run_and_compare(self):
+        params = dict(bench_goob.DEFAULTS, files=20, commits=2, changes=3)
+        filenames = bench_goob.make_repo("repo", **params)
+        results = bench_goob.run_benchmarks(os.path.abspath("repo"), filenames, params,
+            ["status (clean)", "commit"], repeat=1)
+        self.assertEqual(results.keys(), ["status (clean)", "commit"])
+        self.assertGreater(results["commit"]["peak_rss_kb"], 0)
+        # the commit ran on a copy
+        os.chdir("repo")
+        self.assertEqual(len(goob.log()), 2)
+
+        old = {"results": {"commit": {"best": 1.0}, "status (clean)": {"best": 1.0}}}
+        new = {"results": {"commit": {"best": 2.0}, "status (clean)": {"best": 1.1}}}
+        self.assertEqual(sorted((name, regression) for name, _, _, _, regression in
+            bench_goob.compare_results(old, new)), [("commit", True), ("status (clean)", False)])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file